@@ -0,0 +1,193 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+# Precomputed conditioning for training. Conditioner outputs only depend on the item, so for frozen conditioners
+# they are computed once by build_conditioning_store and written as one packed .npy array per output tensor
+# (row i belongs to item i of the manifest). PrecomputedConditioningDataset attaches each item's rows to its metadata,
+# PrecomputedConditioningCollator stacks them into a batch the DataLoader pins, and the training step uses that batch
+# instead of running the conditioner.
+
+STORE_KEY = "precomputed_conditioning"
+
+def _item_id(info):
+    return info["path"]
+
+def _as_list(output):
+    return list(output) if isinstance(output, (list, tuple)) else [output]
+
+def _numpy_dtype(tensor):
+    # numpy has no bfloat16
+    return torch.empty(0, dtype=torch.float32 if tensor.dtype == torch.bfloat16 else tensor.dtype).numpy().dtype
+
+@torch.no_grad()
+def build_conditioning_store(conditioner, dataset, output_dir, batch_size=16, num_workers=4, device="cuda"):
+    '''
+    Run conditioner (a MultiConditioner) over every item of dataset and write its outputs to output_dir.
+    Items are keyed by their metadata "path". Conditioners with trainable parameters change during
+    training, so they cannot be precomputed.
+    '''
+    from .dataset import collation_fn
+
+    assert not any(p.requires_grad for p in conditioner.parameters()), "Only frozen conditioners can be precomputed"
+    device = torch.device(device)
+    conditioner = conditioner.to(device).eval()
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size, shuffle=False, num_workers=num_workers, drop_last=False, collate_fn=collation_fn)
+    os.makedirs(output_dir, exist_ok=True)
+
+    arrays = {}
+    structure = {}
+    ids = []
+    for _, metadata in loader:
+        with torch.autocast(device.type, enabled=device.type == "cuda"):
+            conditioning = conditioner(metadata, device)
+
+        start = len(ids)
+        ids.extend(_item_id(info) for info in metadata)
+        for key, output in conditioning.items():
+            tensors = _as_list(output)
+            if key not in structure:
+                structure[key] = {"list": isinstance(output, (list, tuple)), "files": []}
+                for i, tensor in enumerate(tensors):
+                    filename = f"{key}.{i}.npy"
+                    structure[key]["files"].append(filename)
+                    arrays[filename] = np.lib.format.open_memmap(os.path.join(output_dir, filename), mode="w+",
+                                                                 dtype=_numpy_dtype(tensor), shape=(len(dataset), *tensor.shape[1:]))
+            for filename, tensor in zip(structure[key]["files"], tensors):
+                assert tuple(tensor.shape[1:]) == arrays[filename].shape[1:], f"{key} changes shape between batches"
+                arrays[filename][start:len(ids)] = tensor.float().cpu().numpy() if tensor.dtype == torch.bfloat16 else tensor.cpu().numpy()
+
+    for array in arrays.values():
+        array.flush()
+
+    manifest = {"num_items": len(ids), "ids": ids, "outputs": structure}
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    return manifest
+
+class ConditioningStore:
+    '''
+    Read-only view of a store written by build_conditioning_store. Arrays are memory-mapped,
+    so only the rows that are read are loaded.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.outputs = manifest["outputs"]
+        self.index = {item_id: row for row, item_id in enumerate(manifest["ids"])}
+        self.arrays = {filename: np.load(os.path.join(path, filename), mmap_mode="r")
+                       for output in self.outputs.values() for filename in output["files"]}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, item_id):
+        return item_id in self.index
+
+    def __getitem__(self, item_id):
+        '''
+        {conditioner id: tensor or list of tensors} for one item, without the batch dimension.
+        '''
+        row = self.index[item_id]
+        item = {}
+        for key, output in self.outputs.items():
+            tensors = [torch.from_numpy(np.array(self.arrays[filename][row])) for filename in output["files"]]
+            item[key] = tensors if output["list"] else tensors[0]
+        return item
+
+class PrecomputedConditioningDataset(torch.utils.data.Dataset):
+    '''
+    Adds each item's precomputed conditioning to its metadata under STORE_KEY.
+    The store is opened in each worker on first use.
+    '''
+    def __init__(self, dataset, store_path):
+        super().__init__()
+        self.dataset = dataset
+        self.store_path = store_path
+        self.store = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if self.store is None:
+            self.store = ConditioningStore(self.store_path)
+        audio, info = self.dataset[idx]
+        assert _item_id(info) in self.store, f"{_item_id(info)} is not in the conditioning store {self.store_path}"
+        info[STORE_KEY] = self.store[_item_id(info)]
+        return audio, info
+
+def stack_conditioning(items):
+    '''
+    Batch per-item (or per-row) conditioning dicts into the dict MultiConditioner would have returned, on the CPU.
+    '''
+    conditioning = {}
+    for key, output in items[0].items():
+        if isinstance(output, list):
+            conditioning[key] = [torch.stack([item[key][i] for item in items]) for i in range(len(output))]
+        else:
+            conditioning[key] = torch.stack([item[key] for item in items])
+    return conditioning
+
+class PrecomputedConditioningCollator:
+    '''
+    Wraps the collate_fn of a PrecomputedConditioningDataset loader (collation_fn or a packing.PackingCollator) and
+    moves the conditioning out of the metadata into a batched third element, [latents, metadata, conditioning].
+    Stacking happens in the loader workers, so a pin_memory DataLoader pins the batched tensors and the training
+    step only copies them to the device.
+    '''
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, samples):
+        latents, metadata = self.collate_fn(samples)
+        conditioning = stack_conditioning([info.pop(STORE_KEY) for info in metadata])
+        return [latents, metadata, conditioning]
+
+def conditioning_to(conditioning, device):
+    return {key: [t.to(device, non_blocking=True) for t in output] if isinstance(output, list) else output.to(device, non_blocking=True)
+            for key, output in conditioning.items()}
+
+if __name__ == "__main__":
+    import argparse
+
+    from ..models.factory import create_model_from_config
+    from ..models.utils import load_ckpt_state_dict
+    from .datamodule import DataModule
+
+    parser = argparse.ArgumentParser(description="Precompute conditioner outputs for the training set")
+    parser.add_argument("--model-config", required=True)
+    parser.add_argument("--dataset-config", required=True)
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--ckpt-path", default=None, help="Checkpoint with the conditioner weights, if the conditioners have any")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--device", default="cuda")
+    args = parser.parse_args()
+
+    with open(args.model_config) as f:
+        model_config = json.load(f)
+    with open(args.dataset_config) as f:
+        dataset_config = json.load(f)
+
+    model = create_model_from_config(model_config)
+    if args.ckpt_path is not None:
+        model.load_state_dict(load_ckpt_state_dict(args.ckpt_path), strict=False)
+
+    datamodule = DataModule(dataset_config, batch_size=args.batch_size, test_batch_size=args.batch_size,
+                            sample_size=model_config["sample_size"], sample_rate=model_config["sample_rate"],
+                            audio_channels=model_config.get("audio_channels", 2), num_workers=args.num_workers)
+    datamodule.setup("fit")
+    train_set = datamodule.train_set
+    if isinstance(train_set, PrecomputedConditioningDataset):
+        train_set = train_set.dataset
+
+    manifest = build_conditioning_store(model.conditioner, train_set, args.output_dir,
+                                        batch_size=args.batch_size, num_workers=args.num_workers, device=args.device)
+    print(f"Wrote conditioning for {manifest['num_items']} items: {list(manifest['outputs'])}")
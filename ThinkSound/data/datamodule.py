@@ -1,5 +1,7 @@
 import lightning as L
 from .dataset import LatentDataset, SampleDataset, VideoDataset, AudioDataset, MultiModalDataset, LocalDatasetConfig, collation_fn
+from .conditioning_store import PrecomputedConditioningCollator, PrecomputedConditioningDataset
+from .packing import PackingCollator
 import importlib
 from torch.utils.data import DataLoader
 
@@ -121,6 +123,10 @@ class DataModule(L.LightningDataModule):
         self.input_type = dataset_config.get("input_type", "video")
         self.fps = dataset_config.get("fps", 4)
         self.force_channels = force_channels
+        # Directory written by conditioning_store.build_conditioning_store; training then skips the conditioner
+        self.conditioning_store = dataset_config.get("conditioning_store", None)
+        # PackingCollator arguments, e.g. {"max_segments": 4}: pack clips of mixed duration into shared rows
+        self.packing = dataset_config.get("packing", None)
         
 
     def setup(self, stage: str):
@@ -169,6 +175,8 @@ class DataModule(L.LightningDataModule):
                     force_channels=self.force_channels
                 )
                 self.train_set = MultiModalDataset([self.video_set]*self.repeat_num, [self.audio_set])
+            if self.conditioning_store is not None:
+                self.train_set = PrecomputedConditioningDataset(self.train_set, self.conditioning_store)
             self.val_set = create_dataset(self.val_configs, random_crop=False)
         elif stage == 'validate':
             self.val_set = create_dataset(self.val_configs, random_crop=False)
@@ -176,8 +184,11 @@ class DataModule(L.LightningDataModule):
             self.test_set = create_dataset(self.test_configs, random_crop=False)
 
     def train_dataloader(self):
+        collate_fn = PackingCollator(**self.packing) if self.packing is not None else collation_fn
+        if self.conditioning_store is not None:
+            collate_fn = PrecomputedConditioningCollator(collate_fn)
         return DataLoader(self.train_set, self.batch_size, shuffle=True,
-                                num_workers=self.num_workers, persistent_workers=True, pin_memory=True, drop_last=True, collate_fn=collation_fn)
+                                num_workers=self.num_workers, persistent_workers=True, pin_memory=True, drop_last=True, collate_fn=collate_fn)
 
     def val_dataloader(self):
         return DataLoader(self.val_set, self.batch_size, shuffle=False,
@@ -0,0 +1,100 @@
+import torch
+
+from ..models.packing import PACKING_KEY, STREAMS, packed_length, segment_starts
+from .conditioning_store import STORE_KEY
+
+# Sequence packing for training on clips of mixed duration (see models.packing). Instead of padding every clip to
+# the full latent length, PackingCollator packs the clips of a loader batch into rows, first fit by decreasing
+# length: each row holds up to max_segments clips, back to back in every stream with zero gaps between them.
+
+# Metadata features that are time series in a stream (time first), and are packed like the latents
+STREAM_KEYS = {"metaclip_features": "clip", "sync_features": "sync"}
+
+class PackingCollator:
+    '''
+    collate_fn for a dataset of (latent (C, N), metadata) items, e.g. VideoDataset. Returns (latents, metadata)
+    like collation_fn, with fewer rows than items: each row's metadata holds its packed stream features, its
+    other tensor features stacked per segment slot (K, ...), the layout under PACKING_KEY for
+    models.packing.SequencePacking.from_metadata, and the non-tensor metadata of its clips under "segments".
+    sizes are the model's latent, clip and sync sequence lengths; gaps must be at least MMmodule.packing_gaps.
+    '''
+    def __init__(self, sizes=(194, 72, 216), gaps=(3, 1, 3), max_segments=4, stream_keys=None):
+        self.sizes = tuple(sizes)
+        self.gaps = tuple(gaps)
+        self.max_segments = max_segments
+        self.stream_keys = dict(STREAM_KEYS if stream_keys is None else stream_keys)
+
+    def item_lengths(self, sample):
+        latent, info = sample
+        lengths = {"latent": latent.shape[-1]}
+        for key, stream in self.stream_keys.items():
+            lengths[stream] = info[key].shape[0]
+        return tuple(lengths[stream] for stream in STREAMS)
+
+    def fits(self, row_lengths):
+        return all(packed_length(lengths, gap) <= size for lengths, gap, size in zip(zip(*row_lengths), self.gaps, self.sizes))
+
+    def pack_rows(self, lengths):
+        '''
+        Item indices of each row, first fit by decreasing latent length.
+        '''
+        rows = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i][0], reverse=True):
+            assert self.fits([lengths[i]]), f"A clip of {lengths[i]} tokens does not fit in a row of {self.sizes}"
+            for row in rows:
+                if len(row) < self.max_segments and self.fits([lengths[j] for j in row] + [lengths[i]]):
+                    row.append(i)
+                    break
+            else:
+                rows.append([i])
+        return rows
+
+    def _pack_stream(self, values, starts, stream):
+        # values: (n_i, ...) time-first tensors of the row's segments
+        size = self.sizes[STREAMS.index(stream)]
+        packed = values[0].new_zeros(size, *values[0].shape[1:])
+        for value, start in zip(values, starts):
+            packed[start:start + value.shape[0]] = value
+        return packed
+
+    def _stack_slots(self, values):
+        # Per segment features, zeros for the unused slots
+        stacked = values[0].new_zeros(self.max_segments, *values[0].shape)
+        stacked[:len(values)] = torch.stack(values)
+        return stacked
+
+    def _pack(self, values, starts, stream):
+        if isinstance(values[0], (list, tuple)):
+            return [self._pack([value[i] for value in values], starts, stream) for i in range(len(values[0]))]
+        if stream is not None:
+            return self._pack_stream(values, starts[stream], stream)
+        return self._stack_slots(values)
+
+    def __call__(self, samples):
+        lengths = [self.item_lengths(sample) for sample in samples]
+        latents = []
+        metadata = []
+        for row in self.pack_rows(lengths):
+            row_lengths = torch.zeros(self.max_segments, len(STREAMS), dtype=torch.long)
+            row_lengths[:len(row)] = torch.tensor([lengths[i] for i in row])
+            starts = {stream: segment_starts(row_lengths[:, s], self.gaps[s]).tolist() for s, stream in enumerate(STREAMS)}
+
+            latents.append(self._pack_stream([samples[i][0].transpose(0, 1) for i in row], starts["latent"], "latent").transpose(0, 1))
+
+            infos = [samples[i][1] for i in row]
+            info = {
+                PACKING_KEY: {"lengths": row_lengths, "sizes": self.sizes, "gaps": self.gaps},
+                "segments": [{key: value for key, value in item.items() if not isinstance(value, torch.Tensor) and key != STORE_KEY}
+                             for item in infos],
+            }
+            for key, value in infos[0].items():
+                if key in self.stream_keys:
+                    info[key] = self._pack([item[key] for item in infos], starts, self.stream_keys[key])
+                elif key == STORE_KEY:
+                    info[key] = {cond_id: self._pack([item[key][cond_id] for item in infos], starts, self.stream_keys.get(cond_id))
+                                 for cond_id in value}
+                elif isinstance(value, torch.Tensor) and all(item[key].shape == value.shape for item in infos):
+                    info[key] = self._stack_slots([item[key] for item in infos])
+            metadata.append(info)
+
+        return [torch.stack(latents), metadata]
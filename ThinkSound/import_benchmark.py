@@ -0,0 +1,109 @@
+import json
+import os
+import subprocess
+import sys
+
+# Import-time benchmark. ComfyUI imports every custom node package at start-up, so importing the node package
+# must not pull in torch extensions, model code or optional dependencies; those are imported on first use.
+# Each import is timed in a fresh interpreter so nothing is already cached in sys.modules.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NODE_PACKAGE = "<nodes>"
+
+DEFAULT_MODULES = (
+    NODE_PACKAGE,
+    "ThinkSound.models.mmdit",
+    "ThinkSound.models.autoencoders",
+    "ThinkSound.models.diffusion",
+    "ThinkSound.inference.sampling",
+)
+
+# Loads the repository root as a package the way ComfyUI loads custom nodes
+_LOAD_NODES = f'''
+import importlib.util
+spec = importlib.util.spec_from_file_location("thinksound_nodes", {os.path.join(ROOT, "__init__.py")!r}, submodule_search_locations=[{ROOT!r}])
+module = importlib.util.module_from_spec(spec)
+sys.modules["thinksound_nodes"] = module
+spec.loader.exec_module(module)
+'''
+
+def _import_code(module):
+    return _LOAD_NODES if module == NODE_PACKAGE else f"import {module}\n"
+
+def measure_import_time(module, preload=("torch",), top=10):
+    '''
+    Seconds to import module in a fresh interpreter, after importing preload (torch by default, since every
+    model module needs it and its cost is not ours to cut). Also returns the top slowest imports it triggered,
+    as (cumulative seconds, module name) from python -X importtime.
+    '''
+    code = "import sys, time\n"
+    code += "".join(f"import {name}\n" for name in preload)
+    code += "start = time.perf_counter()\n" + _import_code(module)
+    code += "print(time.perf_counter() - start)\n"
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    preloaded = set(preload)
+    imports = []
+    started = False
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        name = name.strip()
+        if not cumulative.strip().isdigit():
+            continue
+        # -X importtime lists a module after its dependencies, so everything after the preloads belongs to module
+        if started:
+            imports.append((int(cumulative) / 1e6, name))
+        elif name in preloaded:
+            preloaded.discard(name)
+            started = not preloaded
+
+    return float(result.stdout.strip().splitlines()[-1]), sorted(imports, reverse=True)[:top]
+
+def imported_modules(module, preload=("torch",)):
+    '''
+    Names in sys.modules after importing module in a fresh interpreter, after importing preload.
+    '''
+    code = "import json, sys\n"
+    code += "".join(f"import {name}\n" for name in preload)
+    code += _import_code(module)
+    code += "print(json.dumps(sorted(sys.modules)))\n"
+
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    return set(json.loads(result.stdout.strip().splitlines()[-1]))
+
+def benchmark_imports(modules=DEFAULT_MODULES, preload=("torch",), repeats=3, top=10):
+    '''
+    {module: (best seconds over repeats, slowest imports)} for each module.
+    '''
+    results = {}
+    for module in modules:
+        runs = [measure_import_time(module, preload=preload, top=top) for _ in range(repeats)]
+        results[module] = min(runs, key=lambda run: run[0])
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time importing the ComfyUI nodes and the ThinkSound modules in fresh interpreters")
+    parser.add_argument("modules", nargs="*", default=list(DEFAULT_MODULES), help=f"Modules to import; {NODE_PACKAGE} is the ComfyUI node package")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5, help="Show this many of the slowest imports per module")
+    parser.add_argument("--max-node-seconds", type=float, default=None, help="Exit with an error if the node package takes longer than this to import")
+    args = parser.parse_args()
+
+    results = benchmark_imports(args.modules, repeats=args.repeats, top=args.top)
+    for module, (seconds, slowest) in results.items():
+        print(f"{module}: {seconds * 1000:.1f} ms")
+        for cumulative, name in slowest:
+            print(f"    {cumulative * 1000:8.1f} ms  {name}")
+
+    if args.max_node_seconds is not None and NODE_PACKAGE in results and results[NODE_PACKAGE][0] > args.max_node_seconds:
+        sys.exit(f"Importing the node package took {results[NODE_PACKAGE][0]:.3f}s, more than {args.max_node_seconds}s")
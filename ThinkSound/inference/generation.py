@@ -1,3 +1,4 @@
+import contextlib
 import numpy as np
 import torch 
 import typing as tp
@@ -70,14 +71,22 @@ def generate_diffusion_cond(
     # ipdb.set_trace()
     # Conditioning
     assert conditioning is not None or conditioning_tensors is not None, "Must provide either conditioning or conditioning_tensors"
+    # With a ResidencyManager attached, each stage's weights are moved to the device just before it runs
+    residency = getattr(model, "residency", None)
+    def stage(*names):
+        return residency.use(*names) if residency is not None else contextlib.nullcontext()
+    conditioner_names = residency.names("conditioner.") if residency is not None else ()
+
     if conditioning_tensors is None:
-        conditioning_tensors = model.conditioner(conditioning, device)
+        with stage(*conditioner_names):
+            conditioning_tensors = model.conditioner(conditioning, device)
     conditioning_inputs = model.get_conditioning_inputs(conditioning_tensors)
 
     if negative_conditioning is not None or negative_conditioning_tensors is not None:
         
         if negative_conditioning_tensors is None:
-            negative_conditioning_tensors = model.conditioner(negative_conditioning, device)
+            with stage(*conditioner_names):
+                negative_conditioning_tensors = model.conditioner(negative_conditioning, device)
             
         negative_conditioning_tensors = model.get_conditioning_inputs(negative_conditioning_tensors, negative=True)
     else:
@@ -98,7 +107,8 @@ def generate_diffusion_cond(
 
         # For latent models, encode the initial audio into latents
         if model.pretransform is not None:
-            init_audio = model.pretransform.encode(init_audio)
+            with stage("pretransform"):
+                init_audio = model.pretransform.encode(init_audio)
 
         init_audio = init_audio.repeat(batch_size, 1, 1)
     else:
@@ -140,32 +150,36 @@ def generate_diffusion_cond(
     # Now the generative AI part:
     # k-diffusion denoising process go!
     diff_objective = model.diffusion_objective
-    if diff_objective == "v":    
-        # k-diffusion denoising process go!
-        # sampled = sample(model.model, noise, steps, 0, **conditioning_inputs)
-        sampled = sample_k(model.model, noise, init_audio, mask, steps, **sampler_kwargs, **conditioning_inputs, **negative_conditioning_tensors, cfg_scale=cfg_scale, batch_cfg=True, rescale_cfg=True, device=device)
-    elif diff_objective == "rectified_flow":
+    with stage("dit"):
+        if diff_objective == "v":    
+            # k-diffusion denoising process go!
+            # sampled = sample(model.model, noise, steps, 0, **conditioning_inputs)
+            sampled = sample_k(model.model, noise, init_audio, mask, steps, **sampler_kwargs, **conditioning_inputs, **negative_conditioning_tensors, cfg_scale=cfg_scale, batch_cfg=True, rescale_cfg=True, device=device)
+        elif diff_objective == "rectified_flow":
 
-        if "sigma_min" in sampler_kwargs:
-            del sampler_kwargs["sigma_min"]
+            if "sigma_min" in sampler_kwargs:
+                del sampler_kwargs["sigma_min"]
 
-        if "sampler_type" in sampler_kwargs:
-            del sampler_kwargs["sampler_type"]
+            if "sampler_type" in sampler_kwargs:
+                del sampler_kwargs["sampler_type"]
 
-        sampled = sample_rf(model.model, noise, init_data=init_audio, steps=steps, **sampler_kwargs, **conditioning_inputs, **negative_conditioning_tensors, cfg_scale=cfg_scale, batch_cfg=True, rescale_cfg=True, device=device)
+            sampled = sample_rf(model.model, noise, init_data=init_audio, steps=steps, **sampler_kwargs, **conditioning_inputs, **negative_conditioning_tensors, cfg_scale=cfg_scale, batch_cfg=True, rescale_cfg=True, device=device)
 
     # v-diffusion: 
     #sampled = sample(model.model, noise, steps, 0, **conditioning_tensors, embedding_scale=cfg_scale)
     del noise
     del conditioning_tensors
     del conditioning_inputs
-    torch.cuda.empty_cache()
+    if residency is None:
+        # The residency manager frees the cache itself when it offloads
+        torch.cuda.empty_cache()
     # Denoising process done. 
     # If this is latent diffusion, decode latents back into audio
     if model.pretransform is not None and not return_latents:
         #cast sampled latents to pretransform dtype
         sampled = sampled.to(next(model.pretransform.parameters()).dtype)
-        sampled = model.pretransform.decode(sampled)
+        with stage("pretransform"):
+            sampled = model.pretransform.decode(sampled)
 
     # Return audio
     return sampled
@@ -2,7 +2,6 @@ import torch
 import math
 from tqdm import trange, tqdm
 
-import k_diffusion as K
 
 # Define the noise schedule and sampling loop
 def get_alphas_sigmas(t):
@@ -95,6 +94,7 @@ def get_bmask(i, steps, mask):
 
 def make_cond_model_fn(model, cond_fn):
     def cond_model_fn(x, sigma, **kwargs):
+        import k_diffusion as K
         with torch.enable_grad():
             x = x.detach().requires_grad_()
             denoised = model(x, sigma, **kwargs)
@@ -122,6 +122,8 @@ def sample_k(
         cond_fn=None,
         **extra_args
     ):
+    # k-diffusion is only needed by the k samplers, so it is imported here rather than with the module
+    import k_diffusion as K
 
     denoiser = K.external.VDenoiser(model_fn)
 
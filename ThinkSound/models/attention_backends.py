@@ -0,0 +1,177 @@
+import logging
+import os
+import time
+from functools import lru_cache
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+
+# Attention backends take q, k, v as (B, H, N, D) and return (B, N, H * D).
+# Backends registered with masks=True also take an optional boolean (B, 1, Nq, Nk) mask of the keys each query
+# may attend to (e.g. for packed sequences); masked attention with any other backend runs on sdpa.
+# The backend is picked with set_attention_backend or the THINKSOUND_ATTENTION_BACKEND environment variable;
+# a backend whose dependencies are not installed falls back to sdpa.
+# "auto" benchmarks the available backends the first time it sees a (q_len, kv_len, head_dim, dtype, device)
+# and sticks with the fastest one.
+
+log = logging.getLogger()
+
+_backends = {}
+_supports = {}
+_available = {}
+_masked = set()
+_backend = "sdpa"
+_tuned = {}
+
+# Queries per block in the chunked backend
+chunk_size = int(os.environ.get("THINKSOUND_ATTENTION_CHUNK_SIZE", 256))
+
+def register_attention_backend(name, supports=None, masks=False, available=None):
+    '''
+    Register fn(q, k, v) as an attention backend, or fn(q, k, v, mask=None) if masks is True.
+    supports(q) tells "auto" whether the backend can run on tensors like q.
+    available() tells whether its dependencies are installed, checked when the backend is selected.
+    '''
+    def register(fn):
+        _backends[name] = fn
+        _supports[name] = supports if supports is not None else (lambda q: True)
+        _available[name] = available if available is not None else (lambda: True)
+        if masks:
+            _masked.add(name)
+        return fn
+    return register
+
+def set_attention_backend(name):
+    global _backend
+    assert name == "auto" or name in _backends, f"Unknown attention backend {name}, expected auto or one of {list(_backends)}"
+    if name != "auto" and not _available[name]():
+        log.warning(f"Attention backend {name} is not available, using sdpa")
+        name = "sdpa"
+    _backend = name
+
+def get_attention_backend():
+    return _backend
+
+def available_attention_backends(q):
+    return [name for name in _backends if _supports[name](q)]
+
+@register_attention_backend("sdpa", masks=True)
+def sdpa_attention(q, k, v, mask=None):
+    # training will crash without these contiguous calls and the CUDNN limitation
+    # I believe this is related to https://github.com/pytorch/pytorch/issues/133974
+    # unresolved at the time of writing
+    q = q.contiguous()
+    k = k.contiguous()
+    v = v.contiguous()
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    out = rearrange(out, 'b h n d -> b n (h d)').contiguous()
+    return out
+
+@lru_cache(maxsize=None)
+def _flash_attn_func():
+    try:
+        from flash_attn import flash_attn_func
+    except ImportError:
+        return None
+    return flash_attn_func
+
+def _flash_available():
+    return _flash_attn_func() is not None
+
+def _flash_supported(q):
+    return q.is_cuda and q.dtype in (torch.float16, torch.bfloat16) and q.shape[-1] <= 256 and _flash_available()
+
+@register_attention_backend("flash", supports=_flash_supported, available=_flash_available)
+def flash_attention(q, k, v):
+    fa_dtype_in = q.dtype
+    if fa_dtype_in not in (torch.float16, torch.bfloat16):
+        # flash-attn only runs in half precision
+        q, k, v = (t.to(torch.bfloat16) for t in (q, k, v))
+    q, k, v = map(lambda t: rearrange(t, 'b h n d -> b n h d'), (q, k, v))
+    out = _flash_attn_func()(q, k, v)
+    out = rearrange(out.to(fa_dtype_in), 'b n h d -> b n (h d)')
+    return out
+
+@register_attention_backend("chunked", supports=lambda q: not q.is_cuda, masks=True)
+def chunked_attention(q, k, v, mask=None):
+    # Memory-efficient attention: queries are processed in blocks of chunk_size,
+    # so only a chunk_size x kv_len score matrix is alive at a time
+    b, h, n, d = q.shape
+    k_t = k.transpose(-1, -2) * d**-0.5
+    out = q.new_empty((b, n, h, v.shape[-1]))
+    for i in range(0, n, chunk_size):
+        scores = torch.matmul(q[:, :, i:i+chunk_size], k_t)
+        if mask is not None:
+            scores = scores.masked_fill(~mask[:, :, i:i+chunk_size], float("-inf"))
+        attn = scores.softmax(dim=-1, dtype=torch.float32).to(v.dtype)
+        out[:, i:i+chunk_size] = torch.matmul(attn, v).transpose(1, 2)
+    return out.view(b, n, -1)
+
+@register_attention_backend("math", masks=True)
+def math_attention(q, k, v, mask=None):
+    # Reference implementation, computed in float32
+    scores = torch.matmul(q.float(), k.float().transpose(-1, -2)) * q.shape[-1]**-0.5
+    if mask is not None:
+        scores = scores.masked_fill(~mask, float("-inf"))
+    out = torch.matmul(scores.softmax(dim=-1), v.float()).to(q.dtype)
+    return rearrange(out, 'b h n d -> b n (h d)')
+
+set_attention_backend(os.environ.get("THINKSOUND_ATTENTION_BACKEND", "sdpa"))
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+@torch.no_grad()
+def benchmark_attention(batch_size, num_heads, q_len, kv_len, head_dim, dtype=torch.float32, device="cpu", repeats=5, backends=None):
+    '''
+    Time each available backend on random inputs of the given shape. Returns {backend: seconds per call}.
+    Backends that raise are left out.
+    '''
+    device = torch.device(device)
+    q = torch.randn(batch_size, num_heads, q_len, head_dim, dtype=dtype, device=device)
+    k = torch.randn(batch_size, num_heads, kv_len, head_dim, dtype=dtype, device=device)
+    v = torch.randn(batch_size, num_heads, kv_len, head_dim, dtype=dtype, device=device)
+
+    timings = {}
+    for name in backends or available_attention_backends(q):
+        fn = _backends[name]
+        try:
+            fn(q, k, v)
+        except RuntimeError:
+            continue
+        _sync(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn(q, k, v)
+        _sync(device)
+        timings[name] = (time.perf_counter() - start) / repeats
+    return timings
+
+def _tune_key(q, k):
+    return (q.shape[2], k.shape[2], q.shape[-1], q.dtype, q.device)
+
+def autotune_attention(q, k):
+    '''
+    Benchmark the backends on q/k-shaped inputs and remember the fastest for this (q_len, kv_len, head_dim, dtype, device).
+    Math is only a reference and never picked.
+    '''
+    key = _tune_key(q, k)
+    if key not in _tuned:
+        backends = [name for name in available_attention_backends(q) if name != "math"]
+        timings = benchmark_attention(q.shape[0], q.shape[1], q.shape[2], k.shape[2], q.shape[-1],
+                                      dtype=q.dtype, device=q.device, backends=backends)
+        _tuned[key] = min(timings, key=timings.get) if timings else "sdpa"
+    return _tuned[key]
+
+def attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: torch.Tensor = None):
+    backend = _backend
+    if mask is not None:
+        return _backends[backend if backend in _masked else "sdpa"](q, k, v, mask=mask)
+    if backend == "auto":
+        if torch.compiler.is_compiling():
+            backend = _tuned.get(_tune_key(q, k), "sdpa")
+        else:
+            backend = autotune_attention(q, k)
+    return _backends[backend](q, k, v)
@@ -1,3 +1,4 @@
+import contextlib
 import torch
 import math
 import numpy as np
@@ -11,11 +12,12 @@ from typing import Literal, Dict, Any
 
 from ..inference.sampling import sample
 from ..inference.utils import prepare_audio
-from .blocks import SnakeBeta
+from .blocks import SnakeBeta, fuse_snake_beta
 from .bottleneck import Bottleneck, DiscreteBottleneck
 from .diffusion import ConditionedDiffusionModel, DAU1DCondWrapper, UNet1DCondWrapper, DiTWrapper
 from .factory import create_pretransform_from_config, create_bottleneck_from_config
 from .pretransforms import Pretransform
+from .utils import remove_weight_norm_from_model
 
 def checkpoint(function, *args, **kwargs):
     kwargs.setdefault("use_reentrant", False)
@@ -127,6 +129,7 @@ class OobleckEncoder(nn.Module):
           
         c_mults = [1] + c_mults 
 
+        self.channels = channels
         self.depth = len(c_mults)
 
         layers = [
@@ -162,6 +165,7 @@ class OobleckDecoder(nn.Module):
 
         c_mults = [1] + c_mults
         
+        self.channels = channels
         self.depth = len(c_mults)
 
         layers = [
@@ -272,38 +276,47 @@ class AudioAutoencoder(nn.Module):
  
         self.is_discrete = self.bottleneck is not None and self.bottleneck.is_discrete
 
+    def inference_mode(self):
+        '''
+        Convert the autoencoder for inference only: fold weight norm into the conv weights
+        and replace SnakeBeta activations with FusedSnakeBeta.
+        Parameter names change, so load the checkpoint before calling this. Returns self.
+        '''
+        remove_weight_norm_from_model(self)
+        fuse_snake_beta(self)
+
+        return self.eval().requires_grad_(False)
+
+    def _iterate_batch_size(self, batch_size, samples_per_item, dtype, iterate_batch):
+        '''
+        Micro-batch size for iterate_batch, which may be
+        False (whole batch at once), True (one item at a time), an int micro-batch size,
+        or {"memory_mb": budget} to fit as many items per call as the activation memory budget allows.
+        '''
+        if iterate_batch is False or iterate_batch is None:
+            return batch_size
+        if iterate_batch is True:
+            return 1
+        if isinstance(iterate_batch, dict):
+            return self._micro_batch_size(batch_size, samples_per_item, dtype, memory_mb=iterate_batch["memory_mb"])
+        return max(1, int(iterate_batch))
+
+    def _map_batch(self, fn, x, micro_batch):
+        if micro_batch >= x.shape[0]:
+            return fn(x)
+        return torch.cat([fn(x[i:i+micro_batch]) for i in range(0, x.shape[0], micro_batch)], dim=0)
+
     def encode(self, audio, return_info=False, skip_pretransform=False, iterate_batch=False, **kwargs):
 
         info = {}
-        # import ipdb
-        # ipdb.set_trace()
+        micro_batch = self._iterate_batch_size(audio.shape[0], audio.shape[2], audio.dtype, iterate_batch)
+
         if self.pretransform is not None and not skip_pretransform:
-            if self.pretransform.enable_grad:
-                if iterate_batch:
-                    audios = []
-                    for i in range(audio.shape[0]):
-                        audios.append(self.pretransform.encode(audio[i:i+1]))
-                    audio = torch.cat(audios, dim=0)
-                else:
-                    audio = self.pretransform.encode(audio)
-            else:
-                with torch.no_grad():
-                    if iterate_batch:
-                        audios = []
-                        for i in range(audio.shape[0]):
-                            audios.append(self.pretransform.encode(audio[i:i+1]))
-                        audio = torch.cat(audios, dim=0)
-                    else:
-                        audio = self.pretransform.encode(audio)
+            with contextlib.nullcontext() if self.pretransform.enable_grad else torch.no_grad():
+                audio = self._map_batch(self.pretransform.encode, audio, micro_batch)
 
         if self.encoder is not None:
-            if iterate_batch:
-                latents = []
-                for i in range(audio.shape[0]):
-                    latents.append(self.encoder(audio[i:i+1]))
-                latents = torch.cat(latents, dim=0)
-            else:
-                latents = self.encoder(audio)
+            latents = self._map_batch(self.encoder, audio, micro_batch)
         else:
             latents = audio
 
@@ -320,41 +333,16 @@ class AudioAutoencoder(nn.Module):
 
     def decode(self, latents, iterate_batch=False, **kwargs):
 
+        micro_batch = self._iterate_batch_size(latents.shape[0], latents.shape[2] * self.downsampling_ratio, latents.dtype, iterate_batch)
+
         if self.bottleneck is not None:
-            if iterate_batch:
-                decoded = []
-                for i in range(latents.shape[0]):
-                    decoded.append(self.bottleneck.decode(latents[i:i+1]))
-                latents = torch.cat(decoded, dim=0)
-            else:
-                latents = self.bottleneck.decode(latents)
+            latents = self._map_batch(self.bottleneck.decode, latents, micro_batch)
 
-        if iterate_batch:
-            decoded = []
-            for i in range(latents.shape[0]):
-                decoded.append(self.decoder(latents[i:i+1]))
-            decoded = torch.cat(decoded, dim=0)
-        else:
-            decoded = self.decoder(latents, **kwargs)
+        decoded = self._map_batch(lambda x: self.decoder(x, **kwargs), latents, micro_batch)
 
         if self.pretransform is not None:
-            if self.pretransform.enable_grad:
-                if iterate_batch:
-                    decodeds = []
-                    for i in range(decoded.shape[0]):
-                        decodeds.append(self.pretransform.decode(decoded[i:i+1]))
-                    decoded = torch.cat(decodeds, dim=0)
-                else:
-                    decoded = self.pretransform.decode(decoded)
-            else:
-                with torch.no_grad():
-                    if iterate_batch:
-                        decodeds = []
-                        for i in range(latents.shape[0]):
-                            decodeds.append(self.pretransform.decode(decoded[i:i+1]))
-                        decoded = torch.cat(decodeds, dim=0)
-                    else:
-                        decoded = self.pretransform.decode(decoded)
+            with contextlib.nullcontext() if self.pretransform.enable_grad else torch.no_grad():
+                decoded = self._map_batch(self.pretransform.decode, decoded, micro_batch)
 
         if self.soft_clip:
             decoded = torch.tanh(decoded)
@@ -427,7 +415,66 @@ class AudioAutoencoder(nn.Module):
         # convert to tensor 
         return torch.stack(new_audio) 
 
-    def encode_audio(self, audio, chunked=False, overlap=32, chunk_size=128, **kwargs):
+    def _split_chunks(self, x, chunk_size, hop_size):
+        '''
+        Split (Batch x Channels x Length) into (Chunks x Batch x Channels x chunk_size) windows of hop_size.
+        The final chunk is aligned to the end of x, so it may have a longer overlap with its neighbour.
+        '''
+        total_size = x.shape[2]
+        chunks = x.unfold(2, chunk_size, hop_size).permute(2, 0, 1, 3)
+        if (chunks.shape[0] - 1) * hop_size + chunk_size != total_size:
+            # Final chunk
+            chunks = torch.cat([chunks, x[None, :, :, -chunk_size:]], dim=0)
+        return chunks
+
+    def _micro_batch_size(self, num_items, samples_per_item, dtype, max_items=None, memory_mb=None):
+        '''
+        Number of items (batch entries or chunks) to run through the model in one call.
+        max_items takes precedence, -1 meaning all items at once. Otherwise memory_mb bounds the estimated activation
+        memory of a micro-batch, assuming a few live full-rate activations of the widest full-rate layer; "auto" budgets
+        half of the free memory of the model's CUDA device. Without either, items are run one at a time.
+        '''
+        if max_items is not None:
+            return num_items if max_items == -1 else max(1, min(num_items, max_items))
+        if memory_mb == "auto":
+            device = next(self.parameters()).device
+            memory_mb = torch.cuda.mem_get_info(device)[0] / 2 / 2**20 if device.type == "cuda" else None
+        if memory_mb is None:
+            return 1
+        channels = max(getattr(self.encoder, "channels", 0), getattr(self.decoder, "channels", 0))
+        if channels == 0:
+            # Unknown activation width, keep to one item per call
+            return 1
+        bytes_per_item = 4 * samples_per_item * channels * torch.finfo(dtype).bits // 8
+        return max(1, min(num_items, int(memory_mb * 2**20) // bytes_per_item))
+
+    def _run_chunks(self, fn, chunks, micro_batch):
+        '''
+        Apply fn to (Chunks x Batch x Channels x Length) chunks, micro_batch chunks per call.
+        '''
+        num_chunks, batch_size = chunks.shape[:2]
+        flat = chunks.reshape(num_chunks * batch_size, *chunks.shape[2:])
+        y = self._map_batch(fn, flat, micro_batch * batch_size)
+        return y.reshape(num_chunks, batch_size, *y.shape[1:])
+
+    def _stitch_chunks(self, y_chunks, hop_size, ol, y_size):
+        '''
+        Assemble (Chunks x Batch x Channels x Length) outputs into (Batch x Channels x y_size), removing the edges of the overlaps.
+        Every chunk but the last contributes hop_size frames starting ol frames in; the last chunk always goes at the end.
+        '''
+        num_chunks, batch_size, channels, chunk_len = y_chunks.shape
+        if num_chunks == 1:
+            return y_chunks[0]
+        y_final = y_chunks.new_empty((batch_size, channels, y_size))
+        # no overlap for the start of the first chunk
+        y_final[:,:,:ol] = y_chunks[0,:,:,:ol]
+        body = y_chunks[:-1,:,:,ol:ol+hop_size].permute(1, 2, 0, 3).reshape(batch_size, channels, -1)
+        y_final[:,:,ol:ol+body.shape[2]] = body
+        # no overlap for the end of the last chunk
+        y_final[:,:,y_size-chunk_len+ol:] = y_chunks[-1,:,:,ol:]
+        return y_final
+
+    def encode_audio(self, audio, chunked=False, overlap=32, chunk_size=128, chunk_batch_size=None, chunk_memory_mb=None, **kwargs):
         '''
         Encode audios into latents. Audios should already be preprocesed by preprocess_audio_for_encoder.
         If chunked is True, split the audio into chunks of a given maximum size chunk_size, with given overlap.
@@ -435,135 +482,105 @@ class AudioAutoencoder(nn.Module):
         # and therefore you likely could use the same values with decode_audio. 
         A overlap of zero will cause discontinuity artefacts. Overlap should be => receptive field size. 
         Every autoencoder will have a different receptive field size, and thus ideal overlap.
-        You can determine it empirically by diffing unchunked vs chunked output and looking at maximum diff.
+        vae_chunking.receptive_field computes it for Oobleck autoencoders, and vae_chunking.tune_chunking benchmarks chunk_size on the host.
         The final chunk may have a longer overlap in order to keep chunk_size consistent for all chunks.
+        Chunks are encoded in micro-batches of chunk_batch_size chunks (-1 for all at once), or as many as fit in chunk_memory_mb
+        (a budget in MB, or "auto" for half the free GPU memory), and one at a time by default.
         Smaller chunk_size uses less memory, but more compute.
         The chunk_size vs memory tradeoff isn't linear, and possibly depends on the GPU and CUDA version
         For example, on a A6000 chunk_size 128 is overall faster than 256 and 512 even though it has more chunks
         '''
-        if not chunked:
+        # samples_per_latent is just the downsampling ratio (which is also the upsampling ratio)
+        samples_per_latent = self.downsampling_ratio
+        total_size = audio.shape[2] # in samples
+        if not chunked or total_size <= chunk_size * samples_per_latent:
             # default behavior. Encode the entire audio in parallel
             return self.encode(audio, **kwargs)
         else:
             # CHUNKED ENCODING
-            # samples_per_latent is just the downsampling ratio (which is also the upsampling ratio)
-            # import ipdb
-            # ipdb.set_trace()
-            samples_per_latent = self.downsampling_ratio
-            total_size = audio.shape[2] # in samples
-            print(f'audio shape: {audio.shape}')
-            batch_size = audio.shape[0]
-            chunk_size *= samples_per_latent # converting metric in latents to samples
-            overlap *= samples_per_latent # converting metric in latents to samples
             hop_size = chunk_size - overlap
-            chunks = []
-            for i in range(0, total_size - chunk_size + 1, hop_size):
-                chunk = audio[:,:,i:i+chunk_size]
-                chunks.append(chunk)
-            if i+chunk_size != total_size:
-                # Final chunk
-                chunk = audio[:,:,-chunk_size:]
-                chunks.append(chunk)
-            chunks = torch.stack(chunks)
-            num_chunks = chunks.shape[0]
+            chunks = self._split_chunks(audio, chunk_size * samples_per_latent, hop_size * samples_per_latent)
+            micro_batch = self._micro_batch_size(chunks.shape[0], audio.shape[0] * chunk_size * samples_per_latent, audio.dtype,
+                                                 max_items=chunk_batch_size, memory_mb=chunk_memory_mb)
+            y_chunks = self._run_chunks(self.encode, chunks, micro_batch)
             # Note: y_size might be a different value from the latent length used in diffusion training
             # because we can encode audio of varying lengths
             # However, the audio should've been padded to a multiple of samples_per_latent by now.
             y_size = total_size // samples_per_latent
-            # Create an empty latent, we will populate it with chunks as we encode them
-            y_final = torch.zeros((batch_size,self.latent_dim,y_size)).to(audio.device)
-            print(f'y_final shape: {y_final.shape}')
-            for i in range(num_chunks):
-                x_chunk = chunks[i,:]
-                # encode the chunk
-                y_chunk = self.encode(x_chunk)
-                print(f'y_chunk shape: {y_chunk.shape}')
-                # figure out where to put the audio along the time domain
-                if i == num_chunks-1:
-                    # final chunk always goes at the end
-                    t_end = y_size
-                    t_start = t_end - y_chunk.shape[2]
-                else:
-                    t_start = i * hop_size // samples_per_latent
-                    t_end = t_start + chunk_size // samples_per_latent
-                #  remove the edges of the overlaps
-                ol = overlap//samples_per_latent//2
-                chunk_start = 0
-                chunk_end = y_chunk.shape[2]
-                if i > 0:
-                    # no overlap for the start of the first chunk
-                    t_start += ol
-                    chunk_start += ol
-                if i < num_chunks-1:
-                    # no overlap for the end of the last chunk
-                    t_end -= ol
-                    chunk_end -= ol
-                # paste the chunked audio into our y_final output audio
-                y_final[:,:,t_start:t_end] = y_chunk[:,:,chunk_start:chunk_end]
-            return y_final
+            return self._stitch_chunks(y_chunks, hop_size, overlap // 2, y_size)
     
-    def decode_audio(self, latents, chunked=False, overlap=32, chunk_size=128, **kwargs):
+    def decode_audio(self, latents, chunked=False, overlap=32, chunk_size=128, chunk_batch_size=None, chunk_memory_mb=None, **kwargs):
         '''
         Decode latents to audio. 
         If chunked is True, split the latents into chunks of a given maximum size chunk_size, with given overlap, both of which are measured in number of latents. 
         A overlap of zero will cause discontinuity artefacts. Overlap should be => receptive field size. 
         Every autoencoder will have a different receptive field size, and thus ideal overlap.
-        You can determine it empirically by diffing unchunked vs chunked audio and looking at maximum diff.
+        vae_chunking.receptive_field computes it for Oobleck autoencoders, and vae_chunking.tune_chunking benchmarks chunk_size on the host.
         The final chunk may have a longer overlap in order to keep chunk_size consistent for all chunks.
+        Chunks are decoded in micro-batches of chunk_batch_size chunks (-1 for all at once), or as many as fit in chunk_memory_mb
+        (a budget in MB, or "auto" for half the free GPU memory), and one at a time by default.
         Smaller chunk_size uses less memory, but more compute.
         The chunk_size vs memory tradeoff isn't linear, and possibly depends on the GPU and CUDA version
         For example, on a A6000 chunk_size 128 is overall faster than 256 and 512 even though it has more chunks
         '''
-        if not chunked:
+        total_size = latents.shape[2]
+        if not chunked or total_size <= chunk_size:
             # default behavior. Decode the entire latent in parallel
             return self.decode(latents, **kwargs)
         else:
             # chunked decoding
-            hop_size = chunk_size - overlap
-            total_size = latents.shape[2]
-            batch_size = latents.shape[0]
-            chunks = []
-            for i in range(0, total_size - chunk_size + 1, hop_size):
-                chunk = latents[:,:,i:i+chunk_size]
-                chunks.append(chunk)
-            if i+chunk_size != total_size:
-                # Final chunk
-                chunk = latents[:,:,-chunk_size:]
-                chunks.append(chunk)
-            chunks = torch.stack(chunks)
-            num_chunks = chunks.shape[0]
             # samples_per_latent is just the downsampling ratio
             samples_per_latent = self.downsampling_ratio
-            # Create an empty waveform, we will populate it with chunks as decode them
+            hop_size = chunk_size - overlap
+            chunks = self._split_chunks(latents, chunk_size, hop_size)
+            micro_batch = self._micro_batch_size(chunks.shape[0], latents.shape[0] * chunk_size * samples_per_latent, latents.dtype,
+                                                 max_items=chunk_batch_size, memory_mb=chunk_memory_mb)
+            y_chunks = self._run_chunks(self.decode, chunks, micro_batch)
             y_size = total_size * samples_per_latent
-            y_final = torch.zeros((batch_size,self.out_channels,y_size)).to(latents.device)
-            for i in range(num_chunks):
-                x_chunk = chunks[i,:]
-                # decode the chunk
-                y_chunk = self.decode(x_chunk)
-                # figure out where to put the audio along the time domain
-                if i == num_chunks-1:
-                    # final chunk always goes at the end
-                    t_end = y_size
-                    t_start = t_end - y_chunk.shape[2]
-                else:
-                    t_start = i * hop_size * samples_per_latent
-                    t_end = t_start + chunk_size * samples_per_latent
-                #  remove the edges of the overlaps
-                ol = (overlap//2) * samples_per_latent
-                chunk_start = 0
-                chunk_end = y_chunk.shape[2]
-                if i > 0:
-                    # no overlap for the start of the first chunk
-                    t_start += ol
-                    chunk_start += ol
-                if i < num_chunks-1:
-                    # no overlap for the end of the last chunk
-                    t_end -= ol
-                    chunk_end -= ol
-                # paste the chunked audio into our y_final output audio
-                y_final[:,:,t_start:t_end] = y_chunk[:,:,chunk_start:chunk_end]
-            return y_final
+            return self._stitch_chunks(y_chunks, hop_size * samples_per_latent, (overlap//2) * samples_per_latent, y_size)
+
+    def decode_audio_stream(self, latents, overlap=32, chunk_size=128, crossfade=None, **kwargs):
+        '''
+        Decode latents to audio chunk by chunk, yielding (Batch x Channels x Length) segments as soon as they are final.
+        Concatenating the yielded segments along time gives the full waveform.
+        overlap and chunk_size are measured in latents, as in decode_audio, and the seams sit at the same positions.
+        Each seam is blended with a linear crossfade of crossfade latents (overlap//2 by default),
+        clamped so it stays inside the overlap. A crossfade of zero reproduces decode_audio(chunked=True) exactly.
+        '''
+        total_size = latents.shape[2]
+        if total_size <= chunk_size:
+            yield self.decode(latents, **kwargs)
+            return
+
+        samples_per_latent = self.downsampling_ratio
+        hop_size = chunk_size - overlap
+        chunks = self._split_chunks(latents, chunk_size, hop_size)
+        num_chunks = chunks.shape[0]
+        # the final chunk always goes at the end
+        starts = [i * hop_size * samples_per_latent for i in range(num_chunks - 1)] + [(total_size - chunk_size) * samples_per_latent]
+        ol = (overlap//2) * samples_per_latent
+        if crossfade is None:
+            crossfade = overlap//2
+        half_fade = min(crossfade * samples_per_latent // 2, ol, hop_size * samples_per_latent // 2)
+        # seams[i] is where chunk i takes over from chunk i-1
+        seams = [0] + [start + ol for start in starts[1:]]
+        if num_chunks > 2:
+            # the final chunk can start closer than one crossfade after the previous seam
+            seams[-1] = max(seams[-1], seams[-2] + 2 * half_fade)
+        seams.append(total_size * samples_per_latent + half_fade)
+        if half_fade > 0:
+            fade_in = (torch.arange(2 * half_fade, device=latents.device) + 0.5) / (2 * half_fade)
+
+        y_prev = None
+        for i in range(num_chunks):
+            y_chunk = self.decode(chunks[i], **kwargs)
+            start = starts[i]
+            if y_prev is not None and half_fade > 0:
+                a = y_prev[:,:,seams[i]-half_fade-starts[i-1]:seams[i]+half_fade-starts[i-1]]
+                b = y_chunk[:,:,seams[i]-half_fade-start:seams[i]+half_fade-start]
+                yield a + (b - a) * fade_in.to(b.dtype)
+            yield y_chunk[:,:,seams[i]+(half_fade if i > 0 else 0)-start:seams[i+1]-half_fade-start]
+            y_prev = y_chunk
 
     
 class DiffusionAutoencoder(AudioAutoencoder):
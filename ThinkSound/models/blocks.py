@@ -1,4 +1,4 @@
-from functools import reduce
+from functools import reduce, wraps
 import math
 import numpy as np
 import torch
@@ -8,7 +8,7 @@ from torch.nn import functional as F
 from torch.backends.cuda import sdp_kernel
 from packaging import version
 
-from dac.nn.layers import Snake1d
+from .packing import mask_tokens
 
 class ResidualBlock(nn.Module):
     def __init__(self, main, skip=None):
@@ -22,6 +22,9 @@ class ResidualBlock(nn.Module):
 class ResConvBlock(ResidualBlock):
     def __init__(self, c_in, c_mid, c_out, is_last=False, kernel_size=5, conv_bias=True, use_snake=False):
         skip = None if c_in == c_out else nn.Conv1d(c_in, c_out, 1, bias=False)
+        if use_snake:
+            # dac pulls in audiotools, so only import it when a block needs it
+            from dac.nn.layers import Snake1d
         super().__init__([
             nn.Conv1d(c_in, c_mid, kernel_size, padding=kernel_size//2, bias=conv_bias),
             nn.GroupNorm(1, c_mid),
@@ -247,12 +250,29 @@ class ForcedWNConv1d(nn.Module):
 use_compile = True
 
 def compile(function, *args, **kwargs):
+    '''
+    torch.compile(function) on its first call. Compiling at decoration time would import inductor
+    (seconds) whenever this module is imported.
+    '''
     if not use_compile:
         return function
-    try:
-        return torch.compile(function, *args, **kwargs)
-    except RuntimeError:
-        return function
+
+    compiled = None
+
+    @wraps(function)
+    def lazy_compiled(*call_args, **call_kwargs):
+        nonlocal compiled
+        if torch.compiler.is_compiling():
+            # Already inside a compiled region, which traces function itself
+            return function(*call_args, **call_kwargs)
+        if compiled is None:
+            try:
+                compiled = torch.compile(function, *args, **kwargs)
+            except RuntimeError:
+                compiled = function
+        return compiled(*call_args, **call_kwargs)
+
+    return lazy_compiled
 
 
 @compile
@@ -338,13 +358,80 @@ class SnakeBeta(nn.Module):
 
         return x
 
+class FusedSnakeBeta(nn.Module):
+    '''
+    Inference-only SnakeBeta with exp(alpha) and 1/(exp(beta)+eps) precomputed as buffers
+    and the activation evaluated in place on a single temporary.
+    '''
+
+    def __init__(self, snake: SnakeBeta):
+        super().__init__()
+        self.in_features = snake.in_features
+
+        with torch.no_grad():
+            alpha = snake.alpha.detach()
+            beta = snake.beta.detach()
+            if snake.alpha_logscale:
+                alpha = torch.exp(alpha)
+                beta = torch.exp(beta)
+            self.register_buffer("alpha", alpha[None, :, None].clone())
+            self.register_buffer("inv_beta", 1.0 / (beta[None, :, None] + snake.no_div_by_zero))
+
+    def forward(self, x):
+        y = x * self.alpha
+        return y.sin_().square_().mul_(self.inv_beta).add_(x)
+
+def fuse_snake_beta(model):
+    # Replaces every SnakeBeta in model with a FusedSnakeBeta, in place
+    for name, child in model.named_children():
+        if isinstance(child, SnakeBeta):
+            setattr(model, name, FusedSnakeBeta(child))
+        else:
+            fuse_snake_beta(child)
+
+    return model
+
+def channel_last_unfold(x: torch.Tensor, kernel_size: int, stride: int = 1, padding: int = 0, dilation: int = 1) -> torch.Tensor:
+    '''
+    (B, N, C) -> (B, N_out, C * kernel_size) conv windows (im2col), so a conv with an (out, C, kernel_size) weight
+    is F.linear against the weight flattened to (out, C * kernel_size).
+    '''
+    if kernel_size == 1 and padding == 0:
+        return x[:, ::stride]
+
+    if padding > 0:
+        x = F.pad(x, (0, 0, padding, padding))
+    # (B, N_out, C, window) view
+    windows = x.unfold(1, dilation * (kernel_size - 1) + 1, stride)
+    if dilation > 1:
+        windows = windows[..., ::dilation]
+    return windows.flatten(-2)
+
+
 class ChannelLastConv1d(nn.Conv1d):
+    '''
+    Conv1d on (B, N, C) inputs.
+    Computed as one matmul over unfolded windows (im2col), so the input and output stay channels-last
+    instead of being permuted to (B, C, N) and back; the (out, in, k) conv weight already is the
+    (out, in * k) matrix this needs.
+    '''
+
+    @property
+    def unfold_args(self):
+        # channel_last_unfold arguments, or None if this conv can't be computed as a matmul
+        if self.groups != 1 or self.padding_mode != 'zeros' or isinstance(self.padding, str):
+            return None
+        return self.kernel_size[0], self.stride[0], self.padding[0], self.dilation[0]
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x.permute(0, 2, 1)
-        x = super().forward(x)
-        x = x.permute(0, 2, 1)
-        return x
+        unfold_args = self.unfold_args
+        if unfold_args is None:
+            x = x.permute(0, 2, 1)
+            x = super().forward(x)
+            x = x.permute(0, 2, 1)
+            return x
+
+        return F.linear(channel_last_unfold(x, *unfold_args), self.weight.flatten(1), self.bias)
 
 
 # https://github.com/Stability-AI/sd3-ref
@@ -378,7 +465,8 @@ class MLP(nn.Module):
         self.w2 = nn.Linear(hidden_dim, dim, bias=False)
         self.w3 = nn.Linear(dim, hidden_dim, bias=False)
 
-    def forward(self, x):
+    def forward(self, x, keep=None):
+        # keep is accepted for symmetry with ConvMLP; tokens are independent here
         return self.w2(F.silu(self.w1(x)) * self.w3(x))
 
 
@@ -426,5 +514,10 @@ class ConvMLP(nn.Module):
                                     kernel_size=kernel_size,
                                     padding=padding)
 
-    def forward(self, x):
-        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+    def forward(self, x, keep=None):
+        # keep: optional (B, N, 1) mask of the tokens of a packed sequence that belong to a segment,
+        # the others are zeroed before each conv
+        if keep is None:
+            return self.w2(F.silu(self.w1(x)) * self.w3(x))
+        x = mask_tokens(x, keep)
+        return self.w2(mask_tokens(F.silu(self.w1(x)) * self.w3(x), keep))
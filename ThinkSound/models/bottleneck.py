@@ -4,8 +4,6 @@ from torch import nn
 from torch.nn import functional as F
 
 from einops import rearrange
-from vector_quantize_pytorch import ResidualVQ, FSQ
-from dac.nn.quantize import ResidualVectorQuantize as DACResidualVQ
 
 class Bottleneck(nn.Module):
     def __init__(self, is_discrete: bool = False):
@@ -146,6 +144,7 @@ class L2Bottleneck(Bottleneck):
 class RVQBottleneck(DiscreteBottleneck):
     def __init__(self, **quantizer_kwargs):
         super().__init__(num_quantizers = quantizer_kwargs["num_quantizers"], codebook_size = quantizer_kwargs["codebook_size"], tokens_id = "quantizer_indices")
+        from vector_quantize_pytorch import ResidualVQ
         self.quantizer = ResidualVQ(**quantizer_kwargs)
         self.num_quantizers = quantizer_kwargs["num_quantizers"]
 
@@ -175,6 +174,7 @@ class RVQBottleneck(DiscreteBottleneck):
 class RVQVAEBottleneck(DiscreteBottleneck):
     def __init__(self, **quantizer_kwargs):
         super().__init__(num_quantizers = quantizer_kwargs["num_quantizers"], codebook_size = quantizer_kwargs["codebook_size"], tokens_id = "quantizer_indices")
+        from vector_quantize_pytorch import ResidualVQ
         self.quantizer = ResidualVQ(**quantizer_kwargs)
         self.num_quantizers = quantizer_kwargs["num_quantizers"]
 
@@ -208,6 +208,7 @@ class RVQVAEBottleneck(DiscreteBottleneck):
 class DACRVQBottleneck(DiscreteBottleneck):
     def __init__(self, quantize_on_decode=False, noise_augment_dim=0, **quantizer_kwargs):
         super().__init__(num_quantizers = quantizer_kwargs["n_codebooks"], codebook_size = quantizer_kwargs["codebook_size"], tokens_id = "codes")
+        from dac.nn.quantize import ResidualVectorQuantize as DACResidualVQ
         self.quantizer = DACResidualVQ(**quantizer_kwargs)
         self.num_quantizers = quantizer_kwargs["n_codebooks"]
         self.quantize_on_decode = quantize_on_decode
@@ -261,6 +262,7 @@ class DACRVQBottleneck(DiscreteBottleneck):
 class DACRVQVAEBottleneck(DiscreteBottleneck):
     def __init__(self, quantize_on_decode=False, **quantizer_kwargs):
         super().__init__(num_quantizers = quantizer_kwargs["n_codebooks"], codebook_size = quantizer_kwargs["codebook_size"], tokens_id = "codes")
+        from dac.nn.quantize import ResidualVectorQuantize as DACResidualVQ
         self.quantizer = DACResidualVQ(**quantizer_kwargs)
         self.num_quantizers = quantizer_kwargs["n_codebooks"]
         self.quantize_on_decode = quantize_on_decode
@@ -316,6 +318,7 @@ class FSQBottleneck(DiscreteBottleneck):
 
         self.noise_augment_dim = noise_augment_dim
 
+        from vector_quantize_pytorch import FSQ
         self.quantizer = FSQ(**kwargs, allowed_dtypes=[torch.float16, torch.float32, torch.float64])
 
     def encode(self, x, return_info=False):
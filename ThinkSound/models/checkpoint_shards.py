@@ -0,0 +1,123 @@
+import json
+import os
+
+import torch
+
+from .utils import LazyCheckpoint
+
+# Splits a ThinkSound checkpoint into per-component safetensors shards plus a manifest.json.
+# Shards keep the key names of an exported diffusion model ("model.model.*", "pretransform.model.*", ...),
+# so any set of them loads like the original checkpoint, and LazyCheckpoint reads the manifest as one checkpoint
+# (e.g. MMmodule.from_checkpoint("shards/manifest.json") only reads the MMDiT and empty-feature shards).
+
+# component: key prefix, checked in order
+COMPONENTS = {
+    "empty_features": "model.model.empty_",
+    "mmdit": "model.model.",
+    "vae_encoder": "pretransform.model.encoder.",
+    "vae_decoder": "pretransform.model.decoder.",
+    "vae_bottleneck": "pretransform.model.bottleneck.",
+    "conditioner": "conditioner.",
+}
+
+_DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+def _root_prefix(keys):
+    # Training checkpoints hold the diffusion model under "diffusion." (and an EMA copy of its inner model
+    # under "diffusion_ema.ema_model."), exported ones hold it at the top level
+    if any(k.startswith("diffusion.") for k in keys):
+        return "diffusion."
+    return ""
+
+def _component(key):
+    for name, prefix in COMPONENTS.items():
+        if key.startswith(prefix):
+            return name
+    return None
+
+def split_checkpoint(ckpt_path, output_dir, dtype="bfloat16", components=None, ema=False, include_other=False):
+    '''
+    Write <output_dir>/<component>.safetensors for each component of the checkpoint and <output_dir>/manifest.json.
+    Floating point tensors are stored in dtype. components limits which shards are written (all found by default).
+    With ema, MMDiT weights come from the EMA copy of a training checkpoint.
+    Keys outside the known components (losses, EMA copies, ...) go to an "other" shard if include_other is set,
+    and are dropped otherwise.
+    '''
+    storage_dtype = _DTYPES[dtype]
+    checkpoint = LazyCheckpoint(ckpt_path)
+    root = _root_prefix(checkpoint.keys())
+
+    # output key -> source key
+    sources = {}
+    for key in checkpoint.keys():
+        if key.startswith(root):
+            sources.setdefault(key[len(root):], key)
+        elif include_other:
+            sources.setdefault(key, key)
+    if ema:
+        assert any(k.startswith("diffusion_ema.ema_model.") for k in checkpoint.keys()), "Checkpoint has no EMA weights"
+        for key in checkpoint.keys():
+            if key.startswith("diffusion_ema.ema_model."):
+                sources["model." + key[len("diffusion_ema.ema_model."):]] = key
+
+    shards = {}
+    for key, source_key in sources.items():
+        name = _component(key)
+        if name is None:
+            if not include_other:
+                continue
+            name = "other"
+        if components is not None and name not in components:
+            continue
+        shards.setdefault(name, {})[key] = source_key
+
+    os.makedirs(output_dir, exist_ok=True)
+    from safetensors.torch import save_file
+
+    manifest = {
+        "source": os.path.basename(ckpt_path),
+        "dtype": dtype,
+        "ema": ema,
+        "components": {},
+    }
+    for name, keys in shards.items():
+        tensors = {}
+        for key, source_key in keys.items():
+            tensor = checkpoint[source_key]
+            if tensor.is_floating_point():
+                tensor = tensor.to(storage_dtype)
+            tensors[key] = tensor.contiguous()
+
+        filename = f"{name}.safetensors"
+        save_file(tensors, os.path.join(output_dir, filename), metadata={"component": name, "dtype": dtype})
+        manifest["components"][name] = {
+            "file": filename,
+            "num_tensors": len(tensors),
+            "num_bytes": sum(t.numel() * t.element_size() for t in tensors.values()),
+        }
+        del tensors
+
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Split a ThinkSound checkpoint into per-component safetensors shards with a manifest")
+    parser.add_argument("--ckpt-path", required=True, help="Exported or training checkpoint (.ckpt or .safetensors)")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--dtype", default="bfloat16", choices=list(_DTYPES))
+    parser.add_argument("--components", nargs="+", default=None, choices=list(COMPONENTS) + ["other"],
+                        help="Only write these shards, e.g. mmdit empty_features vae_decoder for inference")
+    parser.add_argument("--ema", action="store_true", help="Take MMDiT weights from the EMA copy of a training checkpoint")
+    parser.add_argument("--include-other", action="store_true", help="Keep tensors outside the known components in an 'other' shard")
+    args = parser.parse_args()
+
+    manifest = split_checkpoint(args.ckpt_path, args.output_dir, dtype=args.dtype, components=args.components,
+                                ema=args.ema, include_other=args.include_other)
+    for name, component in manifest["components"].items():
+        print(f"{name}: {component['num_tensors']} tensors, {component['num_bytes'] / 2**20:.1f} MiB")
@@ -0,0 +1,211 @@
+import logging
+import time
+
+import torch
+
+# Activation checkpointing for the MMmodule joint and fused blocks. A checkpointed block keeps only its inputs during
+# the forward pass and recomputes its activations in the backward pass, trading compute for memory.
+# Blocks are numbered joint blocks first, then fused blocks; MMmodule.checkpoint_blocks holds the checkpointed ones.
+
+log = logging.getLogger()
+
+POLICIES = ("none", "all", "every_k", "budget")
+
+def checkpoint(function, *args, **kwargs):
+    kwargs.setdefault("use_reentrant", False)
+    return torch.utils.checkpoint.checkpoint(function, *args, **kwargs)
+
+def model_blocks(model):
+    return list(model.joint_blocks) + list(model.fused_blocks)
+
+def _tensor_bytes(values):
+    return sum(v.numel() * v.element_size() for v in values if isinstance(v, torch.Tensor))
+
+def measure_block_activations(model, batch_size=1):
+    '''
+    (saved bytes, input bytes) of each block for one training forward pass at batch_size, without checkpointing.
+    Saved bytes are the activations autograd keeps for the backward pass, not counting parameters;
+    input bytes are what a checkpointed block keeps instead. Runs under the caller's autocast.
+    '''
+    from .mmdit import sample_inputs
+
+    blocks = model_blocks(model)
+    saved = [0] * len(blocks)
+    inputs = [0] * len(blocks)
+    seen = [set() for _ in blocks]
+    parameters = {p.data_ptr() for p in model.parameters()}
+    current = None
+
+    def pre_hook(index):
+        def hook(module, args, kwargs):
+            nonlocal current
+            current = index
+            inputs[index] = _tensor_bytes(args) + _tensor_bytes(kwargs.values())
+        return hook
+
+    def post_hook(module, args, output):
+        nonlocal current
+        current = None
+
+    def pack(tensor):
+        if current is not None:
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in parameters and storage.data_ptr() not in seen[current]:
+                seen[current].add(storage.data_ptr())
+                saved[current] += storage.nbytes()
+        return tensor
+
+    handles = [block.register_forward_pre_hook(pre_hook(i), with_kwargs=True) for i, block in enumerate(blocks)]
+    handles += [block.register_forward_hook(post_hook) for block in blocks]
+    checkpoint_blocks = model.checkpoint_blocks
+    model.checkpoint_blocks = frozenset()
+    generator = torch.Generator().manual_seed(0)
+    try:
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            model(**sample_inputs(model, batch_size, generator=generator), cfg_scale=1.0, cfg_dropout_prob=0.0, scale_phi=0.0)
+    finally:
+        model.checkpoint_blocks = checkpoint_blocks
+        for handle in handles:
+            handle.remove()
+    return list(zip(saved, inputs))
+
+def select_checkpoint_blocks(model, policy="none", every=2, memory_budget=None, batch_size=1):
+    '''
+    Indices of the blocks to checkpoint under policy:
+    "none", "all", "every_k" (every block whose index is a multiple of every) or
+    "budget" (as few blocks as needed to keep the block activations of a batch_size batch within memory_budget bytes).
+    '''
+    assert policy in POLICIES, f"Unknown checkpointing policy {policy}, expected one of {POLICIES}"
+    num_blocks = len(model_blocks(model))
+    if policy == "none":
+        return frozenset()
+    if policy == "all":
+        return frozenset(range(num_blocks))
+    if policy == "every_k":
+        assert every >= 1, "every must be at least 1"
+        return frozenset(range(0, num_blocks, every))
+
+    assert memory_budget is not None, "The budget policy needs a memory_budget"
+    # Measured at batch size 1 and scaled, so measuring does not need the memory it is trying to save
+    activations = [(saved * batch_size, kept * batch_size) for saved, kept in measure_block_activations(model, 1)]
+    total = sum(saved for saved, _ in activations)
+    # Checkpoint the blocks that save the most first
+    order = sorted(range(num_blocks), key=lambda i: activations[i][1] - activations[i][0])
+    selected = set()
+    for i in order:
+        if total <= memory_budget:
+            break
+        saved, kept = activations[i]
+        if kept >= saved:
+            break
+        selected.add(i)
+        total -= saved - kept
+    if total > memory_budget:
+        log.warning(f"Block activations need {total / 2**30:.2f} GiB even with every block checkpointed, more than the {memory_budget / 2**30:.2f} GiB budget")
+    log.info(f"Checkpointing {len(selected)} of {num_blocks} MMmodule blocks, {total / 2**30:.2f} GiB of block activations at batch size {batch_size}")
+    return frozenset(selected)
+
+def set_activation_checkpointing(model, policy="none", every=2, memory_budget_gb=None):
+    '''
+    Set the checkpointing policy of an MMmodule. The budget policy depends on the batch size, sequence lengths,
+    device and autocast dtype, so it is resolved on the first training forward pass.
+    '''
+    assert policy in POLICIES, f"Unknown checkpointing policy {policy}, expected one of {POLICIES}"
+    if policy == "budget":
+        assert memory_budget_gb is not None, "The budget policy needs memory_budget_gb"
+        model.checkpoint_budget = int(memory_budget_gb * 2**30)
+        model.checkpoint_blocks = None
+    else:
+        model.checkpoint_budget = None
+        model.checkpoint_blocks = select_checkpoint_blocks(model, policy, every=every)
+    return model
+
+def benchmark_checkpointing(model, policies=None, batch_size=1, repeats=3, dtype=None):
+    '''
+    {policy name: (peak memory bytes, seconds per training step)} for a forward and backward pass of model
+    under each policy, given as {name: set_activation_checkpointing kwargs}. On CUDA the peak is the allocator's
+    peak; elsewhere it is the peak of the activations held for the backward pass.
+    '''
+    from .mmdit import sample_inputs
+
+    if policies is None:
+        policies = {"none": {"policy": "none"}, "every_2": {"policy": "every_k", "every": 2}, "all": {"policy": "all"}}
+    device = model.device
+    autocast = torch.autocast(device_type=device.type, dtype=dtype, enabled=dtype is not None)
+    generator = torch.Generator().manual_seed(0)
+    inputs = sample_inputs(model, batch_size, generator=generator)
+    previous = (model.checkpoint_blocks, model.checkpoint_budget)
+    model.train()
+
+    held = peak = 0
+    seen = {p.data_ptr() for p in model.parameters()}
+
+    def pack(tensor):
+        nonlocal held, peak, seen
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            held += storage.nbytes()
+            peak = max(peak, held)
+        return tensor
+
+    def unpack(tensor):
+        return tensor
+
+    results = {}
+    try:
+        for name, kwargs in policies.items():
+            set_activation_checkpointing(model, **kwargs)
+            timings = []
+            for i in range(repeats + 1):
+                model.zero_grad(set_to_none=True)
+                held = peak = 0
+                seen = {p.data_ptr() for p in model.parameters()}
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats(device)
+                start = time.perf_counter()
+                with autocast, torch.autograd.graph.saved_tensors_hooks(pack, unpack):
+                    output = model(**inputs, cfg_scale=1.0, cfg_dropout_prob=0.0, scale_phi=0.0)
+                output.float().square().mean().backward()
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                # The first step resolves budget policies and warms up kernels
+                if i > 0:
+                    timings.append(time.perf_counter() - start)
+            peak_bytes = torch.cuda.max_memory_allocated(device) if device.type == "cuda" else peak
+            results[name] = (peak_bytes, min(timings))
+    finally:
+        model.checkpoint_blocks, model.checkpoint_budget = previous
+        model.zero_grad(set_to_none=True)
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from .factory import create_model_from_config
+
+    parser = argparse.ArgumentParser(description="Peak memory and step time of MMmodule training under each activation checkpointing policy")
+    parser.add_argument("--model-config", required=True)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--every", type=int, nargs="*", default=[2, 3], help="every_k policies to compare")
+    parser.add_argument("--budget-gb", type=float, nargs="*", default=[], help="budget policies to compare")
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument("--device", default="cuda")
+    args = parser.parse_args()
+
+    with open(args.model_config) as f:
+        model_config = json.load(f)
+    model = create_model_from_config(model_config).model.model.to(args.device)
+
+    policies = {"none": {"policy": "none"}}
+    policies.update({f"every_{k}": {"policy": "every_k", "every": k} for k in args.every})
+    policies.update({f"budget_{gb:g}GiB": {"policy": "budget", "memory_budget_gb": gb} for gb in args.budget_gb})
+    policies["all"] = {"policy": "all"}
+
+    results = benchmark_checkpointing(model, policies, batch_size=args.batch_size, repeats=args.repeats,
+                                      dtype=torch.bfloat16 if args.bf16 else None)
+    for name, (peak_bytes, seconds) in results.items():
+        print(f"{name:>16}: peak {peak_bytes / 2**20:9.1f} MiB, {seconds * 1000:8.1f} ms/step")
@@ -0,0 +1,144 @@
+import functools
+import logging
+import math
+import os
+import time
+
+import torch
+
+from . import blocks
+
+# Opt-in torch.compile for inference: MMmodule.predict_flow and the Oobleck decoder are compiled with static shapes,
+# one graph per duration bucket, compiled up front by warmup() and cached on disk so restarts are warm.
+# Anything that fails to compile runs eagerly instead.
+
+log = logging.getLogger()
+
+def enable_compile_cache(cache_dir=None):
+    '''
+    Keep inductor's compiled kernels and FX graphs in cache_dir across runs,
+    by default $THINKSOUND_CACHE_DIR/inductor or ~/.cache/thinksound/inductor.
+    Call before the first compile.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.environ.get("THINKSOUND_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "thinksound")), "inductor")
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    os.environ["TORCHINDUCTOR_AUTOGRAD_CACHE"] = "1"
+
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    return cache_dir
+
+def _allow_recompiles(num_graphs):
+    # Every bucket is its own static-shape graph, so dynamo must not give up after its default recompile limit
+    import torch._dynamo.config as dynamo_config
+    name = "recompile_limit" if hasattr(dynamo_config, "recompile_limit") else "cache_size_limit"
+    setattr(dynamo_config, name, max(getattr(dynamo_config, name), num_graphs))
+
+def compile_with_fallback(fn, name=None, **compile_kwargs):
+    '''
+    blocks.compile(fn) with static shapes that switches to calling fn eagerly, with a warning,
+    the first time compilation fails (e.g. on an op inductor does not support).
+    '''
+    name = name or getattr(fn, "__qualname__", repr(fn))
+    compiled = blocks.compile(fn, dynamic=False, **compile_kwargs)
+    if compiled is fn:
+        return fn
+
+    from torch._dynamo.exc import TorchDynamoException
+
+    failed = False
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal failed
+        if not failed:
+            try:
+                return compiled(*args, **kwargs)
+            except TorchDynamoException as e:
+                failed = True
+                log.warning(f"Compiling {name} failed, running it eagerly: {e}")
+        return fn(*args, **kwargs)
+
+    wrapper.eager = fn
+    return wrapper
+
+def duration_bucket(duration, sample_rate=44100, downsampling_ratio=2048, clip_fps=8, sync_fps=24):
+    '''
+    MMmodule (latent_seq_len, clip_seq_len, sync_seq_len) for a clip of duration seconds.
+    The defaults match the ThinkSound config, where 9 s gives (194, 72, 216).
+    '''
+    return (math.ceil(duration * sample_rate / downsampling_ratio), int(duration * clip_fps), int(duration * sync_fps))
+
+def compile_mmdit(model, **compile_kwargs):
+    '''
+    Compile model.predict_flow in place. The eager method stays available as model.predict_flow.eager.
+    '''
+    if not hasattr(model.predict_flow, "eager"):
+        model.predict_flow = compile_with_fallback(model.predict_flow, name="MMmodule.predict_flow", **compile_kwargs)
+    return model
+
+def compile_decoder(decoder, **compile_kwargs):
+    '''
+    Compile an OobleckDecoder's forward in place. Fold its weight norm first (AudioAutoencoder.inference_mode)
+    so the graphs do not recompute the normalised weights.
+    '''
+    if not hasattr(decoder.forward, "eager"):
+        decoder.forward = compile_with_fallback(decoder.forward, name=f"{type(decoder).__name__}.forward", **compile_kwargs)
+    return decoder
+
+@torch.no_grad()
+def warmup(model=None, decoder=None, buckets=(), batch_size=1, cfg_scale=5.0, decoder_lengths=None, dtype=None):
+    '''
+    Run the compiled model and/or decoder once per bucket, so every graph is compiled (or loaded from the cache) at start-up.
+    buckets are (latent_seq_len, clip_seq_len, sync_seq_len) tuples, e.g. from duration_bucket.
+    The decoder is warmed up on the latent lengths of the buckets, or on decoder_lengths
+    (e.g. the chunk size, for chunked decoding). Leaves the model set to the last bucket.
+    Returns the seconds spent per bucket.
+    '''
+    from .mmdit import sample_inputs
+
+    buckets = list(buckets)
+    decoder_lengths = list(decoder_lengths) if decoder_lengths is not None else [bucket[0] for bucket in buckets]
+    _allow_recompiles(2 * (len(buckets) + len(decoder_lengths)))
+    autocast = torch.autocast(device_type=model.device.type if model is not None else "cuda", dtype=dtype, enabled=dtype is not None)
+
+    timings = {}
+    if model is not None:
+        for bucket in buckets:
+            start = time.perf_counter()
+            model.update_seq_lengths(*bucket)
+            with autocast:
+                model(**sample_inputs(model, batch_size), cfg_scale=cfg_scale, cfg_dropout_prob=0.0, scale_phi=0.0)
+            timings[bucket] = time.perf_counter() - start
+            log.info(f"Warmed up MMmodule for {bucket} in {timings[bucket]:.1f}s")
+
+    if decoder is not None:
+        parameter = next(decoder.parameters())
+        latent_dim = next(m for m in decoder.modules() if isinstance(m, torch.nn.Conv1d)).in_channels
+        for length in decoder_lengths:
+            start = time.perf_counter()
+            decoder(torch.randn(batch_size, latent_dim, length, device=parameter.device, dtype=parameter.dtype))
+            timings[("decoder", length)] = time.perf_counter() - start
+
+    return timings
+
+def compile_for_inference(model=None, autoencoder=None, durations=(), batch_size=1, cfg_scale=5.0, cache_dir=None,
+                          decoder_lengths=None, dtype=None, **compile_kwargs):
+    '''
+    Opt-in compiled inference: enable the persistent compile cache, compile MMmodule.predict_flow and the
+    autoencoder's decoder, and warm them up for the given durations in seconds.
+    '''
+    enable_compile_cache(cache_dir)
+    buckets = [duration_bucket(duration) for duration in durations]
+
+    decoder = None
+    if autoencoder is not None:
+        autoencoder.inference_mode()
+        decoder = compile_decoder(autoencoder.decoder, **compile_kwargs)
+    if model is not None:
+        compile_mmdit(model, **compile_kwargs)
+
+    return warmup(model, decoder, buckets, batch_size=batch_size, cfg_scale=cfg_scale, decoder_lengths=decoder_lengths, dtype=dtype)
@@ -14,10 +14,13 @@ from .utils import copy_state_dict
 from .utils import load_ckpt_state_dict
 import numpy as np
 from einops import rearrange
-from transformers import AutoProcessor, AutoModel
 from torch import nn
 
 class Conditioner(nn.Module):
+    # Set by ResidencyManager.register when a manager decides where the conditioner's weights live
+    residency = None
+    residency_name = None
+
     def __init__(
             self,
             dim: int,
@@ -34,6 +37,15 @@ class Conditioner(nn.Module):
     def forward(self, x: tp.Any) -> tp.Any:
         raise NotImplementedError()
 
+    def model_to(self, device):
+        '''
+        Put the wrapped encoder on device before encoding, through the residency manager if there is one.
+        '''
+        if self.residency is not None:
+            self.residency.load(self.residency_name)
+        else:
+            self.model.to(device)
+
 class VideoHieraConditioner(Conditioner):
     def __init__(self, 
                  output_dim: int, 
@@ -89,7 +101,7 @@ class VideoHieraConditioner(Conditioner):
         torch.cuda.empty_cache()
 
     def forward(self, x: tp.List[str], device: tp.Any = "cuda") -> tp.Any:
-        self.model.to(device)
+        self.model_to(device)
         import ipdb
         ipdb.set_trace()
         output, interm = model(x,return_intermediates=True)
@@ -256,6 +268,7 @@ class CLIPConditioner(Conditioner):
         super().__init__(self.CLIP_MODEL_DIMS[clip_model_name], output_dim, project_out=project_out)
         
         self.enable_grad = enable_grad
+        from transformers import AutoModel
         model = AutoModel.from_pretrained(f"useful_ckpts/{clip_model_name}").train(enable_grad).requires_grad_(enable_grad).to(torch.float16)
 
         
@@ -268,8 +281,9 @@ class CLIPConditioner(Conditioner):
 
     def forward(self, images: tp.List[str], device: tp.Union[torch.device, str]) -> tp.Tuple[torch.Tensor, torch.Tensor]:
         
-        self.model.to(device)
-        self.proj_out.to(device)
+        self.model_to(device)
+        if self.residency is None:
+            self.proj_out.to(device)
         # import ipdb
         # ipdb.set_trace()
 
@@ -415,7 +429,7 @@ class CLAPTextConditioner(Conditioner):
         return prompt_features, attention_mask
 
     def forward(self, texts: tp.List[str], device: tp.Any = "cuda") -> tp.Any:
-        self.model.to(device)
+        self.model_to(device)
 
         if self.use_text_features:
             if len(texts) == 1:
@@ -483,7 +497,7 @@ class CLAPAudioConditioner(Conditioner):
 
     def forward(self, audios: tp.Union[torch.Tensor, tp.List[torch.Tensor], tp.Tuple[torch.Tensor]] , device: tp.Any = "cuda") -> tp.Any:
 
-        self.model.to(device)
+        self.model_to(device)
 
         if isinstance(audios, list) or isinstance(audios, tuple):
             audios = torch.cat(audios, dim=0)
@@ -558,8 +572,9 @@ class T5Conditioner(Conditioner):
 
     def forward(self, texts: tp.List[str], device: tp.Union[torch.device, str]) -> tp.Tuple[torch.Tensor, torch.Tensor]:
         
-        self.model.to(device)
-        self.proj_out.to(device)
+        self.model_to(device)
+        if self.residency is None:
+            self.proj_out.to(device)
         encoded = self.tokenizer(
             texts,
             truncation=True,
@@ -638,8 +653,9 @@ class CLIPTextConditioner(Conditioner):
 
     def forward(self, texts: tp.List[str], device: tp.Union[torch.device, str]) -> tp.Tuple[torch.Tensor, torch.Tensor]:
         
-        self.model.to(device)
-        self.proj_out.to(device)
+        self.model_to(device)
+        if self.residency is None:
+            self.proj_out.to(device)
 
         encoded = self.tokenizer(
             texts
@@ -722,8 +738,9 @@ class MetaCLIPTextConditioner(Conditioner):
 
     def forward(self, texts: tp.List[str], device: tp.Union[torch.device, str]) -> tp.Tuple[torch.Tensor, torch.Tensor]:
         
-        self.model.to(device)
-        self.proj_out.to(device)
+        self.model_to(device)
+        if self.residency is None:
+            self.proj_out.to(device)
         encoded = self.clip_processor(text=texts, return_tensors="pt", padding=True).to(device)
 
         # input_ids = encoded["input_ids"].to(device)
@@ -893,39 +910,84 @@ class MultiConditioner(nn.Module):
     Args:
         conditioners: a dictionary of conditioners with keys corresponding to the keys of the conditioning input dictionary (e.g. "prompt")
         default_keys: a dictionary of default keys to use if the key is not in the input dictionary (e.g. {"prompt_t5": "prompt"})
+        num_workers: run up to this many conditioners concurrently in threads (1 runs them one after another).
+            Conditioners are independent, so feature-file loaders overlap their I/O and encoders on CUDA run on their own streams.
     """
-    def __init__(self, conditioners: tp.Dict[str, Conditioner], default_keys: tp.Dict[str, str] = {}):
+    def __init__(self, conditioners: tp.Dict[str, Conditioner], default_keys: tp.Dict[str, str] = {}, num_workers: int = 1):
         super().__init__()
 
         self.conditioners = nn.ModuleDict(conditioners)
         self.default_keys = default_keys
+        self.num_workers = num_workers
 
-    def forward(self, batch_metadata: tp.List[tp.Dict[str, tp.Any]], device: tp.Union[torch.device, str]) -> tp.Dict[str, tp.Any]:
-        output = {}
+    def get_conditioner_inputs(self, key: str, batch_metadata: tp.List[tp.Dict[str, tp.Any]]) -> tp.List[tp.Any]:
+        condition_key = key
+
+        conditioner_inputs = []
 
-        for key, conditioner in self.conditioners.items():
-            condition_key = key
+        for x in batch_metadata:
 
-            conditioner_inputs = []
+            if condition_key not in x:
+                if condition_key in self.default_keys:
+                    condition_key = self.default_keys[condition_key]
+                else:
+                    raise ValueError(f"Conditioner key {condition_key} not found in batch metadata")
 
-            for x in batch_metadata:
+            #Unwrap the condition info if it's a single-element list or tuple, this is to support collation functions that wrap everything in a list
+            if isinstance(x[condition_key], list) or isinstance(x[condition_key], tuple) and len(x[condition_key]) == 1:
+                conditioner_input = x[condition_key][0]
+                
+            else:
+                conditioner_input = x[condition_key]
+
+            conditioner_inputs.append(conditioner_input)
+
+        return conditioner_inputs
+
+    def _run_parallel(self, jobs, device):
+        # Grad mode and autocast are thread-local, so each worker re-enters the caller's
+        device = torch.device(device)
+        grad_enabled = torch.is_grad_enabled()
+        autocast_enabled = torch.is_autocast_enabled(device.type)
+        autocast_dtype = torch.get_autocast_dtype(device.type)
+        main_stream = torch.cuda.current_stream(device) if device.type == "cuda" else None
+
+        def run(conditioner, inputs):
+            with torch.set_grad_enabled(grad_enabled), torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_enabled):
+                if main_stream is None:
+                    return conditioner(inputs, device), None
+                stream = torch.cuda.Stream(device)
+                stream.wait_stream(main_stream)
+                with torch.cuda.stream(stream):
+                    return conditioner(inputs, device), stream
+
+        executor = _conditioner_executor(self.num_workers)
+        futures = {key: executor.submit(run, conditioner, inputs) for key, conditioner, inputs in jobs}
+
+        outputs = {}
+        for key, future in futures.items():
+            cond_output, stream = future.result()
+            if stream is not None:
+                main_stream.wait_stream(stream)
+                for tensor in cond_output:
+                    if isinstance(tensor, torch.Tensor) and tensor.is_cuda:
+                        tensor.record_stream(main_stream)
+            outputs[key] = cond_output
+        return outputs
 
-                if condition_key not in x:
-                    if condition_key in self.default_keys:
-                        condition_key = self.default_keys[condition_key]
-                    else:
-                        raise ValueError(f"Conditioner key {condition_key} not found in batch metadata")
+    def forward(self, batch_metadata: tp.List[tp.Dict[str, tp.Any]], device: tp.Union[torch.device, str]) -> tp.Dict[str, tp.Any]:
+        jobs = [(key, conditioner, self.get_conditioner_inputs(key, batch_metadata)) for key, conditioner in self.conditioners.items()]
 
-                #Unwrap the condition info if it's a single-element list or tuple, this is to support collation functions that wrap everything in a list
-                if isinstance(x[condition_key], list) or isinstance(x[condition_key], tuple) and len(x[condition_key]) == 1:
-                    conditioner_input = x[condition_key][0]
-                    
-                else:
-                    conditioner_input = x[condition_key]
+        if self.num_workers > 1 and len(jobs) > 1:
+            cond_outputs = self._run_parallel(jobs, device)
+        else:
+            cond_outputs = {key: conditioner(inputs, device) for key, conditioner, inputs in jobs}
 
-                conditioner_inputs.append(conditioner_input)
-            
-            cond_output = conditioner(conditioner_inputs, device)
+        output = {}
+
+        # Merge in conditioner order, whatever order they finished in
+        for key, _, _ in jobs:
+            cond_output = cond_outputs[key]
             if len(cond_output) == 1:
                 output[key] = cond_output[0]
             elif len(cond_output) == 2:
@@ -935,6 +997,18 @@ class MultiConditioner(nn.Module):
                 output[f'{key}_g'] = cond_output[2:]
 
         return output
+
+_executor = None
+
+def _conditioner_executor(num_workers):
+    # Shared by all MultiConditioners; kept out of the modules so they can still be deep-copied (e.g. for EMA)
+    global _executor
+    if _executor is None or _executor._max_workers < num_workers:
+        from concurrent.futures import ThreadPoolExecutor
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="conditioner")
+    return _executor
     
 def create_multi_conditioner_from_conditioning_config(config: tp.Dict[str, tp.Any]) -> MultiConditioner:
     """
@@ -1002,4 +1076,7 @@ def create_multi_conditioner_from_conditioning_config(config: tp.Dict[str, tp.An
         else:
             raise ValueError(f"Unknown conditioner type: {conditioner_type}")
 
-    return MultiConditioner(conditioners, default_keys=default_keys)
+    # Conditioners run concurrently unless the config asks for fewer workers
+    num_workers = config.get("num_workers", len(conditioners))
+
+    return MultiConditioner(conditioners, default_keys=default_keys, num_workers=num_workers)
@@ -1,3 +1,4 @@
+import contextlib
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -861,7 +862,9 @@ def create_diffusion_cond_from_config(config: tp.Dict[str, tp.Any]):
 
     conditioner = None
     if conditioning_config is not None:
-        conditioner = create_multi_conditioner_from_conditioning_config(conditioning_config)
+        # Conditioners load pretrained encoders that may not be in the checkpoint, so they are built on the CPU even under torch.device("meta")
+        with torch.device("cpu") if torch.get_default_device().type == "meta" else contextlib.nullcontext():
+            conditioner = create_multi_conditioner_from_conditioning_config(conditioning_config)
 
     cross_attention_ids = diffusion_config.get('cross_attention_cond_ids', [])
     add_cond_ids = diffusion_config.get('add_cond_ids', [])
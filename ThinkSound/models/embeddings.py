@@ -3,7 +3,8 @@ import torch.nn as nn
 
 # https://github.com/facebookresearch/DiT
 
-from typing import Union
+from functools import lru_cache
+from typing import Optional, Union
 
 import torch
 from einops import rearrange
@@ -32,12 +33,89 @@ def compute_rope_rotations(length: int,
         return rot
 
 
-def apply_rope(x: Tensor, rot: Tensor) -> tuple[Tensor, Tensor]:
-    with torch.amp.autocast(device_type='cuda', enabled=False):
-        _x = x.float()
-        _x = _x.view(*_x.shape[:-1], -1, 1, 2)
-        x_out = rot[..., 0] * _x[..., 0] + rot[..., 1] * _x[..., 1]
-        return x_out.reshape(*x.shape).to(dtype=x.dtype)
+@lru_cache(maxsize=32)
+def _rope_tables(length: int, dim: int, theta: int, freq_scaling: float, dtype: torch.dtype,
+                 device: torch.device) -> Tensor:
+    # Cached tensors are shared between calls, so they must be ordinary (not inference-mode) tensors
+    with torch.inference_mode(False), torch.no_grad():
+        rot = compute_rope_rotations(length, dim, theta, freq_scaling=freq_scaling, device=device)
+        # (1, N, D/2, 2, 2) rotation matrices -> cos and signed sin per channel, interleaved like x
+        cos = rot[..., 0, 0].repeat_interleave(2, dim=-1)
+        sin = torch.stack([rot[..., 0, 1], rot[..., 1, 0]], dim=-1).flatten(-2)
+        return torch.stack([cos, sin]).to(dtype)
+
+
+def rope_tables(length: int,
+                dim: int,
+                theta: int,
+                *,
+                freq_scaling: float = 1.0,
+                dtype: torch.dtype = torch.float32,
+                device: Union[torch.device, str] = 'cpu') -> Tensor:
+    """
+    (2, 1, N, D) cos/sin tables for apply_rope, kept in an LRU per (length, dim, dtype, device).
+    The angles are computed in float32 and only the tables are cast to dtype,
+    so applying them runs in the activation dtype without upcasting q and k.
+    """
+    return _rope_tables(length, dim, theta, float(freq_scaling), dtype, torch.device(device))
+
+
+def rope_tables_at(positions: Tensor,
+                   dim: int,
+                   theta: int,
+                   *,
+                   freq_scaling: Union[float, Tensor] = 1.0,
+                   dtype: torch.dtype = torch.float32) -> Tensor:
+    """
+    (2, B, 1, N, D) cos/sin tables for apply_rope at arbitrary (B, N) token positions, e.g. positions that
+    restart at every segment of a packed sequence. freq_scaling may be a (B, N) tensor of per-token scalings.
+    """
+    assert dim % 2 == 0
+
+    with torch.amp.autocast(device_type=positions.device.type, enabled=False):
+        freqs = 1.0 / (theta**(torch.arange(0, dim, 2, dtype=torch.float32, device=positions.device) / dim))
+        if isinstance(freq_scaling, Tensor):
+            freqs = freqs * freq_scaling.float().unsqueeze(-1)
+        else:
+            freqs = freqs * freq_scaling
+        rot = positions.float().unsqueeze(-1) * freqs
+        cos = rot.cos().repeat_interleave(2, dim=-1)
+        sin = torch.stack([-rot.sin(), rot.sin()], dim=-1).flatten(-2)
+        return torch.stack([cos, sin]).unsqueeze(2).to(dtype)
+
+
+def apply_rope(x: Tensor, rot: Tensor, out: Optional[Tensor] = None) -> Tensor:
+    # rot: rope_tables or rope_tables_at output, or the (1, N, D/2, 2, 2) matrices from compute_rope_rotations
+    # out: optional buffer the rotated x is written to (and cast to its dtype)
+    if rot.dim() == 5 and rot.shape[-2:] == (2, 2):
+        with torch.amp.autocast(device_type='cuda', enabled=False):
+            _x = x.float()
+            _x = _x.view(*_x.shape[:-1], -1, 1, 2)
+            x_out = rot[..., 0] * _x[..., 0] + rot[..., 1] * _x[..., 1]
+            if out is not None:
+                return out.copy_(x_out.reshape(*x.shape))
+            return x_out.reshape(*x.shape).to(dtype=x.dtype)
+
+    # (x0, x1) -> (x0 * cos - x1 * sin, x1 * cos + x0 * sin), with the sign folded into the sin table
+    cos, sin = rot
+    x_swapped = x.unflatten(-1, (-1, 2)).flip(-1).flatten(-2)
+    if out is None:
+        return torch.addcmul(x * cos, x_swapped, sin).to(x.dtype)
+    if out is not x:
+        out.copy_(x)
+    return out.mul_(cos).addcmul_(x_swapped, sin)
+
+
+def apply_rope_qk(q: Tensor, k: Tensor, rot: Tensor, out: Optional[Tensor] = None) -> Tensor:
+    """
+    Rotate q and k in one call, returning them stacked as (2, ...).
+    out: optional (2, ...) buffer, e.g. the q/k part of a joint q/k/v buffer.
+    """
+    if out is None:
+        return apply_rope(torch.stack([q, k]), rot)
+    out[0].copy_(q)
+    out[1].copy_(k)
+    return apply_rope(out, rot, out=out)
 
 
 class TimestepEmbedder(nn.Module):
@@ -56,9 +134,10 @@ class TimestepEmbedder(nn.Module):
         self.max_period = max_period
         assert dim % 2 == 0, 'dim must be even.'
 
+        # freqs is not in checkpoints, so it is always built on the CPU, even when the model is built on the meta device
         with torch.autocast('cuda', enabled=False):
             self.freqs = nn.Buffer(
-                1.0 / (10000**(torch.arange(0, frequency_embedding_size, 2, dtype=torch.float32) /
+                1.0 / (10000**(torch.arange(0, frequency_embedding_size, 2, dtype=torch.float32, device='cpu') /
                                frequency_embedding_size)),
                 persistent=False)
             freq_scale = 10000 / max_period
@@ -48,10 +48,15 @@ def create_pretransform_from_config(pretransform_config, sample_rate):
 
         scale = pretransform_config.get("scale", 1.0)
         model_half = pretransform_config.get("model_half", False)
+        # bool, micro-batch size, or {"memory_mb": budget}
         iterate_batch = pretransform_config.get("iterate_batch", False)
         chunked = pretransform_config.get("chunked", False)
+        chunk_memory_mb = pretransform_config.get("chunk_memory_mb", None)
+        chunk_size = pretransform_config.get("chunk_size", None)
+        overlap = pretransform_config.get("overlap", None)
 
-        pretransform = AutoencoderPretransform(autoencoder, scale=scale, model_half=model_half, iterate_batch=iterate_batch, chunked=chunked)
+        pretransform = AutoencoderPretransform(autoencoder, scale=scale, model_half=model_half, iterate_batch=iterate_batch, chunked=chunked, 
+                                               chunk_memory_mb=chunk_memory_mb, chunk_size=chunk_size, overlap=overlap, model_config=pretransform_config["config"])
     elif pretransform_type == 'wavelet':
         from .pretransforms import WaveletPretransform
 
@@ -1,20 +1,52 @@
 import logging
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Union
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import sys
-from .embeddings import compute_rope_rotations
+from .embeddings import rope_tables, rope_tables_at
 from .embeddings import TimestepEmbedder
 from .blocks import MLP, ChannelLastConv1d, ConvMLP
+from .attention_backends import set_attention_backend
+from .checkpointing import checkpoint, select_checkpoint_blocks
+from .packing import SequencePacking, mask_tokens
+from .quantization import quantize_model, quantized_mode
 from .transformer_layers import (FinalBlock, JointBlock, MMDitSingleBlock)
-from .utils import resample
+from .utils import LazyCheckpoint, load_state_dict_lazy, resample
 
 log = logging.getLogger()
 
 
+def mmdit_prefix(keys) -> str:
+    # Checkpoints hold MMmodule under a wrapper prefix, e.g. "model.model." or "diffusion.model.model."
+    suffix = 'joint_blocks.0.latent_block.attn.qkv.'
+    for key in keys:
+        if suffix in key:
+            return key[:key.index(suffix)]
+    raise ValueError('No MMDiT weights found in checkpoint')
+
+
+def sample_inputs(model: 'MMmodule', batch_size: int = 1, generator: Optional[torch.Generator] = None) -> dict:
+    """
+    Random MMmodule.forward inputs with the shapes the model currently expects, on its device.
+    """
+    def randn(*shape):
+        return torch.randn(*shape, generator=generator).to(model.device)
+
+    return {
+        'latent': randn(batch_size, model.latent_dim, model.latent_seq_len),
+        't': torch.rand(batch_size, generator=generator).to(model.device),
+        'clip_f': randn(batch_size, model.clip_seq_len, model.empty_clip_feat.shape[-1]),
+        'sync_f': randn(batch_size, model.sync_seq_len, model.empty_sync_feat.shape[-1]),
+        'text_f': randn(batch_size, *model.empty_string_feat.shape),
+        't5_features': randn(batch_size, *model.empty_t5_feat.shape),
+        'metaclip_global_text_features': randn(batch_size, model.empty_string_feat.shape[-1]),
+        'inpaint_masked_input': None,
+    }
+
+
 @dataclass
 class PreprocessedConditions:
     clip_f: torch.Tensor
@@ -52,9 +84,13 @@ class MMmodule(nn.Module):
                  cross_attend: bool = False,
                  add_video: bool = False,
                  triple_fusion: bool = False,
-                 gated_video: bool = False) -> None:
+                 gated_video: bool = False,
+                 attention_backend: Optional[str] = None) -> None:
         super().__init__()
 
+        if attention_backend is not None:
+            set_attention_backend(attention_backend)
+
         self.v2 = v2
         self.latent_dim = latent_dim
         self._latent_seq_len = latent_seq_len
@@ -184,6 +220,10 @@ class MMmodule(nn.Module):
             for i in range(fused_depth)
         ])
 
+        # Packed sequences need at least this many zero tokens after each segment of the latent, clip and sync
+        # streams: the widest conv padding in each stream (the final layer's conv pads the latent by 3)
+        self.packing_gaps = (max(padding_size, 3), 1, max((sync_kernel - 1) // 2, 1) if v2 else 3)
+
         if empty_string_feat is None:
             empty_string_feat = torch.zeros((77, 1024))
         
@@ -194,25 +234,30 @@ class MMmodule(nn.Module):
         self.empty_clip_feat = nn.Parameter(torch.zeros(1, clip_dim), requires_grad=True)
         self.empty_sync_feat = nn.Parameter(torch.zeros(1, sync_dim), requires_grad=True)
 
+        # Indices of the blocks to checkpoint in training, see checkpointing.set_activation_checkpointing.
+        # None: resolve the checkpoint_budget policy on the next training forward pass
+        self.checkpoint_blocks = frozenset()
+        self.checkpoint_budget = None
+
         self.initialize_weights()
         self.initialize_rotations()
 
     def initialize_rotations(self):
         base_freq = 1.0
-        latent_rot = compute_rope_rotations(self._latent_seq_len,
-                                            self.hidden_dim // self.num_heads,
-                                            10000,
-                                            freq_scaling=base_freq,
-                                            device=self.device)
-        clip_rot = compute_rope_rotations(self._clip_seq_len,
-                                          self.hidden_dim // self.num_heads,
-                                          10000,
-                                          freq_scaling=base_freq * self._latent_seq_len /
-                                          self._clip_seq_len,
-                                          device=self.device)
-
-        self.latent_rot = nn.Buffer(latent_rot, persistent=False)
-        self.clip_rot = nn.Buffer(clip_rot, persistent=False)
+        # RoPE cos/sin tables are fetched per forward from the embeddings.rope_tables LRU,
+        # in the activation dtype and device
+        self._latent_rope = dict(length=self._latent_seq_len,
+                                 dim=self.hidden_dim // self.num_heads,
+                                 theta=10000,
+                                 freq_scaling=base_freq)
+        self._clip_rope = dict(length=self._clip_seq_len,
+                               dim=self.hidden_dim // self.num_heads,
+                               theta=10000,
+                               freq_scaling=base_freq * self._latent_seq_len / self._clip_seq_len)
+
+    def rope_tables(self, dtype: torch.dtype, device: torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+        return (rope_tables(**self._latent_rope, dtype=dtype, device=device),
+                rope_tables(**self._clip_rope, dtype=dtype, device=device))
 
     def update_seq_lengths(self, latent_seq_len: int, clip_seq_len: int, sync_seq_len: int) -> None:
         self._latent_seq_len = latent_seq_len
@@ -257,28 +302,8 @@ class MMmodule(nn.Module):
         nn.init.constant_(self.empty_clip_feat, 0)
         nn.init.constant_(self.empty_sync_feat, 0)
 
-    def preprocess_conditions(self, clip_f: torch.Tensor, sync_f: torch.Tensor,
-                              text_f: torch.Tensor, t5_features: torch.Tensor, metaclip_global_text_features: torch.Tensor) -> PreprocessedConditions:
-        """
-        cache computations that do not depend on the latent/time step
-        i.e., the features are reused over steps during inference
-        """
-        # breakpoint()
-        assert clip_f.shape[1] == self._clip_seq_len, f'{clip_f.shape=} {self._clip_seq_len=}'
-        assert sync_f.shape[1] == self._sync_seq_len, f'{sync_f.shape=} {self._sync_seq_len=}'
-        assert text_f.shape[1] == self._text_seq_len, f'{text_f.shape=} {self._text_seq_len=}'
-
-        bs = clip_f.shape[0]
-
-        # B * num_segments (24) * 8 * 768
-        num_sync_segments = self._sync_seq_len // 8
-        sync_f = sync_f.view(bs, num_sync_segments, 8, -1) + self.sync_pos_emb
-        sync_f = sync_f.flatten(1, 2)  # (B, VN, D)
-
-        # extend vf to match x
-        clip_f = self.clip_input_proj(clip_f)  # (B, VN, D)
-        sync_f = self.sync_input_proj(sync_f)  # (B, VN, D)
-
+    def text_conditions(self, text_f: torch.Tensor, t5_features: Optional[torch.Tensor],
+                        metaclip_global_text_features: Optional[torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor]:
         if t5_features is not None:
 
             if metaclip_global_text_features is not None:
@@ -301,6 +326,34 @@ class MMmodule(nn.Module):
                 text_f_c = self.text_cond_proj(metaclip_global_text_features)  # (B, D)
             else:
                 text_f_c = self.text_cond_proj(text_f.mean(dim=1))  # (B, D)
+        return text_f, text_f_c
+
+    def preprocess_conditions(self, clip_f: torch.Tensor, sync_f: torch.Tensor,
+                              text_f: torch.Tensor, t5_features: torch.Tensor, metaclip_global_text_features: torch.Tensor,
+                              packing: Optional[SequencePacking] = None) -> PreprocessedConditions:
+        """
+        cache computations that do not depend on the latent/time step
+        i.e., the features are reused over steps during inference
+        """
+        if packing is not None:
+            return self.preprocess_packed_conditions(clip_f, sync_f, text_f, t5_features, metaclip_global_text_features, packing)
+        # breakpoint()
+        assert clip_f.shape[1] == self._clip_seq_len, f'{clip_f.shape=} {self._clip_seq_len=}'
+        assert sync_f.shape[1] == self._sync_seq_len, f'{sync_f.shape=} {self._sync_seq_len=}'
+        assert text_f.shape[1] == self._text_seq_len, f'{text_f.shape=} {self._text_seq_len=}'
+
+        bs = clip_f.shape[0]
+
+        # B * num_segments (24) * 8 * 768
+        num_sync_segments = self._sync_seq_len // 8
+        sync_f = sync_f.view(bs, num_sync_segments, 8, -1) + self.sync_pos_emb
+        sync_f = sync_f.flatten(1, 2)  # (B, VN, D)
+
+        # extend vf to match x
+        clip_f = self.clip_input_proj(clip_f)  # (B, VN, D)
+        sync_f = self.sync_input_proj(sync_f)  # (B, VN, D)
+
+        text_f, text_f_c = self.text_conditions(text_f, t5_features, metaclip_global_text_features)
 
         # upsample the sync features to match the audio
         sync_f = sync_f.transpose(1, 2)  # (B, D, VN)
@@ -317,11 +370,97 @@ class MMmodule(nn.Module):
                                       clip_f_c=clip_f_c,
                                       text_f_c=text_f_c)
 
+    def project(self, proj: nn.Sequential, x: torch.Tensor, keep: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # proj(x), zeroing the tokens of a packed sequence that belong to no segment before each conv
+        if keep is None:
+            return proj(x)
+        for layer in proj:
+            if isinstance(layer, ConvMLP):
+                x = layer(x, keep)
+            elif isinstance(layer, ChannelLastConv1d):
+                x = layer(mask_tokens(x, keep))
+            else:
+                x = layer(x)
+        return x
+
+    def preprocess_packed_conditions(self, clip_f: torch.Tensor, sync_f: torch.Tensor, text_f: torch.Tensor,
+                                     t5_features: Optional[torch.Tensor], metaclip_global_text_features: Optional[torch.Tensor],
+                                     packing: SequencePacking) -> PreprocessedConditions:
+        """
+        preprocess_conditions for a packed batch: clip_f and sync_f hold the segments of each row back to back,
+        text_f, t5_features and metaclip_global_text_features are per segment, (B, K, ...).
+        clip_f_c and text_f_c are per segment, (B, K, D).
+        """
+        assert clip_f.shape[1] == self._clip_seq_len, f'{clip_f.shape=} {self._clip_seq_len=}'
+        assert sync_f.shape[1] == self._sync_seq_len, f'{sync_f.shape=} {self._sync_seq_len=}'
+        assert text_f.shape[2] == self._text_seq_len, f'{text_f.shape=} {self._text_seq_len=}'
+        assert all(g >= r for g, r in zip(packing.gaps, self.packing_gaps)), f'{packing.gaps=} {self.packing_gaps=}'
+
+        bs, num_segments = text_f.shape[:2]
+
+        # each segment's sync features start a new group of 8 frames
+        sync_f = sync_f + self.sync_pos_emb[0, 0][packing.positions['sync'] % 8]
+
+        clip_f = self.project(self.clip_input_proj, clip_f, packing.keep('clip'))  # (B, VN, D)
+        sync_f = self.project(self.sync_input_proj, sync_f, packing.keep('sync'))  # (B, VN, D)
+
+        flatten = lambda x: x.flatten(0, 1) if x is not None else None
+        text_f, text_f_c = self.text_conditions(flatten(text_f), flatten(t5_features), flatten(metaclip_global_text_features))
+        text_f = text_f.view(bs, -1, text_f.shape[-1])  # (B, K * text tokens, D)
+        text_f_c = text_f_c.view(bs, num_segments, -1)  # (B, K, D)
+
+        # upsample each segment's sync features to its latent length
+        index = packing.resample_index('sync', 'latent')
+        sync_f = sync_f.gather(1, index.unsqueeze(-1).expand(-1, -1, sync_f.shape[-1]))  # (B, N, D)
+
+        clip_f_c = self.clip_cond_proj(packing.segment_mean(clip_f, 'clip'))  # (B, K, D)
+
+        return PreprocessedConditions(clip_f=clip_f,
+                                      sync_f=sync_f,
+                                      text_f=text_f,
+                                      clip_f_c=clip_f_c,
+                                      text_f_c=text_f_c)
+
+    def packed_rope_tables(self, packing: SequencePacking, dtype: torch.dtype) -> tuple[torch.Tensor, torch.Tensor]:
+        # positions restart at every segment; the clip rotations are scaled by each segment's latent/clip length ratio
+        latent_rot = rope_tables_at(packing.positions['latent'], self._latent_rope['dim'], self._latent_rope['theta'], dtype=dtype)
+        ids = packing.ids['clip']
+        scaling = packing.to_tokens(packing.segment_lengths('latent'), ids) / packing.to_tokens(packing.segment_lengths('clip'), ids).clamp(min=1)
+        clip_rot = rope_tables_at(packing.positions['clip'], self._clip_rope['dim'], self._clip_rope['theta'],
+                                  freq_scaling=scaling, dtype=dtype)
+        return latent_rot, clip_rot
+
+    def packed_cfg_dropout(self, packing: SequencePacking, cfg_dropout_prob: float, clip_f, sync_f, text_f,
+                           t5_features, metaclip_global_text_features, inpaint_masked_input):
+        """
+        classifier-free guidance dropout for a packed batch, drawn per segment instead of per row
+        """
+        def dropped(ids=None):
+            drop = torch.bernoulli(torch.full(packing.lengths.shape[:2], cfg_dropout_prob, device=clip_f.device)).to(torch.bool)
+            return drop if ids is None else packing.to_tokens(drop, ids)
+
+        if inpaint_masked_input is not None:
+            inpaint_masked_input = torch.where(dropped(packing.ids['latent']).unsqueeze(1), 0, inpaint_masked_input)
+        clip_f = torch.where(dropped(packing.ids['clip']).unsqueeze(-1), self.empty_clip_feat, clip_f)
+        sync_f = torch.where(dropped(packing.ids['sync']).unsqueeze(-1), self.empty_sync_feat, sync_f)
+        text_f = torch.where(dropped()[..., None, None], self.empty_string_feat, text_f)
+        if t5_features is not None:
+            t5_features = torch.where(dropped()[..., None, None], self.empty_t5_feat, t5_features)
+        if metaclip_global_text_features is not None:
+            metaclip_global_text_features = torch.where(dropped().unsqueeze(-1), 0, metaclip_global_text_features)
+        return clip_f, sync_f, text_f, t5_features, metaclip_global_text_features, inpaint_masked_input
+
+    def run_block(self, index, block, *args, **kwargs):
+        if torch.is_grad_enabled() and self.checkpoint_blocks and index in self.checkpoint_blocks:
+            return checkpoint(block, *args, **kwargs)
+        return block(*args, **kwargs)
+
     def predict_flow(self, latent: torch.Tensor, t: torch.Tensor,
-                     conditions: PreprocessedConditions, inpaint_masked_input=None, cfg_scale:float=1.0,cfg_dropout_prob:float=0.0,scale_phi:float=0.0
-                     ) -> torch.Tensor:
+                     conditions: PreprocessedConditions, inpaint_masked_input=None, cfg_scale:float=1.0,cfg_dropout_prob:float=0.0,scale_phi:float=0.0,
+                     packing: Optional[SequencePacking] = None) -> torch.Tensor:
         """
         for non-cacheable computations
+        packing: layout of a packed batch, with t and the global conditions per segment, (B, K, ...)
         """
         # print(f'cfg_scale: {cfg_scale}, cfg_dropout_prob: {cfg_dropout_prob}, scale_phi: {scale_phi}')
         assert latent.shape[1] == self._latent_seq_len, f'{latent.shape=} {self._latent_seq_len=}'
@@ -337,15 +476,41 @@ class MMmodule(nn.Module):
         # breakpoint()
         if inpaint_masked_input is not None:
             latent = torch.cat([latent,inpaint_masked_input],dim=2)
-        latent = self.audio_input_proj(latent)  # (B, N, D)
+        latent_keep = packing.keep('latent') if packing is not None else None
+        latent = self.project(self.audio_input_proj, latent, latent_keep)  # (B, N, D)
         global_c = self.global_cond_mlp(clip_f_c + text_f_c)  # (B, D)
-        # global_c = text_f_c
-        global_c = self.t_embed(t).unsqueeze(1) + global_c.unsqueeze(1)  # (B, D)
-        extended_c = global_c + sync_f
+        joint_kwargs = {}
+        fused_kwargs = {}
+        if packing is None:
+            # global_c = text_f_c
+            global_c = self.t_embed(t).unsqueeze(1) + global_c.unsqueeze(1)  # (B, D)
+            extended_c = global_c + sync_f
+            latent_rot, clip_rot = self.rope_tables(latent.dtype, latent.device)
+        else:
+            assert not self.add_video, 'add_video does not support packed sequences'
+            # conditions are per segment (B, K, D), every token gets its segment's
+            global_c = self.t_embed(t.flatten()).view(*t.shape, -1) + global_c
+            latent_ids = packing.ids['latent']
+            text_ids = packing.text_ids(text_f.shape[1] // packing.num_segments)
+            extended_c = packing.to_tokens(global_c, latent_ids) + sync_f
+            latent_rot, clip_rot = self.packed_rope_tables(packing, latent.dtype)
+            joint_ids = torch.cat([latent_ids, packing.ids['clip'], text_ids], dim=1)
+            joint_kwargs = dict(text_c=packing.to_tokens(global_c, text_ids),
+                                attn_mask=SequencePacking.attention_mask(joint_ids, joint_ids),
+                                latent_keep=latent_keep,
+                                clip_keep=packing.keep('clip'))
+            fused_kwargs = dict(attn_mask=SequencePacking.attention_mask(latent_ids, latent_ids), keep=latent_keep)
+            if self.cross_attend:
+                fused_kwargs['context_mask'] = SequencePacking.attention_mask(latent_ids, text_ids)
+            global_c = packing.to_tokens(global_c, packing.ids['clip'])
 
-        for block in self.joint_blocks:
-            latent, clip_f, text_f = block(latent, clip_f, text_f, global_c, extended_c,
-                                           self.latent_rot, self.clip_rot)  # (B, N, D)
+        if self.checkpoint_blocks is None and torch.is_grad_enabled():
+            self.checkpoint_blocks = select_checkpoint_blocks(self, "budget", memory_budget=self.checkpoint_budget,
+                                                              batch_size=latent.shape[0])
+
+        for i, block in enumerate(self.joint_blocks):
+            latent, clip_f, text_f = self.run_block(i, block, latent, clip_f, text_f, global_c, extended_c,
+                                                    latent_rot, clip_rot, **joint_kwargs)  # (B, N, D)
         if self.add_video:
             if clip_f.shape[1] != latent.shape[1]:
                 clip_f = resample(clip_f, latent)
@@ -366,22 +531,25 @@ class MMmodule(nn.Module):
             else:
                 latent = latent + clip_f
         
-        for block in self.fused_blocks:
+        for i, block in enumerate(self.fused_blocks, start=len(self.joint_blocks)):
             if self.cross_attend:
-                latent = block(latent, extended_c, self.latent_rot, context=text_f)
+                latent = self.run_block(i, block, latent, extended_c, latent_rot, context=text_f, **fused_kwargs)
             else:
-                latent = block(latent, extended_c, self.latent_rot)
+                latent = self.run_block(i, block, latent, extended_c, latent_rot, **fused_kwargs)
 
         # should be extended_c; this is a minor implementation error #55
-        flow = self.final_layer(latent, extended_c)  # (B, N, out_dim), remove t
+        flow = self.final_layer(latent, extended_c, keep=latent_keep)  # (B, N, out_dim), remove t
         return flow
 
     def forward(self, latent: torch.Tensor, t: torch.Tensor, clip_f: torch.Tensor, sync_f: torch.Tensor,
-                text_f: torch.Tensor, inpaint_masked_input, t5_features, metaclip_global_text_features, cfg_scale:float,cfg_dropout_prob:float,scale_phi:float) -> torch.Tensor:
+                text_f: torch.Tensor, inpaint_masked_input, t5_features, metaclip_global_text_features, cfg_scale:float,cfg_dropout_prob:float,scale_phi:float,
+                packing: Optional[SequencePacking] = None) -> torch.Tensor:
         """
         latent: (B, N, C) 
         vf: (B, T, C_V)
         t: (B,)
+        packing: for training on packed sequences, see packing.SequencePacking; t, text_f, t5_features and
+        metaclip_global_text_features are then per segment, (B, K, ...)
         """
         # breakpoint()
         # print(f'cfg_scale: {cfg_scale}, cfg_dropout_prob: {cfg_dropout_prob}, scale_phi: {scale_phi}')
@@ -389,7 +557,11 @@ class MMmodule(nn.Module):
             inpaint_masked_input = torch.zeros_like(latent, device=latent.device)
         latent = latent.permute(0, 2, 1)
 
-        if cfg_dropout_prob > 0.0:
+        if cfg_dropout_prob > 0.0 and packing is not None:
+            (clip_f, sync_f, text_f, t5_features, metaclip_global_text_features,
+             inpaint_masked_input) = self.packed_cfg_dropout(packing, cfg_dropout_prob, clip_f, sync_f, text_f, t5_features,
+                                                             metaclip_global_text_features, inpaint_masked_input)
+        elif cfg_dropout_prob > 0.0:
             if inpaint_masked_input is not None:
                 null_embed = torch.zeros_like(inpaint_masked_input,device=latent.device)
                 dropout_mask = torch.bernoulli(torch.full((inpaint_masked_input.shape[0], 1, 1), cfg_dropout_prob, device=latent.device)).to(torch.bool)
@@ -424,6 +596,7 @@ class MMmodule(nn.Module):
             # text_f_c = torch.where(dropout_mask, null_embed, text_f_c)
 
         if cfg_scale != 1.0:
+            assert packing is None, 'classifier-free guidance does not support packed sequences'
             # empty_conditions = self.get_empty_conditions(latent.shape[0])
             # breakpoint()
             bsz = latent.shape[0]
@@ -453,8 +626,8 @@ class MMmodule(nn.Module):
             # clip_f_c = torch.cat([clip_f_c,empty_clip_f_c], dim=0)
             # text_f_c = torch.cat([text_f_c,empty_text_f_c], dim=0)
 
-        conditions = self.preprocess_conditions(clip_f, sync_f, text_f, t5_features, metaclip_global_text_features)
-        flow = self.predict_flow(latent, t, conditions, inpaint_masked_input, cfg_scale,cfg_dropout_prob,scale_phi)
+        conditions = self.preprocess_conditions(clip_f, sync_f, text_f, t5_features, metaclip_global_text_features, packing=packing)
+        flow = self.predict_flow(latent, t, conditions, inpaint_masked_input, cfg_scale,cfg_dropout_prob,scale_phi, packing=packing)
         if cfg_scale != 1.0:
             cond_output, uncond_output = torch.chunk(flow, 2, dim=0)
             cfg_output = uncond_output + (cond_output - uncond_output) * cfg_scale
@@ -501,7 +674,10 @@ class MMmodule(nn.Module):
 
         return conditions
 
-    def load_weights(self, src_dict) -> None:
+    def load_weights(self, src_dict, metadata: Optional[dict] = None) -> None:
+        """
+        metadata is the safetensors metadata of the checkpoint, which holds the mode of pre-quantized weights.
+        """
         if 't_embed.freqs' in src_dict:
             del src_dict['t_embed.freqs']
         if 'latent_rot' in src_dict:
@@ -509,8 +685,54 @@ class MMmodule(nn.Module):
         if 'clip_rot' in src_dict:
             del src_dict['clip_rot']
 
+        # Pre-quantized weights, e.g. from quantization.save_quantized
+        mode = quantized_mode(src_dict, metadata)
+        if mode is not None:
+            self.quantize(mode, quantize=False)
+
         self.load_state_dict(src_dict, strict=True)
 
+    @classmethod
+    def from_checkpoint(cls,
+                        ckpt_path: str,
+                        *,
+                        prefix: Optional[str] = None,
+                        device: Union[torch.device, str] = 'cpu',
+                        dtype: Optional[torch.dtype] = None,
+                        **kwargs) -> 'MMmodule':
+        """
+        Build the model on the meta device, which skips random initialisation, and load its weights
+        from ckpt_path one tensor at a time, straight to device and dtype (safetensors are memory-mapped).
+        prefix defaults to wherever the MMDiT weights sit in the checkpoint. Pre-quantized weights are supported.
+        """
+        with torch.device('meta'):
+            model = cls(**kwargs)
+
+        checkpoint = LazyCheckpoint(ckpt_path)
+        if prefix is None:
+            prefix = mmdit_prefix(checkpoint.keys())
+        checkpoint = LazyCheckpoint(ckpt_path, prefix=prefix)
+
+        mode = quantized_mode(checkpoint, checkpoint.metadata)
+        if mode is not None:
+            model.quantize(mode, quantize=False)
+
+        missing_keys, unexpected_keys = load_state_dict_lazy(model, checkpoint, device=device, dtype=dtype, strict=False)
+        unexpected_keys = [k for k in unexpected_keys if k not in ('t_embed.freqs', 'latent_rot', 'clip_rot')]
+        assert not missing_keys and not unexpected_keys, f'{missing_keys=} {unexpected_keys=}'
+
+        # Non-persistent buffers were built on the CPU
+        return model.to(device)
+
+    def quantize(self, mode: str = "dynamic_int8", quantize: bool = True):
+        """
+        Quantize the Linear and conv layers of the joint and fused blocks for CPU inference,
+        see quantization.QUANT_MODES. quantize=False only swaps in the layers, to load pre-quantized weights.
+        """
+        quantize_model(self.joint_blocks, mode, quantize=quantize)
+        quantize_model(self.fused_blocks, mode, quantize=quantize)
+        return self
+
     @property
     def device(self) -> torch.device:
         return self.empty_clip_feat.device
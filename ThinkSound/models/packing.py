@@ -0,0 +1,137 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+
+# Sequence packing for MMmodule training: several clips (segments) share one row of the batch instead of each clip
+# being padded to the full sequence length. Every stream (latent, clip, sync) holds its segments back to back,
+# each followed by a gap of zero tokens at least as wide as the stream's conv padding, so convolutions never see
+# another segment; attention is block-diagonal over segments and RoPE positions restart at every segment.
+# Unused segment slots have length 0 and sit at the end of a row.
+
+PACKING_KEY = "packing"
+
+STREAMS = ("latent", "clip", "sync")
+
+
+def segment_starts(lengths: torch.Tensor, gap: int) -> torch.Tensor:
+    # lengths: (..., K) tokens per segment; each non-empty segment is followed by gap tokens
+    spans = lengths + gap * (lengths > 0)
+    return torch.cumsum(spans, dim=-1) - spans
+
+
+def packed_length(lengths, gap: int) -> int:
+    '''
+    Tokens taken by segments of the given lengths, including the gaps between them.
+    '''
+    lengths = [length for length in lengths if length > 0]
+    return sum(lengths) + gap * max(len(lengths) - 1, 0)
+
+
+def token_layout(lengths: torch.Tensor, gap: int, size: int) -> tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Segment index (-1 for gaps and padding) and position within its segment of each of the size tokens of a
+    stream, for (B, K) segment lengths. Returns two (B, size) long tensors.
+    '''
+    starts = segment_starts(lengths, gap)
+    index = torch.arange(size, device=lengths.device)
+    inside = (index >= starts[..., None]) & (index < (starts + lengths)[..., None])  # (B, K, size)
+    ids = torch.where(inside.any(dim=1), inside.int().argmax(dim=1), -1)
+    positions = index - starts.gather(1, ids.clamp(min=0))
+    return ids, torch.where(ids >= 0, positions, 0)
+
+
+@dataclass
+class SequencePacking:
+    """
+    Layout of a packed batch. lengths is (B, K, 3): the latent, clip and sync tokens of each of the K segment slots
+    of each row; sizes and gaps are the length of each stream and the gap after each segment, in the same order.
+    """
+    lengths: torch.Tensor
+    sizes: tuple[int, int, int]
+    gaps: tuple[int, int, int]
+    ids: dict = field(init=False)
+    positions: dict = field(init=False)
+
+    def __post_init__(self):
+        self.ids = {}
+        self.positions = {}
+        for i, stream in enumerate(STREAMS):
+            self.ids[stream], self.positions[stream] = token_layout(self.lengths[..., i], self.gaps[i], self.sizes[i])
+
+    @classmethod
+    def from_metadata(cls, metadata, device=None) -> 'SequencePacking':
+        '''
+        The layout a data.packing.PackingCollator stored in the metadata of each row.
+        '''
+        rows = [info[PACKING_KEY] for info in metadata]
+        lengths = torch.stack([row["lengths"] for row in rows]).to(device)
+        return cls(lengths, tuple(rows[0]["sizes"]), tuple(rows[0]["gaps"]))
+
+    @property
+    def num_segments(self) -> int:
+        return self.lengths.shape[1]
+
+    def segment_lengths(self, stream: str) -> torch.Tensor:
+        return self.lengths[..., STREAMS.index(stream)]
+
+    def segment_starts(self, stream: str) -> torch.Tensor:
+        i = STREAMS.index(stream)
+        return segment_starts(self.lengths[..., i], self.gaps[i])
+
+    def keep(self, stream: str) -> torch.Tensor:
+        '''
+        (B, N, 1) mask of the tokens of stream that belong to a segment.
+        '''
+        return (self.ids[stream] >= 0).unsqueeze(-1)
+
+    def text_ids(self, tokens_per_segment: int) -> torch.Tensor:
+        # Text features are per segment, K blocks of tokens_per_segment tokens; unused slots belong to no segment
+        slots = torch.arange(self.num_segments, device=self.lengths.device)
+        ids = torch.where(self.segment_lengths("latent") > 0, slots, -1)
+        return ids.repeat_interleave(tokens_per_segment, dim=1)
+
+    def to_tokens(self, values: torch.Tensor, ids: torch.Tensor) -> torch.Tensor:
+        '''
+        Per-segment values (B, K, ...) to per-token values (B, N, ...) for tokens with segment ids (B, N).
+        Tokens outside any segment get the values of segment 0.
+        '''
+        index = ids.clamp(min=0)
+        index = index.view(*index.shape, *([1] * (values.dim() - 2))).expand(-1, -1, *values.shape[2:])
+        return values.gather(1, index)
+
+    def segment_mean(self, x: torch.Tensor, stream: str) -> torch.Tensor:
+        # (B, N, D) tokens -> (B, K, D) mean over the tokens of each segment (0 for unused slots)
+        ids = self.ids[stream]
+        keep = (ids >= 0).unsqueeze(-1)
+        index = ids.clamp(min=0).unsqueeze(-1).expand_as(x)
+        total = x.new_zeros(x.shape[0], self.num_segments, x.shape[-1]).scatter_add_(1, index, torch.where(keep, x, 0))
+        count = self.segment_lengths(stream).clamp(min=1).unsqueeze(-1).to(x.dtype)
+        return total / count
+
+    def resample_index(self, source: str, target: str) -> torch.Tensor:
+        '''
+        (B, N) index into the source stream of the nearest-exact source token for each target token,
+        as F.interpolate(mode='nearest-exact') resamples each segment on its own.
+        '''
+        ids = self.ids[target]
+        source_lengths = self.to_tokens(self.segment_lengths(source), ids)
+        target_lengths = self.to_tokens(self.segment_lengths(target), ids).clamp(min=1)
+        scale = source_lengths.float() / target_lengths.float()
+        index = torch.floor((self.positions[target].float() + 0.5) * scale).long()
+        index = torch.minimum(index, (source_lengths - 1).clamp(min=0))
+        return index + self.to_tokens(self.segment_starts(source), ids)
+
+    @staticmethod
+    def attention_mask(q_ids: torch.Tensor, k_ids: torch.Tensor) -> torch.Tensor:
+        '''
+        (B, 1, Nq, Nk) block-diagonal mask: tokens attend within their segment.
+        Tokens outside any segment attend to everything, so no row of the mask is empty; nothing attends to them.
+        '''
+        mask = (q_ids[:, :, None] == k_ids[:, None, :]) & (k_ids >= 0)[:, None, :]
+        return (mask | (q_ids < 0)[:, :, None]).unsqueeze(1)
+
+
+def mask_tokens(x: torch.Tensor, keep: Optional[torch.Tensor]) -> torch.Tensor:
+    # Zero the tokens outside any segment, e.g. before a conv, so it sees the zero padding of an unpacked sequence
+    return x if keep is None else torch.where(keep, x, 0)
@@ -1,7 +1,9 @@
 import json
 
+import torch
+
 from .factory import create_model_from_config
-from .utils import load_ckpt_state_dict
+from .utils import load_state_dict_lazy
 
 from huggingface_hub import hf_hub_download
 
@@ -12,7 +14,9 @@ def get_pretrained_model(name: str):
     with open(model_config_path) as f:
         model_config = json.load(f)
 
-    model = create_model_from_config(model_config)
+    # Built on the meta device, which skips random initialisation; the weights come from the checkpoint
+    with torch.device("meta"):
+        model = create_model_from_config(model_config)
 
     # Try to download the model.safetensors file first, if it doesn't exist, download the model.ckpt file
     try:
@@ -20,6 +24,9 @@ def get_pretrained_model(name: str):
     except Exception as e:
         model_ckpt_path = hf_hub_download(name, filename="model.ckpt", repo_type='model')
 
-    model.load_state_dict(load_ckpt_state_dict(model_ckpt_path))
+    # Copied in one tensor at a time from the memory-mapped checkpoint
+    load_state_dict_lazy(model, model_ckpt_path)
+    unloaded = [name for name, tensor in [*model.named_parameters(), *model.named_buffers()] if tensor.is_meta]
+    assert not unloaded, f"Not loaded from the checkpoint: {unloaded}"
 
     return model, model_config
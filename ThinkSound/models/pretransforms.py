@@ -2,6 +2,8 @@ import torch
 from einops import rearrange
 from torch import nn
 
+from .vae_chunking import default_chunk_settings
+
 class Pretransform(nn.Module):
     def __init__(self, enable_grad, io_channels, is_discrete):
         super().__init__()
@@ -26,7 +28,7 @@ class Pretransform(nn.Module):
         raise NotImplementedError
 
 class AutoencoderPretransform(Pretransform):
-    def __init__(self, model, scale=1.0, model_half=False, iterate_batch=False, chunked=False):
+    def __init__(self, model, scale=1.0, model_half=False, iterate_batch=False, chunked=False, chunk_memory_mb=None, chunk_size=None, overlap=None, model_config=None):
         super().__init__(enable_grad=False, io_channels=model.io_channels, is_discrete=model.bottleneck is not None and model.bottleneck.is_discrete)
         self.model = model
         self.model.requires_grad_(False).eval()
@@ -41,11 +43,41 @@ class AutoencoderPretransform(Pretransform):
         self.encoded_channels = model.latent_dim
 
         self.chunked = chunked
+        self.chunk_memory_mb = chunk_memory_mb
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        # Autoencoder config, used to look up the receptive field and tuned chunk settings
+        self.model_config = model_config
+        self._chunk_settings = {}
         self.num_quantizers = model.bottleneck.num_quantizers if model.bottleneck is not None and model.bottleneck.is_discrete else None
         self.codebook_size = model.bottleneck.codebook_size if model.bottleneck is not None and model.bottleneck.is_discrete else None
 
         if self.model_half:
             self.model.half()
+
+    def inference_mode(self):
+        self.model.inference_mode()
+        return self
+
+    def chunk_settings(self, device):
+        '''
+        chunk_size and overlap for chunked encode/decode on device.
+        Explicitly configured values win, then settings tuned with vae_chunking.tune_chunking,
+        then a chunk_size of 128 with the receptive-field overlap.
+        '''
+        key = str(device)
+        if key not in self._chunk_settings:
+            if self.model_config is not None:
+                settings = dict(default_chunk_settings(self.model_config, device))
+            else:
+                settings = {"chunk_size": 128, "overlap": 32}
+            if self.chunk_size is not None:
+                settings["chunk_size"] = self.chunk_size
+            if self.overlap is not None:
+                settings["overlap"] = self.overlap
+            self._chunk_settings[key] = settings
+
+        return self._chunk_settings[key]
     
     def encode(self, x, **kwargs):
         
@@ -53,7 +85,10 @@ class AutoencoderPretransform(Pretransform):
             x = x.half()
             self.model.to(torch.float16)
 
-        encoded = self.model.encode_audio(x, chunked=self.chunked, iterate_batch=self.iterate_batch, **kwargs)
+        if self.chunked:
+            kwargs = {**self.chunk_settings(x.device), **kwargs}
+
+        encoded = self.model.encode_audio(x, chunked=self.chunked, chunk_memory_mb=self.chunk_memory_mb, iterate_batch=self.iterate_batch, **kwargs)
 
         if self.model_half:
             encoded = encoded.float()
@@ -67,13 +102,31 @@ class AutoencoderPretransform(Pretransform):
             z = z.half()
             self.model.to(torch.float16)
 
-        decoded = self.model.decode_audio(z, chunked=self.chunked, iterate_batch=self.iterate_batch, **kwargs)
+        if self.chunked:
+            kwargs = {**self.chunk_settings(z.device), **kwargs}
+
+        decoded = self.model.decode_audio(z, chunked=self.chunked, chunk_memory_mb=self.chunk_memory_mb, iterate_batch=self.iterate_batch, **kwargs)
 
         if self.model_half:
             decoded = decoded.float()
 
         return decoded
-    
+
+    def decode_stream(self, z, **kwargs):
+        z = z * self.scale
+
+        if self.model_half:
+            z = z.half()
+            self.model.to(torch.float16)
+
+        kwargs = {**self.chunk_settings(z.device), **kwargs}
+
+        for decoded in self.model.decode_audio_stream(z, **kwargs):
+            if self.model_half:
+                decoded = decoded.float()
+
+            yield decoded
+
     def tokenize(self, x, **kwargs):
         assert self.model.is_discrete, "Cannot tokenize with a continuous model"
 
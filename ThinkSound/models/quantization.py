@@ -0,0 +1,219 @@
+import json
+import time
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from .blocks import ChannelLastConv1d, channel_last_unfold
+
+# Quantized inference for MMmodule on CPU. All modes store weights as symmetric integers with one scale per output channel.
+# "dynamic_int8": activations are quantized per token at run time and multiplied with the int8 weights in int32 (torch._int_mm)
+# "int8", "int4": weight-only; weights are dequantized to the activation dtype for each matmul, which mostly saves memory
+# "dynamic_int8" and "int8" store the same tensors, so a checkpoint quantized for one runs in the other.
+
+QUANT_MODES = ("dynamic_int8", "int8", "int4")
+
+def _bits(mode):
+    assert mode in QUANT_MODES, f"Unknown quantization mode {mode}, expected one of {QUANT_MODES}"
+    return 4 if mode == "int4" else 8
+
+def quantize_weight(weight, bits=8):
+    '''
+    (out, in) float weight -> integer weight and (out,) float32 scales.
+    int4 weights are packed two per byte along in, low nibble first, as uint8.
+    '''
+    weight = weight.detach().float()
+    qmax = 2 ** (bits - 1) - 1
+    scale = weight.abs().amax(dim=1).clamp(min=1e-8) / qmax
+    qweight = torch.round(weight / scale[:, None]).clamp(-qmax, qmax).to(torch.int8)
+
+    if bits == 4:
+        if qweight.shape[1] % 2:
+            qweight = F.pad(qweight, (0, 1))
+        qweight = ((qweight[:, 0::2] & 0xF) | (qweight[:, 1::2] << 4)).view(torch.uint8)
+
+    return qweight, scale
+
+def dequantize_weight(qweight, scale, in_features, dtype=torch.float32):
+    if qweight.dtype == torch.uint8:
+        # Sign-extend both nibbles: shift each into the high half of an int8, then arithmetic-shift back
+        packed = qweight.view(torch.int8)
+        low = (packed << 4) >> 4
+        high = packed >> 4
+        qweight = torch.stack([low, high], dim=-1).flatten(1)[:, :in_features]
+    return (qweight.to(dtype) * scale[:, None].to(dtype))
+
+def int8_linear(x, qweight, scale, bias=None):
+    '''
+    F.linear with int8 weights and dynamically quantized int8 activations, one scale per token.
+    '''
+    shape = x.shape
+    x = x.reshape(-1, shape[-1]).float()
+    x_scale = x.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+    x_q = torch.round(x / x_scale).to(torch.int8)
+
+    out = torch._int_mm(x_q, qweight.t()).float()
+    out.mul_(x_scale).mul_(scale)
+    if bias is not None:
+        out.add_(bias)
+    return out.view(*shape[:-1], -1)
+
+class QuantizedLinear(nn.Module):
+    '''
+    Quantized replacement for an nn.Linear, or for a ChannelLastConv1d computed as a matmul over its windows.
+    With quantize=False the integer weights are left uninitialised, to be filled from a pre-quantized state dict.
+    '''
+    def __init__(self, module, mode="dynamic_int8", quantize=True):
+        super().__init__()
+        self.mode = mode
+        bits = _bits(mode)
+
+        weight = module.weight.flatten(1)
+        self.out_features, self.in_features = weight.shape
+        self.unfold_args = module.unfold_args if isinstance(module, ChannelLastConv1d) else None
+
+        if quantize:
+            qweight, scale = quantize_weight(weight, bits)
+        else:
+            packed_features = (self.in_features + 1) // 2 if bits == 4 else self.in_features
+            qweight = torch.empty(self.out_features, packed_features, dtype=torch.uint8 if bits == 4 else torch.int8, device=weight.device)
+            scale = torch.empty(self.out_features, device=weight.device)
+
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("weight_scale", scale)
+
+        if module.bias is not None:
+            self.bias = nn.Parameter(module.bias.detach().clone(), requires_grad=False)
+        else:
+            self.bias = None
+
+    def dequantize(self, dtype=torch.float32):
+        return dequantize_weight(self.qweight, self.weight_scale, self.in_features, dtype)
+
+    def forward(self, x):
+        if self.unfold_args is not None:
+            x = channel_last_unfold(x, *self.unfold_args)
+
+        if self.mode == "dynamic_int8" and x.device.type == "cpu":
+            return int8_linear(x, self.qweight, self.weight_scale, self.bias).to(x.dtype)
+
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, mode={self.mode}"
+
+def _quantizable(module):
+    if isinstance(module, ChannelLastConv1d):
+        return module.unfold_args is not None
+    return type(module) is nn.Linear
+
+def quantize_model(model, mode="dynamic_int8", quantize=True):
+    '''
+    Replace every nn.Linear and matmul-computable ChannelLastConv1d in model with a QuantizedLinear, in place.
+    Already quantized layers are switched to mode if it stores the same weights.
+    '''
+    for name, module in list(model.named_modules()):
+        for child_name, child in module.named_children():
+            if isinstance(child, QuantizedLinear):
+                assert _bits(child.mode) == _bits(mode), f"{name}.{child_name} is already quantized to {child.mode}"
+                child.mode = mode
+            elif _quantizable(child):
+                setattr(module, child_name, QuantizedLinear(child, mode, quantize=quantize))
+    return model
+
+def quantized_mode(state_dict, metadata=None):
+    '''
+    Mode a pre-quantized state dict (or LazyCheckpoint) was saved in, or None if it is not quantized.
+    The mode is read from the "quantization" entry save_quantized writes to the safetensors metadata;
+    without it, int4 or dynamic_int8 is inferred from the weight dtype.
+    '''
+    qweight_key = next((key for key in state_dict.keys() if key.endswith("qweight")), None)
+    if qweight_key is None:
+        return None
+    mode = (metadata or {}).get("quantization")
+    if mode in QUANT_MODES:
+        return mode
+    return "int4" if state_dict[qweight_key].dtype == torch.uint8 else "dynamic_int8"
+
+def save_quantized(model, path, mode):
+    from safetensors.torch import save_file
+    state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+    save_file(state_dict, path, metadata={"quantization": mode})
+
+# Calibration / evaluation
+
+@torch.no_grad()
+def evaluate_quantization(model, quantized_model, inputs, cfg_scale=5.0, repeats=1):
+    '''
+    Flow-prediction error of quantized_model against model on inputs (a list of MMmodule.forward kwargs),
+    relative to the RMS of the reference flow, and the time per forward of each.
+    '''
+    errors, max_errors = [], []
+    times = {"reference": 0.0, "quantized": 0.0}
+    for kwargs in inputs:
+        kwargs = {"cfg_scale": cfg_scale, "cfg_dropout_prob": 0.0, "scale_phi": 0.0, **kwargs}
+        for name, m in (("reference", model), ("quantized", quantized_model)):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                out = m(**kwargs)
+            times[name] += (time.perf_counter() - start) / repeats
+            if name == "reference":
+                reference = out
+        diff = (out.float() - reference.float())
+        rms = reference.float().pow(2).mean().sqrt()
+        errors.append((diff.pow(2).mean().sqrt() / rms).item())
+        max_errors.append((diff.abs().max() / rms).item())
+
+    return {
+        "relative_rms_error": sum(errors) / len(errors),
+        "relative_max_error": max(max_errors),
+        "reference_seconds": times["reference"] / len(inputs),
+        "quantized_seconds": times["quantized"] / len(inputs),
+    }
+
+if __name__ == "__main__":
+    import argparse
+    import copy
+
+    from .mmdit import MMmodule, sample_inputs
+
+    parser = argparse.ArgumentParser(description="Quantize the MMDiT of a ThinkSound checkpoint and report its flow error against fp32")
+    parser.add_argument("--model-config", required=True)
+    parser.add_argument("--ckpt-path", required=True)
+    parser.add_argument("--modes", nargs="+", default=list(QUANT_MODES), choices=QUANT_MODES)
+    parser.add_argument("--conditions", default=None, help="torch.save'd list of MMmodule.forward kwargs to evaluate on; random inputs if not given")
+    parser.add_argument("--num-samples", type=int, default=4)
+    parser.add_argument("--cfg-scale", type=float, default=5.0)
+    parser.add_argument("--save-dir", default=None, help="Write <save-dir>/mmdit_<mode>.safetensors for each mode")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    with open(args.model_config) as f:
+        model_config = json.load(f)
+
+    model = MMmodule.from_checkpoint(args.ckpt_path, **model_config["model"]["diffusion"]["config"]).eval()
+
+    if args.conditions is not None:
+        inputs = torch.load(args.conditions)
+    else:
+        generator = torch.Generator().manual_seed(0)
+        inputs = [sample_inputs(model, generator=generator) for _ in range(args.num_samples)]
+
+    results = {}
+    for mode in args.modes:
+        # MMmodule.quantize, so the saved checkpoint has the layout from_checkpoint and load_weights expect
+        quantized = copy.deepcopy(model).quantize(mode)
+        results[mode] = evaluate_quantization(model, quantized, inputs, cfg_scale=args.cfg_scale)
+        print(f"{mode}: {results[mode]}")
+        if args.save_dir is not None:
+            import os
+            os.makedirs(args.save_dir, exist_ok=True)
+            save_quantized(quantized, os.path.join(args.save_dir, f"mmdit_{mode}.safetensors"), mode)
+        del quantized
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,189 @@
+import contextlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+# Keeps the sub-models of a pipeline (conditioners, DiT, VAE) on the compute device only while they are needed.
+# Each registered entry is loaded just in time; when loading it would exceed the memory budget, the least recently
+# used entries that are not in use are offloaded, either to CPU memory or to a file on disk that is memory-mapped back.
+
+log = logging.getLogger()
+
+OFFLOAD_MODES = ("cpu", "disk")
+
+def module_bytes(modules):
+    # Parameters and buffers shared between modules are only counted once
+    tensors = {}
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            tensors[id(tensor)] = tensor
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+def _state_dict_modules(module):
+    # Conditioners keep frozen encoders in __dict__ so they stay out of the state dict; they still take memory
+    modules = [module]
+    for m in module.modules():
+        hidden = m.__dict__.get("model")
+        if isinstance(hidden, nn.Module) and all(hidden is not other for other in modules):
+            modules.append(hidden)
+    return modules
+
+class ResidencyManager:
+    '''
+    Tracks which registered modules are on device and moves them there on demand.
+    budget_bytes caps the memory of the resident modules (None: no cap, offload only when asked).
+    offload is "cpu" (pinned host memory when device is CUDA) or "disk" (written once to offload_dir
+    and memory-mapped back, so offloaded weights only use page cache). Disk offload is meant for frozen
+    inference weights: an entry is only written the first time it is offloaded.
+    '''
+    def __init__(self, device="cuda", budget_bytes=None, offload="cpu", offload_dir=None):
+        assert offload in OFFLOAD_MODES, f"Unknown offload mode {offload}, expected one of {OFFLOAD_MODES}"
+        assert offload != "disk" or offload_dir is not None, "Disk offload needs an offload_dir"
+        self.device = torch.device(device)
+        if self.device.type == "cuda" and self.device.index is None and torch.cuda.is_available():
+            # Tensors report their device with an index, which never compares equal to a bare "cuda"
+            self.device = torch.device("cuda", torch.cuda.current_device())
+        self.budget_bytes = budget_bytes
+        self.offload_mode = offload
+        self.offload_dir = offload_dir
+
+        self._modules = {}
+        self._bytes = {}
+        # name -> bytes, least recently used first
+        self._resident = OrderedDict()
+        self._in_use = {}
+        # Conditioners may load themselves from several threads at once (MultiConditioner num_workers)
+        self._lock = threading.RLock()
+
+    def register(self, name, module):
+        '''
+        Manage module (and any encoders its submodules keep outside the module tree) as name.
+        Modules already on device count as resident.
+        '''
+        assert name not in self._modules, f"{name} is already registered"
+        modules = _state_dict_modules(module)
+        self._modules[name] = modules
+        self._bytes[name] = module_bytes(modules)
+        self._in_use[name] = 0
+
+        if any(t.device == self.device for m in modules for t in m.parameters()):
+            self._resident[name] = self._bytes[name]
+
+        for m in module.modules():
+            if hasattr(m, "residency"):
+                m.residency = self
+                m.residency_name = name
+        return module
+
+    def attach(self, model):
+        '''
+        Register the conditioners, diffusion model and pretransform of a conditioned diffusion model wrapper
+        as "conditioner.<id>", "dit" and "pretransform", and make generation go through this manager.
+        '''
+        if getattr(model, "conditioner", None) is not None:
+            for key, conditioner in model.conditioner.conditioners.items():
+                self.register(f"conditioner.{key}", conditioner)
+        self.register("dit", model.model)
+        if getattr(model, "pretransform", None) is not None:
+            self.register("pretransform", model.pretransform)
+        model.residency = self
+        return model
+
+    def names(self, prefix=""):
+        return [name for name in self._modules if name.startswith(prefix)]
+
+    def is_resident(self, name):
+        return name in self._resident
+
+    def resident_bytes(self):
+        return sum(self._resident.values())
+
+    def _move(self, name, device):
+        pin = device.type == "cpu" and self.device.type == "cuda"
+        for module in self._modules[name]:
+            module.to(device, non_blocking=device.type == "cuda")
+            if pin:
+                for tensor in list(module.parameters()) + list(module.buffers()):
+                    tensor.data = tensor.data.pin_memory()
+
+    def _offload_to_disk(self, name):
+        for i, module in enumerate(self._modules[name]):
+            path = os.path.join(self.offload_dir, f"{name}.{i}.pt")
+            if not os.path.exists(path):
+                os.makedirs(self.offload_dir, exist_ok=True)
+                state_dict = {k: v.to("cpu") for k, v in module.state_dict(keep_vars=False).items()}
+                tmp_path = f"{path}.tmp"
+                torch.save(state_dict, tmp_path)
+                os.replace(tmp_path, path)
+                del state_dict
+            module.load_state_dict(torch.load(path, map_location="cpu", mmap=True, weights_only=True), assign=True)
+
+    def offload(self, name):
+        with self._lock:
+            assert self._in_use[name] == 0, f"{name} is in use and cannot be offloaded"
+            if name not in self._resident:
+                return
+            if self.offload_mode == "disk":
+                self._offload_to_disk(name)
+            else:
+                self._move(name, torch.device("cpu"))
+            del self._resident[name]
+        log.debug(f"Offloaded {name} ({self._bytes[name] / 2**20:.0f} MiB) to {self.offload_mode}")
+
+    def _make_room(self, num_bytes):
+        if self.budget_bytes is None:
+            return
+        freed = False
+        for name in list(self._resident):
+            if self.resident_bytes() + num_bytes <= self.budget_bytes:
+                break
+            if self._in_use[name] == 0:
+                self.offload(name)
+                freed = True
+        if self.resident_bytes() + num_bytes > self.budget_bytes:
+            log.warning(f"Loading {num_bytes / 2**20:.0f} MiB exceeds the residency budget of {self.budget_bytes / 2**20:.0f} MiB")
+        if freed and self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def load(self, name):
+        '''
+        Make name resident on device, offloading least recently used entries to stay within the budget.
+        Returns the registered module.
+        '''
+        with self._lock:
+            if name in self._resident:
+                self._resident.move_to_end(name)
+            else:
+                self._make_room(self._bytes[name])
+                self._move(name, self.device)
+                self._resident[name] = self._bytes[name]
+        return self._modules[name][0]
+
+    @contextlib.contextmanager
+    def use(self, *names):
+        '''
+        Load names and keep them from being offloaded for the duration of the block.
+        They stay resident afterwards until something else needs the room.
+        '''
+        with self._lock:
+            for name in names:
+                self._in_use[name] += 1
+        try:
+            for name in names:
+                self.load(name)
+            yield
+        finally:
+            with self._lock:
+                for name in names:
+                    self._in_use[name] -= 1
+
+    def offload_all(self):
+        for name in list(self._resident):
+            if self._in_use[name] == 0:
+                self.offload(name)
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
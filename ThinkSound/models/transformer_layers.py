@@ -1,47 +1,57 @@
+import time
 from typing import Optional
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
-from einops.layers.torch import Rearrange
 
-from .embeddings import apply_rope
+from .attention_backends import attention
+from .embeddings import apply_rope_qk
+from .packing import mask_tokens
 from .blocks import MLP, ChannelLastConv1d, ConvMLP
-try:
-    from flash_attn import flash_attn_func, flash_attn_kvpacked_func
-    print('flash_attn installed, using Flash Attention')
-except ImportError as e:
-    print(e)
-    print('flash_attn not installed, disabling Flash Attention')
-    flash_attn_kvpacked_func = None
-    flash_attn_func = None
+
 
 def modulate(x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor):
     return x * (1 + scale) + shift
 
 
-def attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
-    # training will crash without these contiguous calls and the CUDNN limitation
-    # I believe this is related to https://github.com/pytorch/pytorch/issues/133974
-    # unresolved at the time of writing
-    fa_dtype_in = q.dtype
-
-    q = q.contiguous()
-    k = k.contiguous()
-    v = v.contiguous()
-    out = F.scaled_dot_product_attention(q, k, v)
-    out = rearrange(out, 'b h n d -> b n (h d)').contiguous()
-    return out
-    q, k, v = map(lambda t: rearrange(t, 'b h n d -> b n h d').to(torch.bfloat16), (q, k, v))
-    # print(f"q dtype: {q.dtype}")
-    # print(f"k dtype: {k.dtype}")
-    # print(f"v dtype: {v.dtype}")
-    # breakpoint()
-    out = flash_attn_func(q, k, v)
-    out = rearrange(out.to(fa_dtype_in), 'b n h d -> b n (h d)')
-    # out = rearrange(out.to(fa_dtype_in), 'b h n d -> b n (h d)').contiguous()
-    return out
+# False runs norm_modulate/gated_residual as the plain unfused ops, e.g. to benchmark them
+fuse_modulate = True
+
+
+def _needs_grad(*tensors: torch.Tensor) -> bool:
+    return torch.is_grad_enabled() and any(t.requires_grad for t in tensors)
+
+
+def norm_modulate(norm: nn.LayerNorm, x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor):
+    # modulate(norm(x), shift, scale) as layer_norm + one addcmul, written over the normalized x
+    # when autograd does not need it. torch.compile fuses both into one kernel.
+    if not fuse_modulate:
+        return modulate(norm(x), shift, scale)
+    x = F.layer_norm(x, norm.normalized_shape, norm.weight, norm.bias, norm.eps)
+    if _needs_grad(x, shift, scale):
+        return torch.addcmul(shift, x, 1 + scale)
+    return torch.addcmul(shift, x, 1 + scale, out=x)
+
+
+def gated_residual(x: torch.Tensor, y: torch.Tensor, gate: torch.Tensor, inplace: bool = False):
+    # x + y * gate in one kernel. inplace=True overwrites x, which the caller must own,
+    # whenever autograd does not need it.
+    if not fuse_modulate:
+        return x + y * gate
+    if inplace and not _needs_grad(x, y, gate):
+        return x.addcmul_(y, gate)
+    return torch.addcmul(x, y, gate)
+
+
+def _attention_dtype(x: torch.Tensor, linear: nn.Module) -> torch.dtype:
+    # dtype the q/k/v projection produces, which is what attention runs in.
+    # Quantized projections have no float weight and return the input dtype.
+    if torch.is_autocast_enabled(x.device.type):
+        return torch.get_autocast_dtype(x.device.type)
+    weight = getattr(linear, "weight", None)
+    return weight.dtype if isinstance(weight, torch.Tensor) else x.dtype
 
 
 class SelfAttention(nn.Module):
@@ -55,28 +65,34 @@ class SelfAttention(nn.Module):
         self.q_norm = nn.RMSNorm(dim // nheads)
         self.k_norm = nn.RMSNorm(dim // nheads)
 
-        self.split_into_heads = Rearrange('b n (h d j) -> b h n d j',
-                                          h=nheads,
-                                          d=dim // nheads,
-                                          j=3)
-
     def pre_attention(
             self, x: torch.Tensor,
-            rot: Optional[torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+            rot: Optional[torch.Tensor],
+            out: Optional[torch.Tensor] = None) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         # x: batch_size * n_tokens * n_channels
+        # out: optional 3 * batch_size * n_heads * n_tokens * head_dim buffer, e.g. a token slice
+        # of a joint attention buffer; q, k and v are written into it in place
         qkv = self.qkv(x)
-        q, k, v = self.split_into_heads(qkv).chunk(3, dim=-1)
-        q = q.squeeze(-1)
-        k = k.squeeze(-1)
-        v = v.squeeze(-1)
+        # b n (h d j) -> j b h n d, as a view
+        q, k, v = qkv.view(*qkv.shape[:2], self.nheads, -1, 3).permute(4, 0, 2, 1, 3).unbind(0)
         q = self.q_norm(q)
         k = self.k_norm(k)
 
+        if out is None:
+            if rot is not None:
+                q, k = apply_rope_qk(q, k, rot)
+            return q, k, v
+
+        # index out only when writing: views taken before an earlier in-place write
+        # would not see its autograd history
         if rot is not None:
-            q = apply_rope(q, rot)
-            k = apply_rope(k, rot)
+            apply_rope_qk(q, k, rot, out=out[:2])
+        else:
+            out[0].copy_(q)
+            out[1].copy_(k)
+        out[2].copy_(v)
 
-        return q, k, v
+        return out[0], out[1], out[2]
 
     def forward(
             self,
@@ -98,25 +114,15 @@ class CrossAttention(nn.Module):
         self.q_norm = nn.RMSNorm(dim // nheads)
         self.k_norm = nn.RMSNorm(dim // nheads)
 
-        self.split_q_into_heads = Rearrange('b n (h d) -> b h n d',
-                                          h=nheads,
-                                          d=dim // nheads)
-        self.split_kv_into_heads = Rearrange('b n (h d j) -> b h n d j',
-                                          h=nheads,
-                                          d=dim // nheads,
-                                          j=2)
-
     def pre_attention(
             self, x: torch.Tensor,
             context: Optional[torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         # x: batch_size * n_tokens * n_channels
         q = self.to_q(x)
         kv = self.to_kv(context)
-        q = self.split_q_into_heads(q)
-        k, v = self.split_kv_into_heads(kv).chunk(2, dim=-1)
-        q = q.squeeze(-1)
-        k = k.squeeze(-1)
-        v = v.squeeze(-1)
+        # b n (h d) -> b h n d and b n (h d j) -> j b h n d, as views
+        q = q.view(*q.shape[:2], self.nheads, -1).transpose(1, 2)
+        k, v = kv.view(*kv.shape[:2], self.nheads, -1, 2).permute(4, 0, 2, 1, 3).unbind(0)
         q = self.q_norm(q)
         k = self.k_norm(k)
 
@@ -125,10 +131,10 @@ class CrossAttention(nn.Module):
 
     def forward(
             self,
-            x: torch.Tensor, context=None
+            x: torch.Tensor, context=None, mask: Optional[torch.Tensor] = None
     ) -> torch.Tensor:
         q, v, k = self.pre_attention(x, context=context)
-        out = attention(q, k, v)
+        out = attention(q, k, v, mask=mask)
         return out
 
 
@@ -167,9 +173,11 @@ class MMDitSingleBlock(nn.Module):
 
             self.adaLN_modulation = nn.Sequential(nn.SiLU(), nn.Linear(dim, 6 * dim, bias=True))
 
-    def pre_attention(self, x: torch.Tensor, c: torch.Tensor, rot: Optional[torch.Tensor]):
+    def pre_attention(self, x: torch.Tensor, c: torch.Tensor, rot: Optional[torch.Tensor],
+                      out: Optional[torch.Tensor] = None):
         # x: BS * N * D
         # cond: BS * D
+        # out: optional q/k/v buffer for SelfAttention.pre_attention
         modulation = self.adaLN_modulation(c)
         if self.pre_only:
             (shift_msa, scale_msa) = modulation.chunk(2, dim=-1)
@@ -178,32 +186,38 @@ class MMDitSingleBlock(nn.Module):
             (shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp,
              gate_mlp) = modulation.chunk(6, dim=-1)
 
-        x = modulate(self.norm1(x), shift_msa, scale_msa)
-        q, k, v = self.attn.pre_attention(x, rot)
+        x = norm_modulate(self.norm1, x, shift_msa, scale_msa)
+        q, k, v = self.attn.pre_attention(x, rot, out=out)
         return (q, k, v), (gate_msa, shift_mlp, scale_mlp, gate_mlp)
 
-    def post_attention(self, x: torch.Tensor, attn_out: torch.Tensor, c: tuple[torch.Tensor], context=None):
+    def post_attention(self, x: torch.Tensor, attn_out: torch.Tensor, c: tuple[torch.Tensor], context=None,
+                       keep: Optional[torch.Tensor] = None, context_mask: Optional[torch.Tensor] = None):
+        # keep: optional (B, N, 1) mask of the tokens of a packed sequence that belong to a segment
         if self.pre_only:
             return x
 
         (gate_msa, shift_mlp, scale_mlp, gate_mlp) = c
-        x = x + self.linear1(attn_out) * gate_msa
+        # x belongs to the caller, but every later residual can update the new x in place
+        x = gated_residual(x, self.linear1(mask_tokens(attn_out, keep)), gate_msa)
         
         if context is not None:
-            x = x + self.cross_attn(x, context=context)
+            cross_out = self.cross_attn(x, context=context, mask=context_mask)
+            x = x.add_(cross_out) if not _needs_grad(x, cross_out) else x + cross_out
 
-        r = modulate(self.norm2(x), shift_mlp, scale_mlp)
-        x = x + self.ffn(r) * gate_mlp
+        r = norm_modulate(self.norm2, x, shift_mlp, scale_mlp)
+        x = gated_residual(x, self.ffn(r, keep), gate_mlp, inplace=True)
 
         return x
 
     def forward(self, x: torch.Tensor, cond: torch.Tensor,
-                rot: Optional[torch.Tensor], context: torch.Tensor = None) -> torch.Tensor:
+                rot: Optional[torch.Tensor], context: torch.Tensor = None, attn_mask: Optional[torch.Tensor] = None,
+                keep: Optional[torch.Tensor] = None, context_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         # x: BS * N * D
         # cond: BS * D
+        # attn_mask, keep, context_mask: packed sequences only, see packing.SequencePacking
         x_qkv, x_conditions = self.pre_attention(x, cond, rot)
-        attn_out = attention(*x_qkv)
-        x = self.post_attention(x, attn_out, x_conditions, context = context)
+        attn_out = attention(*x_qkv, mask=attn_mask)
+        x = self.post_attention(x, attn_out, x_conditions, context = context, keep=keep, context_mask=context_mask)
 
         return x
 
@@ -229,28 +243,37 @@ class JointBlock(nn.Module):
 
     def forward(self, latent: torch.Tensor, clip_f: torch.Tensor, text_f: torch.Tensor,
                 global_c: torch.Tensor, extended_c: torch.Tensor, latent_rot: torch.Tensor,
-                clip_rot: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+                clip_rot: torch.Tensor, text_c: Optional[torch.Tensor] = None, attn_mask: Optional[torch.Tensor] = None,
+                latent_keep: Optional[torch.Tensor] = None, clip_keep: Optional[torch.Tensor] = None) -> tuple[torch.Tensor, torch.Tensor]:
         # latent: BS * N1 * D
         # clip_f: BS * N2 * D
         # c: BS * (1/N) * D
-        x_qkv, x_mod = self.latent_block.pre_attention(latent, extended_c, latent_rot)
-        c_qkv, c_mod = self.clip_block.pre_attention(clip_f, global_c, clip_rot)
-        t_qkv, t_mod = self.text_block.pre_attention(text_f, global_c, rot=None)
-
+        # text_c: text stream conditioning when it differs from global_c (per token, for packed sequences)
+        # attn_mask, latent_keep, clip_keep: packed sequences only, see packing.SequencePacking
         latent_len = latent.shape[1]
         clip_len = clip_f.shape[1]
         text_len = text_f.shape[1]
 
-        joint_qkv = [torch.cat([x_qkv[i], c_qkv[i], t_qkv[i]], dim=2) for i in range(3)]
-
-        attn_out = attention(*joint_qkv)
+        # Each stream writes its q, k and v straight into its slice of one joint buffer,
+        # so no concatenation or contiguous copy is needed before attention
+        attn = self.latent_block.attn
+        joint_qkv = latent.new_empty((3, latent.shape[0], attn.nheads, latent_len + clip_len + text_len, attn.dim // attn.nheads),
+                                     dtype=_attention_dtype(latent, attn.qkv))
+        x_qkv, x_mod = self.latent_block.pre_attention(latent, extended_c, latent_rot,
+                                                       out=joint_qkv[:, :, :, :latent_len])
+        c_qkv, c_mod = self.clip_block.pre_attention(clip_f, global_c, clip_rot,
+                                                     out=joint_qkv[:, :, :, latent_len:latent_len + clip_len])
+        t_qkv, t_mod = self.text_block.pre_attention(text_f, global_c if text_c is None else text_c, rot=None,
+                                                     out=joint_qkv[:, :, :, latent_len + clip_len:])
+
+        attn_out = attention(joint_qkv[0], joint_qkv[1], joint_qkv[2], mask=attn_mask)
         x_attn_out = attn_out[:, :latent_len]
         c_attn_out = attn_out[:, latent_len:latent_len + clip_len]
         t_attn_out = attn_out[:, latent_len + clip_len:]
 
-        latent = self.latent_block.post_attention(latent, x_attn_out, x_mod)
+        latent = self.latent_block.post_attention(latent, x_attn_out, x_mod, keep=latent_keep)
         if not self.pre_only:
-            clip_f = self.clip_block.post_attention(clip_f, c_attn_out, c_mod)
+            clip_f = self.clip_block.post_attention(clip_f, c_attn_out, c_mod, keep=clip_keep)
             text_f = self.text_block.post_attention(text_f, t_attn_out, t_mod)
 
         return latent, clip_f, text_f
@@ -264,8 +287,45 @@ class FinalBlock(nn.Module):
         self.norm = nn.LayerNorm(dim, elementwise_affine=False)
         self.conv = ChannelLastConv1d(dim, out_dim, kernel_size=7, padding=3)
 
-    def forward(self, latent, c):
+    def forward(self, latent, c, keep=None):
         shift, scale = self.adaLN_modulation(c).chunk(2, dim=-1)
-        latent = modulate(self.norm(latent), shift, scale)
-        latent = self.conv(latent)
+        latent = norm_modulate(self.norm, latent, shift, scale)
+        latent = self.conv(mask_tokens(latent, keep))
         return latent
+
+
+def benchmark_single_block(dim=1024, nhead=16, seq_len=256, batch_size=2, kernel_size=3, padding=1,
+                           dtype=torch.float32, device="cpu", repeats=10, backward=False):
+    '''
+    Time MMDitSingleBlock.forward (and backward, if backward is True) with the fused
+    norm-modulate/gated-residual ops against the unfused ones. Returns {"fused": s, "unfused": s} per call.
+    '''
+    global fuse_modulate
+    device = torch.device(device)
+    block = MMDitSingleBlock(dim, nhead, kernel_size=kernel_size, padding=padding).to(device, dtype)
+    x = torch.randn(batch_size, seq_len, dim, device=device, dtype=dtype, requires_grad=backward)
+    c = torch.randn(batch_size, 1, dim, device=device, dtype=dtype)
+
+    def step():
+        with torch.set_grad_enabled(backward):
+            out = block(x, c, rot=None)
+        if backward:
+            out.sum().backward()
+
+    timings = {}
+    fused = fuse_modulate
+    try:
+        for name, fuse in (("unfused", False), ("fused", True)):
+            fuse_modulate = fuse
+            step()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                step()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            timings[name] = (time.perf_counter() - start) / repeats
+    finally:
+        fuse_modulate = fused
+    return timings
@@ -1,24 +1,135 @@
+import json
+import os
+
 import torch
-from safetensors.torch import load_file
+from safetensors import safe_open
 from torch import nn, Tensor, einsum, IntTensor, FloatTensor, BoolTensor
 #from torchcubicspline import natural_cubic_spline_coeffs, NaturalCubicSpline
 from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize
+from torch.nn.utils.parametrizations import _WeightNorm
+from torch.nn.utils.weight_norm import WeightNorm
 
-def load_ckpt_state_dict(ckpt_path, prefix=None):
+def _open_checkpoint(ckpt_path, device="cpu"):
+    # (keys, tensor getter, safetensors metadata) for a .safetensors or torch checkpoint
     if ckpt_path.endswith(".safetensors"):
-        state_dict = load_file(ckpt_path)
-    else:
-        state_dict = torch.load(ckpt_path, map_location="cpu")["state_dict"]
-
-    # 过滤特定前缀的state_dict
-    filtered_state_dict = {k.replace(f'{prefix}',''): v for k, v in state_dict.items() if k.startswith(prefix)} if prefix is not None else state_dict
-
-    return filtered_state_dict
+        f = safe_open(ckpt_path, framework="pt", device=str(device))
+        return f.keys(), f.get_tensor, f.metadata()
+
+    try:
+        checkpoint = torch.load(ckpt_path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        checkpoint = torch.load(ckpt_path, map_location="cpu")
+    state_dict = checkpoint["state_dict"] if "state_dict" in checkpoint else checkpoint
+    return state_dict.keys(), state_dict.__getitem__, None
+
+class LazyCheckpoint:
+    '''
+    Read-only mapping over the tensors of a checkpoint that loads each tensor only when it is accessed.
+    .safetensors files are memory-mapped with safe_open, torch checkpoints are loaded with mmap=True
+    (falling back to a full load for the legacy, non-zip format). A .json manifest written by
+    checkpoint_shards.split_checkpoint reads as the union of its shards, only touching the shards whose tensors are accessed,
+    and so does a directory holding one (e.g. an export of training.export.save_sharded).
+    Keys are filtered by prefix and have it removed, as in load_ckpt_state_dict.
+    '''
+    def __init__(self, ckpt_path, prefix=None, device="cpu"):
+        if os.path.isdir(ckpt_path):
+            ckpt_path = os.path.join(ckpt_path, "manifest.json")
+        if ckpt_path.endswith(".json"):
+            with open(ckpt_path) as f:
+                self.metadata = json.load(f)
+            shard_dir = os.path.dirname(ckpt_path)
+            paths = [os.path.join(shard_dir, component["file"]) for component in self.metadata["components"].values()]
+        else:
+            self.metadata = None
+            paths = [ckpt_path]
+
+        self.device = device
+        self._keys = {}
+        for path in paths:
+            keys, get, metadata = _open_checkpoint(path, device)
+            if self.metadata is None:
+                self.metadata = metadata
+            for k in keys:
+                if prefix is None or k.startswith(prefix):
+                    self._keys[k.replace(prefix, '') if prefix is not None else k] = (get, k)
+
+    def keys(self):
+        return self._keys.keys()
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, key):
+        get, source_key = self._keys[key]
+        return get(source_key)
+
+    def get(self, key, device=None, dtype=None):
+        '''
+        Tensor for key on device, with floating point tensors cast to dtype.
+        '''
+        tensor = self[key]
+        if dtype is not None and not tensor.is_floating_point():
+            dtype = None
+        return tensor.to(device=device if device is not None else tensor.device, dtype=dtype)
+
+def load_ckpt_state_dict(ckpt_path, prefix=None, device="cpu", dtype=None):
+    # Only tensors under prefix are read, straight to device and (for floating point tensors) dtype
+    checkpoint = LazyCheckpoint(ckpt_path, prefix=prefix, device=device)
+    return {k: checkpoint.get(k, device=device, dtype=dtype) for k in checkpoint.keys()}
+
+def load_state_dict_lazy(model, checkpoint, prefix=None, device=None, dtype=None, strict=True):
+    '''
+    Load a checkpoint path or LazyCheckpoint into model one tensor at a time, so peak memory is the model plus one tensor.
+    Parameters and buffers on the meta device (e.g. a model built under `with torch.device("meta")`,
+    which skips random initialisation) are replaced by the loaded tensors on device (the CPU if None),
+    with floating point tensors cast to dtype if given. Others are copied into in place.
+    Returns the missing and unexpected keys.
+    '''
+    if not isinstance(checkpoint, LazyCheckpoint):
+        checkpoint = LazyCheckpoint(checkpoint, prefix=prefix)
+    targets = {}
+    for module_name, module in model.named_modules():
+        for name, tensor in list(module._parameters.items()) + list(module._buffers.items()):
+            if tensor is None or (name in module._buffers and name in module._non_persistent_buffers_set):
+                continue
+            targets[f"{module_name}.{name}" if module_name else name] = (module, name)
+
+    missing_keys = [k for k in targets if k not in checkpoint]
+    unexpected_keys = [k for k in checkpoint.keys() if k not in targets]
+    if strict and (missing_keys or unexpected_keys):
+        raise RuntimeError(f"Error loading checkpoint: missing keys {missing_keys}, unexpected keys {unexpected_keys}")
+
+    with torch.no_grad():
+        for key, (module, name) in targets.items():
+            if key not in checkpoint:
+                continue
+            current = module._parameters[name] if name in module._parameters else module._buffers[name]
+            if current.is_meta:
+                tensor = checkpoint.get(key, device=device if device is not None else "cpu", dtype=dtype)
+                if name in module._parameters:
+                    module._parameters[name] = nn.Parameter(tensor, requires_grad=current.requires_grad)
+                else:
+                    module._buffers[name] = tensor
+            else:
+                current.copy_(checkpoint.get(key, device=current.device))
+
+    return missing_keys, unexpected_keys
 
 def remove_weight_norm_from_model(model):
+    # Folds weight norm into plain weights, for both the hook-based and the parametrization-based implementations.
+    # remove_parametrizations removes every parametrization of weight, so weights with any other are left alone
     for module in model.modules():
-        if hasattr(module, "weight"):
-            print(f"Removing weight norm from {module}")
+        if parametrize.is_parametrized(module, "weight"):
+            if all(isinstance(p, _WeightNorm) for p in module.parametrizations.weight):
+                parametrize.remove_parametrizations(module, "weight")
+        elif any(isinstance(hook, WeightNorm) for hook in module._forward_pre_hooks.values()):
             remove_weight_norm(module)
 
     return model
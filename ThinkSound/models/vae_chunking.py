@@ -0,0 +1,236 @@
+import hashlib
+import json
+import math
+import os
+import time
+
+import torch
+
+# Receptive field of the Oobleck VAE, and tuned chunk_size/overlap for chunked encode/decode
+
+_OOBLECK_DEFAULTS = {"channels": 128, "c_mults": [1, 2, 4, 8], "strides": [2, 4, 8, 8], "antialias_activation": False, "use_nearest_upsample": False}
+
+# alias_free_torch.Activation1d up/downsamples with 12-tap filters at twice the frame rate,
+# so it reaches at most 6 frames to either side
+_ANTIALIAS_EXTENT = 6
+
+def _oobleck_config(coder_config):
+    assert coder_config.get("type", None) == "oobleck", "Receptive field is only known for oobleck encoders/decoders"
+    config = dict(_OOBLECK_DEFAULTS)
+    config.update(coder_config.get("config", {}))
+    return config
+
+# The three ResidualUnits of an Encoder/DecoderBlock, kernel 7 with dilations 1, 3, 9.
+# Oobleck builds them without antialiasing.
+_RESIDUAL_UNITS_EXTENT = 3 * (1 + 3 + 9)
+
+def oobleck_encoder_extent(encoder_config):
+    '''
+    Returns (left, right): how many input samples to either side of a latent frame's position affect that frame.
+    '''
+    config = _oobleck_config(encoder_config)
+    antialias = config["antialias_activation"]
+    act = _ANTIALIAS_EXTENT if antialias else 0
+
+    # Input conv, kernel 7 padding 3
+    left = right = 3
+    jump = 1
+    for stride in config["strides"][:len(config["c_mults"])]:
+        # EncoderBlock: residual units, activation, strided conv with kernel 2*stride
+        padding = math.ceil(stride / 2)
+        left += (_RESIDUAL_UNITS_EXTENT + act + padding) * jump
+        right += (_RESIDUAL_UNITS_EXTENT + act + 2 * stride - 1 - padding) * jump
+        jump *= stride
+    # Final activation and conv, kernel 3 padding 1
+    left += (act + 1) * jump
+    right += (act + 1) * jump
+    return left, right
+
+def oobleck_decoder_extent(decoder_config):
+    '''
+    Returns (left, right): how many output samples to either side of an output sample's position
+    the latent frames affecting it can lie.
+    '''
+    config = _oobleck_config(decoder_config)
+    antialias = config["antialias_activation"]
+    act = _ANTIALIAS_EXTENT if antialias else 0
+    strides = config["strides"][:len(config["c_mults"])]
+
+    jump = math.prod(strides)
+    # Input conv, kernel 7 padding 3
+    left = right = 3 * jump
+    for stride in reversed(strides):
+        left += act * jump
+        right += act * jump
+        jump //= stride
+        if config["use_nearest_upsample"]:
+            # Nearest upsampling, then a 'same' conv with kernel 2*stride
+            left += (stride - 1 + (2 * stride - 1) // 2) * jump
+            right += (2 * stride - 1 - (2 * stride - 1) // 2) * jump
+        else:
+            # Transposed conv, kernel 2*stride
+            padding = math.ceil(stride / 2)
+            left += (2 * stride - 1 - padding) * jump
+            right += padding * jump
+        left += _RESIDUAL_UNITS_EXTENT * jump
+        right += _RESIDUAL_UNITS_EXTENT * jump
+    # Final activation and conv, kernel 7 padding 3
+    left += act + 3
+    right += act + 3
+    return left, right
+
+def receptive_field(autoencoder_config):
+    '''
+    Receptive field of an Oobleck autoencoder, from the "model" section of its config.
+    Returns the encoder and decoder receptive fields in audio samples,
+    and the minimum seam-free chunk overlap in latents for encode_audio/decode_audio.
+    '''
+    samples_per_latent = autoencoder_config["downsampling_ratio"]
+    encoder_extent = oobleck_encoder_extent(autoencoder_config["encoder"])
+    decoder_extent = oobleck_decoder_extent(autoencoder_config["decoder"])
+
+    # Chunked encode/decode trims overlap//2 latents from each inner chunk edge
+    trim = math.ceil(max(*encoder_extent, *decoder_extent) / samples_per_latent)
+
+    return {
+        "encoder": sum(encoder_extent) + 1,
+        "decoder": sum(decoder_extent) + 1,
+        "min_overlap": 2 * trim,
+    }
+
+def min_chunk_overlap(autoencoder_config):
+    return receptive_field(autoencoder_config)["min_overlap"]
+
+# Persisted tuning results
+
+def _cache_path():
+    cache_dir = os.environ.get("THINKSOUND_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "thinksound"))
+    return os.path.join(cache_dir, "vae_chunking.json")
+
+def _cache_key(autoencoder_config, device):
+    config_hash = hashlib.sha1(json.dumps(autoencoder_config, sort_keys=True).encode()).hexdigest()[:16]
+    device = torch.device(device)
+    if device.type == "cuda":
+        device_name = torch.cuda.get_device_name(device)
+    else:
+        device_name = device.type
+    return f"{config_hash}/{device_name}"
+
+def _read_cache():
+    try:
+        with open(_cache_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_chunk_settings(autoencoder_config, device):
+    '''
+    Tuned {"chunk_size", "overlap"} for this autoencoder config on this device, or None if it was never tuned here.
+    '''
+    return _read_cache().get(_cache_key(autoencoder_config, device), None)
+
+def save_chunk_settings(autoencoder_config, device, settings):
+    path = _cache_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cache = _read_cache()
+    cache[_cache_key(autoencoder_config, device)] = settings
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, path)
+
+def default_chunk_settings(autoencoder_config, device, chunk_size=128):
+    '''
+    Tuned settings if there are any, otherwise chunk_size with the receptive-field overlap.
+    '''
+    settings = load_chunk_settings(autoencoder_config, device)
+    if settings is not None:
+        return settings
+
+    try:
+        overlap = min_chunk_overlap(autoencoder_config)
+    except (AssertionError, KeyError):
+        overlap = 32
+    return {"chunk_size": max(chunk_size, overlap + 1), "overlap": overlap}
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+@torch.no_grad()
+def tune_chunking(autoencoder, autoencoder_config, device, candidates=(32, 64, 128, 256, 512), num_latents=1024, repeats=3, tol=1e-4, save=True):
+    '''
+    Benchmark chunked decode_audio over candidate chunk sizes on device, with the receptive-field overlap.
+    A candidate only counts if its output matches the unchunked decode to tol, relative to the output peak.
+    The fastest one is returned and, if save is True, persisted for AutoencoderPretransform to pick up.
+    '''
+    device = torch.device(device)
+    autoencoder = autoencoder.to(device).eval()
+    dtype = next(autoencoder.parameters()).dtype
+    overlap = min_chunk_overlap(autoencoder_config)
+
+    latents = torch.randn(1, autoencoder.latent_dim, num_latents, device=device, dtype=dtype)
+    reference = autoencoder.decode(latents)
+    peak = reference.abs().max().item()
+
+    best = None
+    for chunk_size in candidates:
+        if chunk_size <= overlap or chunk_size >= num_latents:
+            continue
+
+        decoded = autoencoder.decode_audio(latents, chunked=True, overlap=overlap, chunk_size=chunk_size)
+        if (decoded - reference).abs().max().item() > tol * peak:
+            continue
+
+        _sync(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            autoencoder.decode_audio(latents, chunked=True, overlap=overlap, chunk_size=chunk_size)
+        _sync(device)
+        elapsed = (time.perf_counter() - start) / repeats
+
+        print(f"chunk_size {chunk_size}, overlap {overlap}: {elapsed * 1000:.1f} ms")
+        if best is None or elapsed < best[0]:
+            best = (elapsed, chunk_size)
+
+    if best is None:
+        return None
+
+    settings = {"chunk_size": best[1], "overlap": overlap}
+    if save:
+        save_chunk_settings(autoencoder_config, device, settings)
+    return settings
+
+def _pretransform_autoencoder_config(model_config):
+    if model_config["model_type"] == "autoencoder":
+        return model_config["model"]
+    pretransform_config = model_config["model"]["pretransform"]
+    assert pretransform_config["type"] == "autoencoder", "Model has no autoencoder pretransform"
+    return pretransform_config["config"]
+
+if __name__ == "__main__":
+    import argparse
+
+    from .autoencoders import create_autoencoder_from_config
+
+    parser = argparse.ArgumentParser(description="Tune chunk_size/overlap for chunked VAE encode/decode on this host")
+    parser.add_argument("--model-config", required=True, help="Autoencoder or diffusion model config with an autoencoder pretransform")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num-latents", type=int, default=1024)
+    parser.add_argument("--candidates", type=int, nargs="+", default=[32, 64, 128, 256, 512])
+    parser.add_argument("--half", action="store_true", help="Tune the fp16 model")
+    args = parser.parse_args()
+
+    with open(args.model_config) as f:
+        model_config = json.load(f)
+
+    autoencoder_config = _pretransform_autoencoder_config(model_config)
+    print(f"Receptive field: {receptive_field(autoencoder_config)}")
+
+    # Timing and seams only depend on the architecture, so randomly initialised weights are enough
+    autoencoder = create_autoencoder_from_config({"sample_rate": model_config["sample_rate"], "model": autoencoder_config})
+    if args.half:
+        autoencoder = autoencoder.half()
+
+    settings = tune_chunking(autoencoder, autoencoder_config, args.device, candidates=args.candidates, num_latents=args.num_latents)
+    print(f"Tuned settings: {settings}")
@@ -11,6 +11,7 @@ from lightning.pytorch.callbacks import Callback
 from ..models.autoencoders import AudioAutoencoder
 from ..models.bottleneck import VAEBottleneck, RVQBottleneck, DACRVQBottleneck, DACRVQVAEBottleneck, RVQVAEBottleneck, WassersteinBottleneck
 from .losses import MultiLoss, AuralossLoss, ValueLoss, L1Loss
+from .export import AsyncCheckpointWriter
 from .utils import create_optimizer_from_config, create_scheduler_from_config
 
 
@@ -31,7 +32,8 @@ class AutoencoderTrainingWrapper(L.LightningModule):
             ema_copy = None,
             force_input_mono = False,
             latent_mask_ratio = 0.0,
-            teacher_model: AudioAutoencoder = None
+            teacher_model: AudioAutoencoder = None,
+            async_export: dict = None
     ):
         super().__init__()
 
@@ -221,6 +223,9 @@ class AutoencoderTrainingWrapper(L.LightningModule):
 
         self.latent_mask_ratio = latent_mask_ratio
 
+        # e.g. {"max_shard_size_gb": 2}: export_model writes sharded safetensors in the background
+        self.exporter = AsyncCheckpointWriter(**async_export) if async_export is not None else None
+
     def configure_optimizers(self):
 
         opt_gen = create_optimizer_from_config(self.optimizer_configs['autoencoder']['optimizer'], self.autoencoder.parameters())
@@ -378,13 +383,23 @@ class AutoencoderTrainingWrapper(L.LightningModule):
 
         return loss
     
+    def on_train_end(self):
+        if self.exporter is not None:
+            self.exporter.synchronize()
+
     def export_model(self, path, use_safetensors=False):
+        '''
+        With async_export, path becomes a symlink to <path>.<global step>, a directory of safetensors shards,
+        and a future of its manifest is returned.
+        '''
         if self.autoencoder_ema is not None:
             model = self.autoencoder_ema.ema_model
         else:
             model = self.autoencoder
             
-        if use_safetensors:
+        if self.exporter is not None:
+            return self.exporter.save(model.state_dict(), path, version=self.global_step)
+        elif use_safetensors:
             save_model(model, path)
         else:
             torch.save({"state_dict": model.state_dict()}, path)
@@ -8,18 +8,22 @@ import torchaudio
 import typing as tp
 import wandb
 from aeiou.viz import audio_spectrogram_image
-from ema_pytorch import EMA
 from einops import rearrange
 from safetensors.torch import save_file
 from torch import optim
 from torch.nn import functional as F
 from pytorch_lightning.utilities.rank_zero import rank_zero_only
 from ..inference.sampling import get_alphas_sigmas, sample, sample_discrete_euler
+from ..data.conditioning_store import conditioning_to
 from ..models.diffusion import DiffusionModelWrapper, ConditionedDiffusionModelWrapper
 from ..models.autoencoders import DiffusionAutoencoder
+from ..models.checkpointing import set_activation_checkpointing
+from ..models.packing import PACKING_KEY, SequencePacking
 from .autoencoders import create_loss_modules_from_bottleneck
+from .ema import ForeachEMA
+from .export import AsyncCheckpointWriter
 from .losses import MSELoss, MultiLoss
-from .utils import create_optimizer_from_config, create_scheduler_from_config, generate_mask, generate_channel_mask
+from .utils import create_optimizer_from_config, create_scheduler_from_config, generate_mask, generate_channel_mask, random_inpaint_mask
 import os
 from pathlib import Path
 from time import time
@@ -60,23 +64,36 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
             cfg_dropout_prob = 0.1,
             timestep_sampler: tp.Literal["uniform", "logit_normal"] = "uniform",
             max_mask_segments = 0,
+            mask_seed: tp.Optional[int] = None,
+            log_loss_info_every: int = 1,
+            ema_update_every: int = 1,
+            ema_cpu: bool = False,
+            activation_checkpointing: tp.Optional[dict] = None,
+            async_export: tp.Optional[dict] = None,
     ):
         super().__init__()
 
         self.diffusion = model
 
+        # e.g. {"policy": "every_k", "every": 2} or {"policy": "budget", "memory_budget_gb": 20}
+        if activation_checkpointing is not None:
+            set_activation_checkpointing(self.diffusion.model.model, **activation_checkpointing)
+
         if use_ema:
-            self.diffusion_ema = EMA(
+            self.diffusion_ema = ForeachEMA(
                 self.diffusion.model,
                 beta=0.9999,
                 power=3/4,
-                update_every=1,
+                update_every=ema_update_every,
                 update_after_step=1,
-                include_online_model=False
+                cpu=ema_cpu
             )
         else:
             self.diffusion_ema = None
 
+        # e.g. {"max_shard_size_gb": 2}: export_model writes sharded safetensors in the background
+        self.exporter = AsyncCheckpointWriter(**async_export) if async_export is not None else None
+
         self.mask_padding = mask_padding
         self.mask_padding_dropout = mask_padding_dropout
 
@@ -90,12 +107,15 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
         print(f'Training in the {self.diffusion_objective} formulation with timestep sampler: {timestep_sampler}')
 
         self.max_mask_segments = max_mask_segments
+        # Inpainting masks are drawn from their own generator, seeded from mask_seed (or the global seed) on first use
+        self.mask_seed = mask_seed
+        self.mask_generator = None
             
         self.loss_modules = [
             MSELoss("output", 
                    "targets", 
                    weight=1.0, 
-                   mask_key="padding_mask" if self.mask_padding else None, 
+                   mask_key="padding_mask", 
                    name="mse_loss"
             )
         ]
@@ -103,6 +123,9 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
         self.losses = MultiLoss(self.loss_modules)
 
         self.log_loss_info = log_loss_info
+        self.log_loss_info_every = log_loss_info_every
+        self.loss_bucket_totals = None
+        self.loss_bucket_steps = 0
 
         assert lr is not None or optimizer_configs is not None, "Must specify either lr or optimizer_configs in training config"
 
@@ -140,7 +163,7 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
         return [opt_diff]
 
     def training_step(self, batch, batch_idx):
-        reals, metadata = batch
+        reals, metadata = batch[:2]
         # import ipdb
         # ipdb.set_trace()
         p = Profiler()
@@ -155,16 +178,30 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
 
         p.tick("setup")
 
-        with torch.amp.autocast('cuda'):
+        # Rows of several clips each, from data.packing.PackingCollator
+        packing = SequencePacking.from_metadata(metadata, self.device) if PACKING_KEY in metadata[0] else None
 
-            conditioning = self.diffusion.conditioner(metadata, self.device)
+        if len(batch) > 2:
+            # Conditioner outputs precomputed for this dataset (data.conditioning_store), batched and pinned by the loader
+            conditioning = conditioning_to(batch[2], self.device)
+        else:
+            with torch.amp.autocast('cuda'):
+
+                conditioning = self.diffusion.conditioner(metadata, self.device)
             
 
         video_exist = torch.stack([item['video_exist'] for item in metadata],dim=0)
-        conditioning['metaclip_features'][~video_exist] = self.diffusion.model.model.empty_clip_feat
-        conditioning['sync_features'][~video_exist] = self.diffusion.model.model.empty_sync_feat
+        if packing is None:
+            conditioning['metaclip_features'][~video_exist] = self.diffusion.model.model.empty_clip_feat
+            conditioning['sync_features'][~video_exist] = self.diffusion.model.model.empty_sync_feat
+        else:
+            # video_exist is per segment
+            video_exist = video_exist.to(self.device)
+            conditioning['metaclip_features'][~packing.to_tokens(video_exist, packing.ids['clip'])] = self.diffusion.model.model.empty_clip_feat
+            conditioning['sync_features'][~packing.to_tokens(video_exist, packing.ids['sync'])] = self.diffusion.model.model.empty_sync_feat
         # If mask_padding is on, randomly drop the padding masks to allow for learning silence padding
-        use_padding_mask = self.mask_padding and random.random() > self.mask_padding_dropout
+        # Packed rows have no padding masks, the loss skips the tokens outside their clips instead
+        use_padding_mask = self.mask_padding and packing is None and random.random() > self.mask_padding_dropout
 
         # Create batch tensor of attention masks from the "mask" field of the metadata array
         if use_padding_mask:
@@ -200,11 +237,15 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
             conditioning['inpaint_mask'] = [mask]
             conditioning['inpaint_masked_input'] = masked_input
 
+        # One timestep per clip: per row, or per segment of a packed row
+        num_timesteps = reals.shape[0] * (packing.num_segments if packing is not None else 1)
         if self.timestep_sampler == "uniform":
             # Draw uniformly distributed continuous timesteps
-            t = self.rng.draw(reals.shape[0])[:, 0].to(self.device)
+            t = self.rng.draw(num_timesteps)[:, 0].to(self.device)
         elif self.timestep_sampler == "logit_normal":
-            t = torch.sigmoid(torch.randn(reals.shape[0], device=self.device))
+            t = torch.sigmoid(torch.randn(num_timesteps, device=self.device))
+        if packing is not None:
+            t = t.view(reals.shape[0], packing.num_segments)
         # import ipdb
         # ipdb.set_trace()
         # Calculate the noise schedule parameters for those timesteps
@@ -214,8 +255,13 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
             alphas, sigmas = 1-t, t
 
         # Combine the ground truth data and the noise
-        alphas = alphas[:, None, None]
-        sigmas = sigmas[:, None, None]
+        segment_sigmas = sigmas
+        if packing is None:
+            alphas = alphas[:, None, None]
+            sigmas = sigmas[:, None, None]
+        else:
+            alphas = packing.to_tokens(alphas, packing.ids['latent']).unsqueeze(1)
+            sigmas = packing.to_tokens(sigmas, packing.ids['latent']).unsqueeze(1)
         noise = torch.randn_like(diffusion_input)
         noised_inputs = diffusion_input * alphas + noise * sigmas
 
@@ -231,6 +277,9 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
         if use_padding_mask:
             extra_args["mask"] = padding_masks
 
+        if packing is not None:
+            extra_args["packing"] = packing
+
         with torch.amp.autocast('cuda'):
             p.tick("amp")
             output = self.diffusion(noised_inputs, t, cond=conditioning, cfg_dropout_prob = self.cfg_dropout_prob, **extra_args)
@@ -241,31 +290,22 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
                 "targets": targets,
                 "padding_mask": padding_masks if use_padding_mask else None,
             })
+            if packing is not None:
+                loss_info["padding_mask"] = packing.keep('latent').squeeze(-1)
 
             loss, losses = self.losses(loss_info)
 
             p.tick("loss")
 
             if self.log_loss_info:
-                # Loss debugging logs
-                num_loss_buckets = 10
-                bucket_size = 1 / num_loss_buckets
                 loss_all = F.mse_loss(output, targets, reduction="none")
-
-                sigmas = rearrange(self.all_gather(sigmas), "w b c n -> (w b) c n").squeeze()
-
-                # gather loss_all across all GPUs
-                loss_all = rearrange(self.all_gather(loss_all), "w b c n -> (w b) c n")
-
-                # Bucket loss values based on corresponding sigma values, bucketing sigma values by bucket_size
-                loss_all = torch.stack([loss_all[(sigmas >= i) & (sigmas < i + bucket_size)].mean() for i in torch.arange(0, 1, bucket_size).to(self.device)])
-
-                # Log bucketed losses with corresponding sigma bucket values, if it's not NaN
-                debug_log_dict = {
-                    f"model/loss_all_{i/num_loss_buckets:.1f}": loss_all[i].detach() for i in range(num_loss_buckets) if not torch.isnan(loss_all[i])
-                }
-
-                self.log_dict(debug_log_dict)
+                if packing is None:
+                    self.log_loss_buckets(loss_all, sigmas)
+                else:
+                    # One loss per clip
+                    segment_loss = packing.segment_mean(loss_all.mean(dim=1).unsqueeze(-1), 'latent').squeeze(-1)
+                    used = packing.segment_lengths('latent') > 0
+                    self.log_loss_buckets(segment_loss[used].unsqueeze(1), segment_sigmas[used])
 
 
         log_dict = {
@@ -407,39 +447,47 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
         # # Put the demos together
         # fakes = rearrange(fakes, 'b d n -> d (b n)')
 
-    def random_mask(self, sequence, max_mask_length):
-        b, _, sequence_length = sequence.size()
-
-        # Create a mask tensor for each batch element
-        masks = []
-
-        for i in range(b):
-            mask_type = random.randint(0, 2)
+    def log_loss_buckets(self, loss_all, sigmas, num_loss_buckets=10):
+        """
+        Loss debugging logs: mean loss per sigma bucket of width 1 / num_loss_buckets.
+        Per-bucket sums and counts are accumulated on device and only gathered across ranks and logged
+        every log_loss_info_every steps, so the other steps cost a bucketize and two scatter_adds.
+        """
+        sample_loss = loss_all.detach().flatten(1).mean(dim=1).float()
+        boundaries = torch.arange(1, num_loss_buckets, device=sample_loss.device) / num_loss_buckets
+        buckets = torch.bucketize(sigmas.detach().flatten().float(), boundaries, right=True)
+
+        if self.loss_bucket_totals is None:
+            self.loss_bucket_totals = sample_loss.new_zeros(2, num_loss_buckets)
+        self.loss_bucket_totals[0].scatter_add_(0, buckets, sample_loss)
+        self.loss_bucket_totals[1].scatter_add_(0, buckets, torch.ones_like(sample_loss))
+
+        self.loss_bucket_steps += 1
+        if self.loss_bucket_steps % self.log_loss_info_every != 0:
+            return
 
-            if mask_type == 0:  # Random mask with multiple segments
-                num_segments = random.randint(1, self.max_mask_segments)
-                max_segment_length = max_mask_length // num_segments
+        totals = self.loss_bucket_totals
+        if self.trainer.world_size > 1:
+            totals = self.all_gather(totals).sum(dim=0)
+        self.loss_bucket_totals = None
 
-                segment_lengths = random.sample(range(1, max_segment_length + 1), num_segments)
-               
-                mask = torch.ones((1, 1, sequence_length))
-                for length in segment_lengths:
-                    mask_start = random.randint(0, sequence_length - length)
-                    mask[:, :, mask_start:mask_start + length] = 0
+        sums, counts = totals.cpu()
+        # Log bucketed losses with corresponding sigma bucket values, for buckets that saw any samples
+        debug_log_dict = {
+            f"model/loss_all_{i/num_loss_buckets:.1f}": sums[i] / counts[i] for i in range(num_loss_buckets) if counts[i] > 0
+        }
 
-            elif mask_type == 1:  # Full mask
-                mask = torch.zeros((1, 1, sequence_length))
+        self.log_dict(debug_log_dict)
 
-            elif mask_type == 2:  # Causal mask
-                mask = torch.ones((1, 1, sequence_length))
-                mask_length = random.randint(1, max_mask_length)
-                mask[:, :, -mask_length:] = 0
+    def random_mask(self, sequence, max_mask_length):
+        b, _, sequence_length = sequence.size()
 
-            mask = mask.to(sequence.device)
-            masks.append(mask)
+        if self.mask_generator is None or self.mask_generator.device != sequence.device:
+            seed = self.mask_seed if self.mask_seed is not None else torch.randint(2**62, (1,)).item()
+            self.mask_generator = torch.Generator(sequence.device).manual_seed(seed)
 
-        # Concatenate the mask tensors into a single tensor
-        mask = torch.cat(masks, dim=0).to(sequence.device)
+        mask = random_inpaint_mask(b, sequence_length, max_mask_length, self.max_mask_segments,
+                                   device=sequence.device, generator=self.mask_generator)
 
         # Apply the mask to the sequence tensor for each batch element
         masked_sequence = sequence * mask
@@ -450,11 +498,22 @@ class DiffusionCondTrainingWrapper(L.LightningModule):
         if self.diffusion_ema is not None:
             self.diffusion_ema.update()
 
+    def on_train_end(self):
+        if self.exporter is not None:
+            self.exporter.synchronize()
+
     def export_model(self, path, use_safetensors=False):
+        '''
+        With async_export, path becomes a symlink to <path>.<global step>, a directory of safetensors shards,
+        and a future of its manifest is returned.
+        '''
         if self.diffusion_ema is not None:
+            self.diffusion_ema.synchronize()
             self.diffusion.model = self.diffusion_ema.ema_model
         
-        if use_safetensors:
+        if self.exporter is not None:
+            return self.exporter.save(self.diffusion.state_dict(), path, version=self.global_step)
+        elif use_safetensors:
             save_file(self.diffusion.state_dict(), path)
         else:
             torch.save({"state_dict": self.diffusion.state_dict()}, path)
@@ -0,0 +1,159 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch import nn
+
+class ForeachEMA(nn.Module):
+    '''
+    Exponential moving average of a model's parameters, a drop-in for ema_pytorch.EMA as used by the training wrappers:
+    same warmup schedule (decay = 1 - (1 + step / inv_gamma) ** -power, clamped to [min_value, beta]), same
+    update_every / update_after_step semantics and the same state dict keys (ema_model.*, step, initted).
+
+    Each update is a single _foreach lerp over all parameters instead of one kernel per tensor. With update_every > 1
+    the decay is raised to the power update_every, so the average covers the same number of optimizer steps.
+    With cpu=True the EMA copy stays on the CPU: each update copies the parameters into pinned buffers without
+    blocking and a background thread folds them into the average while training continues.
+    '''
+    def __init__(
+            self,
+            model: nn.Module,
+            beta: float = 0.9999,
+            power: float = 2/3,
+            inv_gamma: float = 1.0,
+            min_value: float = 0.0,
+            update_every: int = 1,
+            update_after_step: int = 100,
+            cpu: bool = False,
+    ):
+        super().__init__()
+
+        # The online model belongs to the training wrapper, keep it out of this module's state dict
+        self.__dict__["online_model"] = model
+        self.ema_model = copy.deepcopy(model).requires_grad_(False)
+
+        self.beta = beta
+        self.power = power
+        self.inv_gamma = inv_gamma
+        self.min_value = min_value
+        self.update_every = update_every
+        self.update_after_step = update_after_step
+        self.cpu = cpu
+
+        self.register_buffer("initted", torch.tensor(False))
+        self.register_buffer("step", torch.tensor(0))
+        # Python copies of step and initted, so deciding whether to update does not synchronize with the device
+        self._step = 0
+        self._initted = False
+        self._tensor_lists = None
+
+        self._snapshot = None
+        self._pending = None
+        self._executor = None
+
+        if cpu:
+            self.ema_model.to("cpu")
+
+    def _apply(self, fn, *args, **kwargs):
+        # With cpu=True, moving the training module to the GPU must not move the EMA copy
+        if not self.cpu:
+            return super()._apply(fn, *args, **kwargs)
+        ema_model = self._modules.pop("ema_model")
+        try:
+            return super()._apply(fn, *args, **kwargs)
+        finally:
+            self._modules["ema_model"] = ema_model
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self.synchronize()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._step = int(self.step)
+        self._initted = bool(self.initted)
+
+    def state_dict(self, *args, **kwargs):
+        self.synchronize()
+        return super().state_dict(*args, **kwargs)
+
+    def _tensors(self):
+        if self._tensor_lists is not None:
+            return self._tensor_lists
+        ema = dict(self.ema_model.named_parameters())
+        online = dict(self.online_model.named_parameters())
+        names = [name for name, p in ema.items() if p.is_floating_point()]
+        ema_buffers = dict(self.ema_model.named_buffers())
+        online_buffers = dict(self.online_model.named_buffers())
+        self._tensor_lists = ([ema[n] for n in names], [online[n] for n in names],
+                              list(ema_buffers.values()), [online_buffers[n] for n in ema_buffers])
+        return self._tensor_lists
+
+    def get_current_decay(self):
+        epoch = self._step - self.update_after_step - 1
+        if epoch <= 0:
+            return 0.0
+        value = 1 - (1 + epoch / self.inv_gamma) ** -self.power
+        return min(max(value, self.min_value), self.beta)
+
+    @torch.no_grad()
+    def copy_params_from_model_to_ema(self):
+        self.synchronize()
+        ema_params, online_params, ema_buffers, online_buffers = self._tensors()
+        torch._foreach_copy_(ema_params, online_params)
+        if ema_buffers:
+            torch._foreach_copy_(ema_buffers, online_buffers)
+
+    def synchronize(self):
+        '''
+        Wait for a background CPU update to finish.
+        '''
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def _cpu_update(self, ema_params, snapshot, weight, event):
+        if event is not None:
+            event.synchronize()
+        torch._foreach_lerp_(ema_params, snapshot, weight)
+
+    @torch.no_grad()
+    def update(self):
+        step = self._step
+        self._step += 1
+        self.step.fill_(self._step)
+
+        if step % self.update_every != 0:
+            return
+
+        if step <= self.update_after_step:
+            self.copy_params_from_model_to_ema()
+            return
+
+        if not self._initted:
+            self.copy_params_from_model_to_ema()
+            self.initted.fill_(True)
+            self._initted = True
+
+        # Skipped steps would each have applied the decay once more
+        weight = 1 - self.get_current_decay() ** self.update_every
+        ema_params, online_params, ema_buffers, online_buffers = self._tensors()
+
+        if not self.cpu:
+            torch._foreach_lerp_(ema_params, online_params, weight)
+            if ema_buffers:
+                torch._foreach_copy_(ema_buffers, online_buffers)
+            return
+
+        # The snapshot buffers are reused, so the previous update must be done with them first
+        self.synchronize()
+        on_cuda = online_params[0].is_cuda
+        if self._snapshot is None:
+            self._snapshot = [torch.empty(p.shape, dtype=ema.dtype, pin_memory=on_cuda) for p, ema in zip(online_params, ema_params)]
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ema")
+
+        torch._foreach_copy_(self._snapshot, online_params, non_blocking=on_cuda)
+        event = None
+        if on_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        if ema_buffers:
+            torch._foreach_copy_(ema_buffers, online_buffers)
+        self._pending = self._executor.submit(self._cpu_update, ema_params, self._snapshot, weight, event)
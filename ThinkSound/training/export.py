@@ -0,0 +1,185 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+# Asynchronous model export for the training wrappers. The state dict is copied into reusable (pinned, for CUDA models)
+# CPU buffers, which is all the training loop waits for; a background thread then writes the copy as safetensors
+# shards of at most max_shard_size bytes with a manifest.json. Each export goes to its own directory <path>.<version>,
+# fsynced, and path is a symlink that is atomically swapped to the new directory once it is complete, so path always
+# names a complete export, even after a crash or power loss mid-write. The manifest has the layout of
+# models.checkpoint_shards.split_checkpoint, so models.utils.LazyCheckpoint and load_ckpt_state_dict read an export
+# directory (or its manifest.json) as one checkpoint.
+
+MANIFEST = "manifest.json"
+
+def shard_state_dict(state_dict, max_shard_size):
+    '''
+    Split state_dict into a list of dicts of at most max_shard_size bytes each, keeping key order.
+    A tensor larger than max_shard_size gets a shard of its own.
+    '''
+    shards = [{}]
+    size = 0
+    for key, tensor in state_dict.items():
+        num_bytes = tensor.numel() * tensor.element_size()
+        if shards[-1] and size + num_bytes > max_shard_size:
+            shards.append({})
+            size = 0
+        shards[-1][key] = tensor
+        size += num_bytes
+    return shards
+
+def _fsync(path):
+    # Files and, on POSIX, directories: a directory is synced so the entries created in it survive a power loss
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _version_path(path, version):
+    version_path = f"{path}.{version if version is not None else time.time_ns()}"
+    # A re-export of the same version must not write into the directory path may still point to
+    return version_path if not os.path.exists(version_path) else f"{version_path}.{time.time_ns()}"
+
+def save_sharded(state_dict, path, max_shard_size=2 * 2**30, metadata=None, version=None, keep_previous=False):
+    '''
+    Write state_dict as model-0000i-of-0000n.safetensors shards and a manifest.json to a new directory
+    <path>.<version> (a timestamp by default), then atomically point the symlink path at it.
+    The export path pointed to before is removed unless keep_previous is set. Returns the manifest.
+    '''
+    from safetensors.torch import save_file
+
+    assert not os.path.exists(path) or os.path.islink(path), f"{path} exists and is not an export symlink"
+    version_path = _version_path(path, version)
+    os.makedirs(version_path)
+
+    try:
+        shards = shard_state_dict(state_dict, max_shard_size)
+        manifest = {"metadata": metadata or {}, "components": {}}
+        for i, shard in enumerate(shards):
+            name = f"model-{i + 1:05d}-of-{len(shards):05d}"
+            filename = f"{name}.safetensors"
+            save_file(shard, os.path.join(version_path, filename), metadata={"component": name})
+            _fsync(os.path.join(version_path, filename))
+            manifest["components"][name] = {
+                "file": filename,
+                "num_tensors": len(shard),
+                "num_bytes": sum(t.numel() * t.element_size() for t in shard.values()),
+            }
+
+        with open(os.path.join(version_path, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync(version_path)
+    except BaseException:
+        shutil.rmtree(version_path, ignore_errors=True)
+        raise
+
+    # The swap is a single rename of a relative symlink, so the export directory can be moved as a whole
+    parent = os.path.dirname(os.path.abspath(path))
+    previous = os.path.join(parent, os.readlink(path)) if os.path.islink(path) else None
+    link_path = f"{path}.link"
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.basename(version_path), link_path)
+    os.replace(link_path, path)
+    _fsync(parent)
+
+    if previous is not None and not keep_previous and os.path.abspath(previous) != os.path.abspath(version_path):
+        shutil.rmtree(previous, ignore_errors=True)
+    return manifest
+
+class AsyncCheckpointWriter:
+    '''
+    Saves state dicts with save_sharded in a background thread. save returns once the state dict is copied to
+    CPU buffers, which are reused by the next save, so a save first waits for the previous write to finish.
+    An error in a write is raised by the next save or synchronize.
+    '''
+    def __init__(self, max_shard_size_gb: float = 2.0, keep_previous: bool = False):
+        self.max_shard_size = int(max_shard_size_gb * 2**30)
+        self.keep_previous = keep_previous
+        self._buffers = {}
+        self._pending = None
+        self._executor = None
+
+    def synchronize(self):
+        '''
+        Wait for the pending write to finish.
+        '''
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    @torch.no_grad()
+    def snapshot(self, state_dict):
+        # Non-blocking copies into pinned buffers for CUDA tensors; the write waits for them with a CUDA event
+        snapshot = {}
+        on_cuda = False
+        for key, tensor in state_dict.items():
+            tensor = tensor.detach()
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+                buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=tensor.is_cuda)
+                self._buffers[key] = buffer
+            buffer.copy_(tensor, non_blocking=tensor.is_cuda)
+            on_cuda = on_cuda or tensor.is_cuda
+            snapshot[key] = buffer
+        for key in set(self._buffers) - set(snapshot):
+            del self._buffers[key]
+
+        event = None
+        if on_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        return snapshot, event
+
+    def _write(self, snapshot, event, path, metadata, version):
+        if event is not None:
+            event.synchronize()
+        return save_sharded(snapshot, path, self.max_shard_size, metadata, version=version, keep_previous=self.keep_previous)
+
+    def save(self, state_dict, path, metadata=None, version=None):
+        '''
+        Save state_dict in the background to <path>.<version>, which the symlink path then points to.
+        Returns a future of the manifest.
+        '''
+        self.synchronize()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+        snapshot, event = self.snapshot(state_dict)
+        self._pending = self._executor.submit(self._write, snapshot, event, path, metadata, version)
+        return self._pending
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time the training loop stall of a blocking save against an asynchronous sharded export")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--size-gb", type=float, default=2.0, help="Size of the random state dict")
+    parser.add_argument("--max-shard-size-gb", type=float, default=0.5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    from safetensors.torch import save_file
+
+    num_tensors = 64
+    numel = int(args.size_gb * 2**30 / 4 / num_tensors)
+    state_dict = {f"layer_{i}.weight": torch.randn(numel, device=args.device) for i in range(num_tensors)}
+
+    start = time.perf_counter()
+    save_file({k: v.cpu() for k, v in state_dict.items()}, os.path.join(args.output_dir, "blocking.safetensors"))
+    print(f"blocking save_file: {time.perf_counter() - start:.2f} s stall")
+
+    writer = AsyncCheckpointWriter(args.max_shard_size_gb)
+    for i in range(2):
+        start = time.perf_counter()
+        future = writer.save(state_dict, os.path.join(args.output_dir, "async"))
+        stall = time.perf_counter() - start
+        future.result()
+        # The first save allocates the pinned buffers
+        print(f"async save {i}: {stall:.2f} s stall, {time.perf_counter() - start:.2f} s until written")
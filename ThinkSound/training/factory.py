@@ -16,13 +16,19 @@ def create_training_wrapper_from_config(model_config, model):
             mask_padding=training_config.get("mask_padding", False),
             mask_padding_dropout=training_config.get("mask_padding_dropout", 0.0),
             use_ema = training_config.get("use_ema", True),
+            ema_update_every = training_config.get("ema_update_every", 1),
+            ema_cpu = training_config.get("ema_cpu", False),
+            activation_checkpointing = training_config.get("activation_checkpointing", None),
+            async_export = training_config.get("async_export", None),
             log_loss_info=training_config.get("log_loss_info", False),
+            log_loss_info_every=training_config.get("log_loss_info_every", 1),
             optimizer_configs=training_config.get("optimizer_configs", None),
             pre_encoded=training_config.get("pre_encoded", False),
             diffusion_objective=training_config.get("diffusion_objective","v"),
             cfg_dropout_prob = training_config.get("cfg_dropout_prob", 0.1),
             timestep_sampler = training_config.get("timestep_sampler", "uniform"),
-            max_mask_segments = training_config.get("max_mask_segments", 0)
+            max_mask_segments = training_config.get("max_mask_segments", 0),
+            mask_seed = training_config.get("mask_seed", None)
         )
     else:
         raise NotImplementedError(f'Unknown model type: {model_type}')
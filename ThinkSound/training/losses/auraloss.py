@@ -293,7 +293,8 @@ class STFTLoss(torch.nn.Module):
         self.fft_size = fft_size
         self.hop_size = hop_size
         self.win_length = win_length
-        self.window = get_window(window, win_length)
+        # Buffers follow the module to its device; the window is not part of the state dict
+        self.register_buffer("window", get_window(window, win_length).float(), persistent=False)
         self.w_sc = w_sc
         self.w_log_mag = w_log_mag
         self.w_lin_mag = w_lin_mag
@@ -345,6 +346,7 @@ class STFTLoss(torch.nn.Module):
                 fb = librosa.filters.chroma(
                     sr=sample_rate, n_fft=fft_size, n_chroma=n_bins
                 )
+                fb = torch.tensor(fb, dtype=torch.float32).unsqueeze(0)
 
             else:
                 raise ValueError(
@@ -372,6 +374,8 @@ class STFTLoss(torch.nn.Module):
             Tensor: x_mag, x_phs
                 Magnitude and phase spectra (B, fft_size // 2 + 1, frames).
         """
+        if self.window.device != x.device:
+            self.to(x.device)
         x_stft = torch.stft(
             x,
             self.fft_size,
@@ -380,9 +384,8 @@ class STFTLoss(torch.nn.Module):
             self.window,
             return_complex=True,
         )
-        x_mag = torch.sqrt(
-            torch.clamp((x_stft.real**2) + (x_stft.imag**2), min=self.eps)
-        )
+        # sqrt(max(|x|^2, eps)) without materializing the squares
+        x_mag = x_stft.abs().clamp(min=self.eps**0.5)
 
         # torch.angle is expensive, so it is only evaluated if the values are used in the loss
         if self.phs_used:
@@ -392,33 +395,36 @@ class STFTLoss(torch.nn.Module):
 
         return x_mag, x_phs
 
-    def forward(self, input: torch.Tensor, target: torch.Tensor):
+    def prepare(self, input: torch.Tensor, target: torch.Tensor):
+        """Apply the optional A-weighting and stack input and target into one (2 * B * C, T) batch of signals,
+        so both are transformed by a single STFT. The result can be shared by losses at several resolutions."""
         bs, chs, seq_len = input.size()
 
         if self.perceptual_weighting:  # apply optional A-weighting via FIR filter
             # since FIRFilter only support mono audio we will move channels to batch dim
-            input = input.view(bs * chs, 1, -1)
-            target = target.view(bs * chs, 1, -1)
+            input = input.reshape(bs * chs, 1, -1)
+            target = target.reshape(bs * chs, 1, -1)
 
             # now apply the filter to both
             self.prefilter.to(input.device)
             input, target = self.prefilter(input, target)
 
-            # now move the channels back
-            input = input.view(bs, chs, -1)
-            target = target.view(bs, chs, -1)
+        return torch.cat([input.reshape(-1, input.shape[-1]), target.reshape(-1, target.shape[-1])])
 
-        # compute the magnitude and phase spectra of input and target
-        self.window = self.window.to(input.device)
+    def forward(self, input: torch.Tensor, target: torch.Tensor):
+        return self.spectral_loss(self.prepare(input, target))
 
-        x_mag, x_phs = self.stft(input.view(-1, input.size(-1)))
-        y_mag, y_phs = self.stft(target.view(-1, target.size(-1)))
+    def spectral_loss(self, signals: torch.Tensor):
+        """Loss between the two halves (input, then target) of signals, as returned by prepare."""
+        # compute the magnitude and phase spectra of input and target
+        mag, phs = self.stft(signals)
 
         # apply relevant transforms
         if self.scale is not None:
-            self.fb = self.fb.to(input.device)
-            x_mag = torch.matmul(self.fb, x_mag)
-            y_mag = torch.matmul(self.fb, y_mag)
+            mag = torch.matmul(self.fb, mag)
+
+        x_mag, y_mag = mag.chunk(2)
+        x_phs, y_phs = phs.chunk(2) if phs is not None else (None, None)
 
         # normalize scales
         if self.scale_invariance:
@@ -517,18 +523,18 @@ class MultiResolutionSTFTLoss(torch.nn.Module):
     def forward(self, x, y):
         mrstft_loss = 0.0
         sc_mag_loss, log_mag_loss, lin_mag_loss, phs_loss = [], [], [], []
-        # import ipdb
-        # ipdb.set_trace()
+        # The resolutions share the A-weighting and the stacked input/target batch
+        signals = self.stft_losses[0].prepare(x, y)
         for f in self.stft_losses:
             if f.output == "full":  # extract just first term
-                tmp_loss = f(x, y)
+                tmp_loss = f.spectral_loss(signals)
                 mrstft_loss += tmp_loss[0]
                 sc_mag_loss.append(tmp_loss[1])
                 log_mag_loss.append(tmp_loss[2])
                 lin_mag_loss.append(tmp_loss[3])
                 phs_loss.append(tmp_loss[4])
             else:
-                mrstft_loss += f(x, y)
+                mrstft_loss += f.spectral_loss(signals)
 
         mrstft_loss /= len(self.stft_losses)
 
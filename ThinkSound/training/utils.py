@@ -181,6 +181,43 @@ def generate_mask(batch_size, seq_len, frac_lengths, min_span_len):
     
     return mask_tensor
 
+def random_inpaint_mask(batch_size, seq_len, max_mask_length, max_mask_segments, device=None, generator=None):
+    """
+    Inpainting masks for a batch, (batch_size, 1, seq_len) with 0 where the input is masked.
+    Each row is equally likely to be
+      0: 1 to max_mask_segments segments with distinct lengths, each at most max_mask_length // num_segments
+      1: fully masked
+      2: causal, the last 1 to max_mask_length positions masked
+    All draws come from generator, so a seeded generator gives the same masks on every run.
+    """
+    def randint(low, high, size):
+        # Uniform integers in [low, high] with per-row bounds
+        return (torch.rand(size, device=device, generator=generator) * (high - low + 1)).long() + low
+
+    mask_type = torch.randint(0, 3, (batch_size,), device=device, generator=generator)
+
+    # Multiple segments: distinct lengths from 1..max_segment_length, drawn by sorting random keys
+    # with the lengths that are out of range pushed to the end
+    num_segments = randint(1, max_mask_segments, (batch_size,))
+    max_segment_length = max_mask_length // num_segments
+    lengths = torch.arange(1, max_mask_length + 1, device=device)
+    keys = torch.rand((batch_size, max_mask_length), device=device, generator=generator)
+    keys = keys.masked_fill(lengths > max_segment_length[:, None], 2.0)
+    segment_lengths = lengths[keys.argsort(dim=1)[:, :max_mask_segments]]
+    active = torch.arange(max_mask_segments, device=device) < num_segments[:, None]
+    active &= segment_lengths <= max_segment_length[:, None]
+    segment_starts = randint(0, seq_len - segment_lengths, (batch_size, max_mask_segments))
+
+    positions = torch.arange(seq_len, device=device)
+    in_segment = (positions >= segment_starts[..., None]) & (positions < (segment_starts + segment_lengths)[..., None])
+    segments_masked = (in_segment & active[..., None]).any(dim=1)
+
+    causal_length = randint(1, max_mask_length, (batch_size,))
+    causal_masked = positions >= seq_len - causal_length[:, None]
+
+    masked = torch.where(mask_type[:, None] == 0, segments_masked, torch.where(mask_type[:, None] == 2, causal_masked, True))
+    return (~masked).float().unsqueeze(1)
+
 def generate_channel_mask(diffusion_input):    
 
     # 如果 r_drop 小于 threshold，则对每个样本选择一个随机声道进行完全 mask
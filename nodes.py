@@ -1,9 +1,7 @@
-import gradio as gr
 import os
 import subprocess
 import shutil
 import uuid
-import cv2
 import sys
 import tempfile
 from datetime import datetime
@@ -106,6 +104,8 @@ def generate_audio(video, title, description, use_half):
         shutil.copy(orig_path, temp_mp4)
 
     # 4. 计算视频时长
+    # cv2 is imported here so that registering the nodes at ComfyUI start-up stays fast
+    import cv2
     cap = cv2.VideoCapture(temp_mp4)
     fps = cap.get(cv2.CAP_PROP_FPS) or 1
     frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
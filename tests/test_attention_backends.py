@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from ThinkSound.models import attention_backends
+from ThinkSound.models.attention_backends import attention, get_attention_backend, register_attention_backend, set_attention_backend
+
+
+@pytest.fixture
+def restore_backend():
+    backend = get_attention_backend()
+    yield
+    set_attention_backend(backend)
+
+
+@pytest.fixture
+def unavailable_backend():
+    @register_attention_backend("unavailable", available=lambda: False)
+    def unavailable_attention(q, k, v):
+        raise AssertionError("an unavailable backend must not be called")
+
+    yield "unavailable"
+    for registry in (attention_backends._backends, attention_backends._supports, attention_backends._available):
+        registry.pop("unavailable")
+
+
+def test_unavailable_backend_falls_back_to_sdpa(restore_backend, unavailable_backend):
+    set_attention_backend(unavailable_backend)
+    assert get_attention_backend() == "sdpa"
+    q = torch.randn(1, 2, 5, 8)
+    assert attention(q, q, q).shape == (1, 5, 16)
+
+
+def test_unknown_backend_is_rejected(restore_backend):
+    with pytest.raises(AssertionError):
+        set_attention_backend("no_such_backend")
+
+
+@pytest.mark.parametrize("name", ["sdpa", "chunked", "math"])
+def test_backends_match_math(restore_backend, name):
+    torch.manual_seed(0)
+    q, k, v = (torch.randn(2, 4, 19, 16) for _ in range(3))
+    set_attention_backend("math")
+    expected = attention(q, k, v)
+    set_attention_backend(name)
+    torch.testing.assert_close(attention(q, k, v), expected, atol=1e-5, rtol=1e-5)
@@ -0,0 +1,75 @@
+import itertools
+
+import pytest
+import torch
+from torch.nn import functional as F
+
+from ThinkSound.models.blocks import ChannelLastConv1d
+
+# ChannelLastConv1d computes the conv as a matmul over unfolded windows; it must match F.conv1d on the
+# permuted (B, C, N) input, forward and backward, and fall back to nn.Conv1d where the matmul does not apply.
+
+IN_CHANNELS = 12
+OUT_CHANNELS = 20
+
+
+def reference(conv, x):
+    # F.conv1d with nn.Conv1d's own padding handling, on (B, N, C) inputs
+    return conv._conv_forward(x.permute(0, 2, 1), conv.weight, conv.bias).permute(0, 2, 1)
+
+
+def check(conv, x, atol=1e-5):
+    x = x.clone().requires_grad_(True)
+    y = conv(x)
+    expected = reference(conv, x)
+    assert y.shape == expected.shape
+    torch.testing.assert_close(y, expected, atol=atol, rtol=1e-5)
+
+    grad = torch.randn_like(y)
+    inputs = [x, conv.weight] + ([conv.bias] if conv.bias is not None else [])
+    grads = torch.autograd.grad(y, inputs, grad)
+    expected_grads = torch.autograd.grad(expected, inputs, grad)
+    for g, expected_g in zip(grads, expected_grads):
+        torch.testing.assert_close(g, expected_g, atol=atol, rtol=1e-5)
+
+
+@pytest.mark.parametrize("kernel_size, padding, stride, dilation, bias",
+                         list(itertools.product([1, 3, 7], [0, 1, 3], [1, 2], [1, 2], [True, False])))
+def test_matches_conv1d(kernel_size, padding, stride, dilation, bias):
+    torch.manual_seed(0)
+    conv = ChannelLastConv1d(IN_CHANNELS, OUT_CHANNELS, kernel_size, stride=stride, padding=padding, dilation=dilation, bias=bias)
+    assert conv.unfold_args is not None
+    check(conv, torch.randn(3, 17, IN_CHANNELS))
+
+
+def test_matches_functional_conv1d():
+    torch.manual_seed(0)
+    conv = ChannelLastConv1d(IN_CHANNELS, OUT_CHANNELS, 7, stride=2, padding=3, dilation=2)
+    x = torch.randn(2, 33, IN_CHANNELS)
+    expected = F.conv1d(x.permute(0, 2, 1), conv.weight, conv.bias, stride=2, padding=3, dilation=2).permute(0, 2, 1)
+    torch.testing.assert_close(conv(x), expected, atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"groups": 4, "padding": 1},
+    {"padding": "same"},
+    {"padding": "valid"},
+    {"padding": 1, "padding_mode": "reflect"},
+    {"padding": 1, "padding_mode": "replicate"},
+    {"padding": 1, "padding_mode": "circular"},
+], ids=["groups", "same", "valid", "reflect", "replicate", "circular"])
+def test_fallback_matches_conv1d(kwargs):
+    torch.manual_seed(0)
+    conv = ChannelLastConv1d(IN_CHANNELS, OUT_CHANNELS, 3, **kwargs)
+    assert conv.unfold_args is None
+    check(conv, torch.randn(3, 17, IN_CHANNELS))
+
+
+def test_half_precision():
+    torch.manual_seed(0)
+    conv = ChannelLastConv1d(IN_CHANNELS, OUT_CHANNELS, 3, padding=1)
+    x = torch.randn(2, 9, IN_CHANNELS)
+    expected = reference(conv, x)
+    y = conv.half()(x.half())
+    assert y.dtype == torch.float16
+    torch.testing.assert_close(y.float(), expected, atol=1e-2, rtol=1e-2)
@@ -0,0 +1,27 @@
+import pytest
+
+from ThinkSound.import_benchmark import NODE_PACKAGE, imported_modules, measure_import_time
+
+# ComfyUI imports every custom node package at start-up; the node package must stay cheap to import and must not
+# pull in heavy optional dependencies, which are imported on first use.
+
+# Seconds to import the node package after torch, best of a few runs in fresh interpreters
+NODE_IMPORT_BUDGET = 0.5
+
+HEAVY_MODULES = ("gradio", "cv2", "k_diffusion", "transformers", "flash_attn")
+
+
+def test_node_import_time():
+    seconds = min(measure_import_time(NODE_PACKAGE)[0] for _ in range(3))
+    assert seconds < NODE_IMPORT_BUDGET, f"Importing the node package took {seconds:.3f}s, more than {NODE_IMPORT_BUDGET}s"
+
+
+@pytest.fixture(scope="module")
+def node_modules():
+    return imported_modules(NODE_PACKAGE)
+
+
+@pytest.mark.parametrize("name", HEAVY_MODULES)
+def test_node_import_skips_heavy_modules(node_modules, name):
+    assert "thinksound_nodes" in node_modules
+    assert name not in node_modules, f"Importing the node package imported {name}"
@@ -0,0 +1,56 @@
+import copy
+
+import pytest
+import torch
+
+from ThinkSound.models.mmdit import MMmodule, sample_inputs
+from ThinkSound.models.quantization import QUANT_MODES, QuantizedLinear, save_quantized
+from ThinkSound.models.utils import load_ckpt_state_dict
+
+# A quantized MMmodule saved with save_quantized must load back through MMmodule.from_checkpoint and
+# MMmodule.load_weights with the same layers quantized, in the same mode, and give the same outputs.
+
+MODEL_KWARGS = dict(latent_dim=8, clip_dim=32, sync_dim=16, text_dim=2048, hidden_dim=64, depth=3, fused_depth=2,
+                    num_heads=4, latent_seq_len=20, clip_seq_len=8, sync_seq_len=16, v2=True, kernel_size=3)
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return MMmodule(**MODEL_KWARGS).eval()
+
+
+def run(model):
+    inputs = sample_inputs(model, 2, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        return model(**inputs, cfg_scale=1.0, cfg_dropout_prob=0.0, scale_phi=0.0)
+
+
+def quantized_layers(model):
+    return {name: module.mode for name, module in model.named_modules() if isinstance(module, QuantizedLinear)}
+
+
+@pytest.mark.parametrize("mode", QUANT_MODES)
+def test_save_reload_round_trip(model, mode, tmp_path):
+    quantized = copy.deepcopy(model).quantize(mode)
+    path = str(tmp_path / f"mmdit_{mode}.safetensors")
+    save_quantized(quantized, path, mode)
+    expected = run(quantized)
+
+    loaded = MMmodule.from_checkpoint(path, prefix="", **MODEL_KWARGS).eval()
+    assert quantized_layers(loaded) == quantized_layers(quantized)
+    assert set(quantized_layers(loaded).values()) == {mode}
+    torch.testing.assert_close(run(loaded), expected, atol=0, rtol=0)
+
+    reloaded = MMmodule(**MODEL_KWARGS).eval()
+    reloaded.load_weights(load_ckpt_state_dict(path), metadata={"quantization": mode})
+    assert quantized_layers(reloaded) == quantized_layers(quantized)
+    torch.testing.assert_close(run(reloaded), expected, atol=0, rtol=0)
+
+
+def test_mode_inferred_without_metadata(model):
+    quantized = copy.deepcopy(model).quantize("int4")
+    reloaded = MMmodule(**MODEL_KWARGS).eval()
+    reloaded.load_weights(quantized.state_dict())
+    assert set(quantized_layers(reloaded).values()) == {"int4"}
+    torch.testing.assert_close(run(reloaded), run(quantized), atol=0, rtol=0)
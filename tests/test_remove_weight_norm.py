@@ -0,0 +1,44 @@
+import torch
+from torch import nn
+from torch.nn.utils import parametrizations, parametrize, weight_norm
+
+from ThinkSound.models.utils import remove_weight_norm_from_model
+
+# remove_weight_norm_from_model folds weight norm, and only weight norm, into plain weights.
+
+
+class Symmetric(nn.Module):
+    def forward(self, weight):
+        return weight.triu() + weight.triu(1).transpose(-1, -2)
+
+
+def check_same_output(model, x):
+    with torch.no_grad():
+        expected = model(x)
+        remove_weight_norm_from_model(model)
+        torch.testing.assert_close(model(x), expected)
+
+
+def test_parametrized_weight_norm_is_folded():
+    model = nn.Sequential(parametrizations.weight_norm(nn.Conv1d(4, 6, 3)))
+    check_same_output(model, torch.randn(2, 4, 10))
+    assert not parametrize.is_parametrized(model[0])
+
+
+def test_hook_weight_norm_is_folded():
+    model = nn.Sequential(weight_norm(nn.Conv1d(4, 6, 3)))
+    check_same_output(model, torch.randn(2, 4, 10))
+    assert "weight_g" not in dict(model[0].named_parameters())
+
+
+def test_other_parametrizations_are_kept():
+    linear = nn.Linear(5, 5)
+    parametrize.register_parametrization(linear, "weight", Symmetric())
+    mixed = nn.Linear(5, 5)
+    parametrizations.weight_norm(mixed)
+    parametrize.register_parametrization(mixed, "weight", Symmetric())
+    model = nn.Sequential(linear, mixed)
+
+    check_same_output(model, torch.randn(3, 5))
+    assert isinstance(linear.parametrizations.weight[0], Symmetric)
+    assert len(mixed.parametrizations.weight) == 2
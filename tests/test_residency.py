@@ -0,0 +1,58 @@
+import pytest
+import torch
+from torch import nn
+
+from ThinkSound.models.residency import ResidencyManager, module_bytes
+
+# Modules that are already on the compute device when they are attached must count against the budget
+# and be offloadable like any module the manager loaded itself.
+
+
+class Pipeline(nn.Module):
+    # The parts of a conditioned diffusion model wrapper ResidencyManager.attach uses
+    def __init__(self):
+        super().__init__()
+        self.conditioner = None
+        self.model = nn.Linear(256, 256)
+        self.pretransform = nn.Linear(128, 128)
+
+
+def test_bare_cuda_device_gets_an_index(monkeypatch):
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    monkeypatch.setattr(torch.cuda, "current_device", lambda: 0)
+    assert ResidencyManager("cuda").device == torch.device("cuda", 0)
+    assert ResidencyManager("cuda:1").device == torch.device("cuda", 1)
+
+
+def check_attached_on_device(device, tmp_path):
+    pipeline = Pipeline().to(device)
+    dit_bytes = module_bytes([pipeline.model])
+    vae_bytes = module_bytes([pipeline.pretransform])
+    manager = ResidencyManager(device, budget_bytes=dit_bytes, offload="disk", offload_dir=str(tmp_path))
+    manager.attach(pipeline)
+
+    assert manager.is_resident("dit") and manager.is_resident("pretransform")
+    assert manager.resident_bytes() == dit_bytes + vae_bytes
+
+    manager.offload("dit")
+    assert manager.resident_bytes() == vae_bytes
+    assert pipeline.model.weight.device.type == "cpu"
+
+    # Loading the DiT back offloads the VAE to stay within the budget
+    with manager.use("dit"):
+        assert manager.is_resident("dit") and not manager.is_resident("pretransform")
+    assert manager.resident_bytes() == dit_bytes
+    assert pipeline.pretransform.weight.device.type == "cpu"
+
+    manager.offload_all()
+    assert manager.resident_bytes() == 0
+    assert pipeline.model.weight.device.type == "cpu"
+
+
+def test_attached_on_cpu(tmp_path):
+    check_attached_on_device("cpu", tmp_path)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_attached_on_cuda(tmp_path):
+    check_attached_on_device("cuda", tmp_path)